@@ -0,0 +1,82 @@
+"""
+INSTREAM throughput across chunk sizes
+
+Streams an in memory payload to a local fake clamd with fixed chunk
+sizes, the size based default and adaptive sizing.
+
+    python benchmarks/chunk_size.py --size 64 --repeat 3 --output chunk_size.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import PyvalveSocket # pylint: disable=wrong-import-position
+from fake_clamd import spawn # pylint: disable=wrong-import-position
+
+FIXED_SIZES = [1 << shift for shift in range(10, 23, 2)]
+
+async def measure(pvs: PyvalveSocket, payload: bytes, repeat: int) -> float:
+    """
+    Stream the payload and time it
+
+    :param pvs PyvalveSocket: Configured client
+    :param payload bytes: Content to stream
+    :param repeat int: Number of streams
+    :return: Best throughput in MB/s
+    :rtype: float
+    """
+    best = 0.0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await pvs.instream(BytesIO(payload))
+        best = max(best, len(payload) / (time.perf_counter() - started) / 1e6)
+    return best
+
+async def main() -> None:
+    """ Run the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=64, help='payload size in MiB')
+    parser.add_argument('--repeat', type=int, default=3, help='streams per chunk size')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size << 20)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'clamd.socket')
+        server = await spawn(path)
+        pvs = await PyvalveSocket(path)
+        await pvs.create_pool(max_size=1)
+
+        results = []
+        for size in FIXED_SIZES:
+            pvs.set_stream_buffer(size)
+            results.append({'mode': 'fixed', 'chunk_size': size,
+                'mb_per_s': await measure(pvs, payload, args.repeat)})
+        pvs.set_stream_buffer(None)
+        results.append({'mode': 'default', 'chunk_size': None,
+            'mb_per_s': await measure(pvs, payload, args.repeat)})
+        pvs.set_adaptive_stream_buffer()
+        results.append({'mode': 'adaptive', 'chunk_size': None,
+            'mb_per_s': await measure(pvs, payload, args.repeat)})
+
+        await pvs.pool.close()
+        server.terminate()
+        await server.wait()
+
+    for result in results:
+        size = result['chunk_size']
+        label = f"{size >> 10} KiB" if size else result['mode']
+        print(f"{label:>10}  {result['mb_per_s']:8.1f} MB/s")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump({'benchmark': 'chunk_size', 'payload_mib': args.size,
+                'results': results}, output, indent=2)
+
+if __name__ == '__main__':
+    asyncio.run(main())
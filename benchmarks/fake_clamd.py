@@ -0,0 +1,197 @@
+"""
+Fake clamd for benchmarks
+
+Speaks enough of the clamd protocol for the client: PING, VERSION, SCAN
+and its variants, and INSTREAM, one shot or inside an IDSESSION, over a
+unix socket and TCP. Streams are read and discarded, nothing is scanned.
+
+    python benchmarks/fake_clamd.py --socket /tmp/fake-clamd.socket
+"""
+import argparse
+import asyncio
+import os
+import socket
+import struct
+import sys
+from typing import List, Optional
+
+CHUNK_HEADER = struct.Struct('!L')
+
+class FakeClamd():
+    """ asyncio clamd server """
+    def __init__(self, latency: float = 0.0):
+        """
+        FakeClamd Constructor
+
+        :param latency float: Seconds added before each reply
+        """
+        self.latency = latency
+        self.connections = 0
+        self.requests = 0
+        self.streamed = 0
+        self.servers: List[asyncio.AbstractServer] = []
+
+    async def start_unix(self, path: str) -> None:
+        """
+        Listen on a unix socket
+
+        :param path str: Socket path
+        """
+        self.servers.append(await asyncio.start_unix_server(self.handle, path))
+
+    async def start_tcp(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        """
+        Listen on a TCP port
+
+        :param host str: Address to bind
+        :param port int: Port, 0 for any free port
+        :return: The port listened on
+        :rtype: int
+        """
+        server = await asyncio.start_server(self.handle, host, port)
+        self.servers.append(server)
+        return server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        """ Stop listening """
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+
+    async def instream(self, reader: asyncio.StreamReader) -> str:
+        """
+        Read an INSTREAM body
+
+        :param reader asyncio.StreamReader: The client stream
+        :return: The reply
+        :rtype: str
+        """
+        while True:
+            size, = CHUNK_HEADER.unpack(await reader.readexactly(4))
+            if not size:
+                return 'stream: OK'
+            while size:
+                # read in slices so large chunks are not buffered whole
+                data = await reader.read(min(size, 1 << 20))
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', size)
+                size -= len(data)
+                self.streamed += len(data)
+
+    async def reply(self, command: str, reader: asyncio.StreamReader) -> str:
+        """
+        Answer a command
+
+        :param command str: Command without its prefix and delimiter
+        :param reader asyncio.StreamReader: The client stream
+        :return: The reply
+        :rtype: str
+        """
+        name, _, argument = command.partition(' ')
+        if name == 'PING':
+            return 'PONG'
+        if name == 'VERSION':
+            return 'ClamAV 1.0.0/26789/Mon Jan 30 08:17:46 2023'
+        if name in ('SCAN', 'CONTSCAN', 'MULTISCAN', 'ALLMATCHSCAN'):
+            return f'{argument}: OK'
+        if name == 'INSTREAM':
+            return await self.instream(reader)
+        return f'{command}: Unknown command ERROR'
+
+    async def handle(self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter) -> None:
+        """ Serve a connection """
+        self.connections += 1
+        session = False
+        request_id = 0
+        try:
+            while True:
+                prefix = await reader.readexactly(1)
+                delimiter = b'\0' if prefix == b'z' else b'\n'
+                command = (await reader.readuntil(delimiter))[:-1].decode()
+                if command == 'IDSESSION':
+                    session = True
+                    continue
+                if command == 'END':
+                    break
+                self.requests += 1
+                reply = await self.reply(command, reader)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if session:
+                    request_id += 1
+                    reply = f'{request_id}: {reply}'
+                writer.write(reply.encode() + delimiter)
+                await writer.drain()
+                if not session:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+def free_port() -> int:
+    """
+    Find a free TCP port on the loopback interface
+
+    :rtype: int
+    """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+async def listening(port: int) -> bool:
+    """
+    Check if something accepts connections on a local TCP port
+
+    :param port int: The port
+    :rtype: bool
+    """
+    try:
+        _, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        return False
+    writer.close()
+    return True
+
+async def spawn(path: str,
+    latency: float = 0.0,
+    port: Optional[int] = None) -> asyncio.subprocess.Process:
+    """
+    Run a fake clamd in a child process, so it does not share the
+    benchmark's event loop
+
+    :param path str: Unix socket path
+    :param latency float: Seconds added before each reply
+    :param port int: Also listen on this TCP port
+    :return: The child process, terminate it when done
+    """
+    command = [sys.executable, os.path.abspath(__file__),
+        '--socket', path, '--latency', str(latency)]
+    if port is not None:
+        command += ['--port', str(port)]
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL)
+    while not os.path.exists(path) or (port is not None and not await listening(port)):
+        if process.returncode is not None:
+            raise RuntimeError('fake clamd exited')
+        await asyncio.sleep(0.01)
+    return process
+
+async def main() -> None:
+    """ Run a fake clamd until interrupted """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--socket', help='unix socket path')
+    parser.add_argument('--port', type=int, help='TCP port')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each reply')
+    args = parser.parse_args()
+    server = FakeClamd(args.latency)
+    if args.socket:
+        await server.start_unix(args.socket)
+    if args.port is not None or not args.socket:
+        print(f'Listening on port {await server.start_tcp(port=args.port or 3310)}')
+    await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    asyncio.run(main())
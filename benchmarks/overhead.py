@@ -0,0 +1,274 @@
+"""
+Client overhead against a local fake clamd
+
+Measures requests per second and latency of pooled, one shot and
+pipelined requests, INSTREAM throughput, connection setup cost and peak
+memory, over a unix socket and TCP, across concurrency levels. The fake
+clamd answers at once, so the figures are the cost of pyvalve and the
+transport.
+
+    python benchmarks/overhead.py --output overhead.json
+    python benchmarks/overhead.py --compare overhead.json
+
+--compare exits with status 1 when a figure regressed by more than the
+tolerance, so it can gate a CI job.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+from io import BytesIO
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+# pylint: disable=wrong-import-position
+from src.pyvalve import Histogram, Pyvalve, PyvalveNetwork, PyvalveSocket
+from fake_clamd import free_port, spawn
+
+SCENARIOS = ('ping', 'scan', 'session', 'oneshot', 'connect', 'instream')
+
+# Figures where a higher value is better, the others are costs
+THROUGHPUT = ('requests_per_s', 'mb_per_s')
+COSTS = ('p50', 'peak_kib')
+
+async def run(operation: Callable[[], Awaitable[Any]],
+    requests: int,
+    concurrency: int) -> Tuple[float, Histogram]:
+    """
+    Run an operation a number of times from concurrent workers
+
+    :param operation callable: Coroutine function making one request
+    :param requests int: Total requests
+    :param concurrency int: Workers
+    :return: Elapsed seconds and the latency of each request
+    :rtype: tuple
+    """
+    latency = Histogram()
+    clock = time.perf_counter
+    remaining = requests
+
+    async def worker() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = clock()
+            await operation()
+            latency.record(clock() - started)
+
+    started = clock()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return clock() - started, latency
+
+async def peak_memory(operation: Callable[[], Awaitable[Any]],
+    requests: int,
+    concurrency: int) -> int:
+    """
+    Measure the memory allocated at the peak of a run
+
+    Tracing slows allocations down, so this is a separate, shorter run.
+
+    :param operation callable: Coroutine function making one request
+    :param requests int: Total requests
+    :param concurrency int: Workers
+    :return: Peak bytes allocated over the memory in use before the run
+    :rtype: int
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        await run(operation, requests, concurrency)
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+async def connect(pvs: Pyvalve) -> None:
+    """ Open a connection and close it """
+    conn = await pvs.open_connection()
+    await conn.close()
+
+async def client(transport: str, path: str, port: int) -> Pyvalve:
+    """
+    Create a client of the fake clamd
+
+    :param transport str: unix or tcp
+    :param path str: Unix socket path
+    :param port int: TCP port
+    :rtype: Pyvalve
+    """
+    if transport == 'unix':
+        return await PyvalveSocket(path)  # type: ignore[misc]
+    return await PyvalveNetwork('127.0.0.1', port)  # type: ignore[misc]
+
+async def measure(pvs: Pyvalve,
+    scenario: str,
+    concurrency: int,
+    args: argparse.Namespace,
+    target: str) -> Dict[str, Any]:
+    """
+    Benchmark one scenario
+
+    :param pvs Pyvalve: Client with a pool of concurrency connections
+    :param scenario str: One of SCENARIOS
+    :param concurrency int: Requests in flight
+    :param args Namespace: Command line options
+    :param target str: Path of an existing file, for SCAN
+    :return: The figures
+    :rtype: dict
+    """
+    requests = args.requests
+    payload = b''
+    operation: Callable[[], Awaitable[Any]]
+    if scenario == 'ping':
+        operation = pvs.ping
+    elif scenario == 'scan':
+        operation = partial(pvs.scan, target)
+    elif scenario == 'oneshot':
+        # a connection of its own for each request, as without a pool
+        operation = partial(pvs.exchange, 'PING')
+    elif scenario == 'connect':
+        operation = partial(connect, pvs)
+    elif scenario == 'instream':
+        payload = os.urandom(args.size << 10)
+        requests = args.streams
+
+        async def operation() -> str:
+            return await pvs.instream(BytesIO(payload))
+
+    if scenario == 'session':
+        async with pvs.session(max_pending=concurrency) as session:
+            elapsed, latency = await run(session.ping, requests, concurrency)
+            peak = await peak_memory(session.ping, concurrency * 4, concurrency)
+    else:
+        await run(operation, min(requests, concurrency * 2), concurrency)
+        elapsed, latency = await run(operation, requests, concurrency)
+        peak = await peak_memory(operation, concurrency * 4, concurrency)
+
+    result = {
+        'scenario': scenario, 'concurrency': concurrency, 'requests': requests,
+        'seconds': elapsed, 'requests_per_s': requests / elapsed,
+        'p50': latency.quantile(0.5), 'p99': latency.quantile(0.99),
+        'peak_kib': peak / 1024,
+    }
+    if payload:
+        result['mb_per_s'] = requests * len(payload) / elapsed / 1e6
+    return result
+
+def compare(results: List[Dict[str, Any]],
+    baseline: List[Dict[str, Any]],
+    tolerance: float) -> List[str]:
+    """
+    Find the figures that regressed against a previous run
+
+    :param results list: Results of this run
+    :param baseline list: Results of the previous run
+    :param tolerance float: Change ignored, as a ratio
+    :return: A description of each regression
+    :rtype: list
+    """
+    def key(result: Dict[str, Any]) -> Tuple[str, str, int]:
+        return result['transport'], result['scenario'], result['concurrency']
+
+    previous = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        for figure in THROUGHPUT + COSTS:
+            if not old.get(figure) or result.get(figure) is None:
+                continue
+            change = result[figure] / old[figure] - 1
+            if change < -tolerance if figure in THROUGHPUT else change > tolerance:
+                regressions.append(
+                    f"{' '.join(map(str, key(result)))} {figure}: "
+                    f"{old[figure]:.4g} -> {result[figure]:.4g} ({change:+.0%})"
+                )
+    return regressions
+
+async def run_all(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """
+    Run every scenario against a fake clamd
+
+    :param args Namespace: Command line options
+    :return: The figures of each transport, scenario and concurrency
+    :rtype: list
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'clamd.socket')
+        target = os.path.join(directory, 'target')
+        with open(target, 'wb') as file:
+            file.write(b'x')
+        port = free_port()
+        server = await spawn(path, args.latency, port)
+        try:
+            for transport in args.transports.split(','):
+                for concurrency in map(int, args.concurrency.split(',')):
+                    pvs = await client(transport, path, port)
+                    pool = await pvs.create_pool(max_size=concurrency)
+                    for scenario in args.scenarios.split(','):
+                        result = await measure(pvs, scenario, concurrency, args, target)
+                        result['transport'] = transport
+                        results.append(result)
+                        rate = (f"{result['mb_per_s']:9.1f} MB/s" if 'mb_per_s' in result
+                            else f"{result['requests_per_s']:9.0f} req/s")
+                        print(f"{transport:>4} {scenario:>8} x{concurrency:<4} {rate}"
+                            f"  p50 {result['p50'] * 1e6:8.0f} us"
+                            f"  p99 {result['p99'] * 1e6:8.0f} us"
+                            f"  peak {result['peak_kib']:8.0f} KiB")
+                    await pool.close()
+        finally:
+            server.terminate()
+            await server.wait()
+    return results
+
+async def main() -> int:
+    """
+    Run the benchmark
+
+    :return: Exit status
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--streams', type=int, default=200, help='INSTREAM requests')
+    parser.add_argument('--size', type=int, default=1024, help='INSTREAM payload in KiB')
+    parser.add_argument('--concurrency', default='1,8,32,128',
+        help='comma separated concurrency levels')
+    parser.add_argument('--transports', default='unix,tcp', help='unix, tcp or both')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+        help=f"comma separated, among {', '.join(SCENARIOS)}")
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds the fake clamd adds to each reply')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='regression ignored by --compare, as a ratio')
+    args = parser.parse_args()
+    results = await run_all(args)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump({
+                'benchmark': 'overhead',
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'latency': args.latency,
+                'results': results,
+            }, output, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline:
+            regressions = compare(results, json.load(baseline)['results'], args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,161 @@
+"""
+Import time and per call cost of path checks
+
+Imports pyvalve in fresh interpreters with -X importtime and reports the
+cumulative time and the slowest modules, then times check_path,
+check_paths and SCAN against a local fake clamd with each path check
+mode of set_path_check.
+
+    python benchmarks/startup.py --output startup.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + '/../'
+sys.path.append(ROOT)
+# pylint: disable=wrong-import-position
+from src.pyvalve import PATH_CHECKS, Pyvalve, PyvalveSocket
+from fake_clamd import spawn
+
+def import_times(module: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Import a module in a fresh interpreter
+
+    :param module str: Module to import
+    :return: Self and cumulative microseconds of each module imported
+    :rtype: dict
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+def measure_import(module: str, repeat: int, top: int) -> Dict[str, Any]:
+    """
+    Time the import of a module
+
+    :param module str: Module to import
+    :param repeat int: Fresh interpreters to start
+    :param top int: Slowest modules to report
+    :return: Median cumulative time in seconds and the slowest modules
+    :rtype: dict
+    """
+    # compile the bytecode once, it is cached after
+    import_times(module)
+    runs = [import_times(module) for _ in range(repeat)]
+    total = statistics.median(run[module][1] for run in runs) / 1e6
+    slowest = sorted(runs[0].items(), key=lambda item: item[1][0], reverse=True)[:top]
+    return {
+        'module': module,
+        'import_s': total,
+        'slowest': [{'module': name, 'self_s': own / 1e6} for name, (own, _) in slowest],
+    }
+
+async def per_call(operation: Callable[[], Awaitable[Any]], calls: int) -> float:
+    """
+    Time an operation
+
+    :param operation callable: Coroutine function
+    :param calls int: Calls to make
+    :return: Mean seconds per call
+    :rtype: float
+    """
+    started = time.perf_counter()
+    for _ in range(calls):
+        await operation()
+    return (time.perf_counter() - started) / calls
+
+async def measure_calls(pvs: Pyvalve, target: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """
+    Time path checks and scans with each path check mode
+
+    :param pvs Pyvalve: Client of the fake clamd
+    :param target str: An existing file
+    :param args Namespace: Command line options
+    :return: The figures of each mode
+    :rtype: list
+    """
+    batch = [target] * args.batch
+    results = []
+    for mode in PATH_CHECKS:
+        pvs.set_path_check(mode)
+        result = {
+            'mode': str(mode),
+            'check_path_s': await per_call(lambda: pvs.check_path(target), args.calls),
+            'check_paths_s': await per_call(
+                lambda: pvs.check_paths(batch), max(1, args.calls // args.batch)
+            ) / args.batch,
+            'scan_s': await per_call(lambda: pvs.scan(target), args.scans),
+        }
+        results.append(result)
+        print(f"{result['mode']:>6}  check_path {result['check_path_s'] * 1e6:8.1f} us"
+            f"  check_paths {result['check_paths_s'] * 1e6:8.1f} us/path"
+            f"  scan {result['scan_s'] * 1e6:8.1f} us")
+    return results
+
+async def main() -> int:
+    """
+    Run the benchmark
+
+    :return: Exit status
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--module', default='src.pyvalve', help='module to import')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters to start')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules to report')
+    parser.add_argument('--calls', type=int, default=5000, help='path checks per mode')
+    parser.add_argument('--batch', type=int, default=100, help='paths per check_paths call')
+    parser.add_argument('--scans', type=int, default=1000, help='SCAN requests per mode')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    startup = measure_import(args.module, args.repeat, args.top)
+    print(f"import {startup['module']}: {startup['import_s'] * 1e3:.1f} ms")
+    for module in startup['slowest']:
+        print(f"  {module['self_s'] * 1e3:8.2f} ms  {module['module']}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'clamd.socket')
+        target = os.path.join(directory, 'target')
+        with open(target, 'wb') as file:
+            file.write(b'x')
+        server = await spawn(path)
+        try:
+            pvs = await PyvalveSocket(path)  # type: ignore[misc]
+            pool = await pvs.create_pool(max_size=1)
+            calls = await measure_calls(pvs, target, args)
+            await pool.close()
+        finally:
+            server.terminate()
+            await server.wait()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump({
+                'benchmark': 'startup',
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'import': startup,
+                'results': calls,
+            }, output, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -1,360 +1,194 @@
 #!/usr/bin/env python
 """ Pyvalve clamd client library """
 import asyncio
-import struct
-import codecs
-from io import BytesIO, BufferedReader
-from typing import List, BinaryIO
-from asyncinit import asyncinit
-from aiopath import AsyncPath
+import importlib
+from typing import Any, BinaryIO, Optional, Union
+from .batch import BatchClient, BatchResult, map_bounded
+from .cache import VerdictCache, MemoryVerdictCache, SqliteVerdictCache
+from .client import Client
+from .commands import CommandClient, PATH_CHECKS
+from .connection import Connection
+from .fork import ForkSafe
+from .hedging import Hedging, LatencyWindow, deadline, deadline_passed, first_of, time_limit
+from .limiter import ConcurrencyLimiter, ServerStats, parse_stats
+from .metrics import Histogram, Metrics, Trace, current_trace
+from .pool import ConnectionPool
+from .protocol import (
+    DEBUG, HEDGED_COMMANDS, LIMITED_COMMANDS, SCAN_COMMANDS, SESSION_COMMANDS,
+    PyvalveConnectionError, PyvalveError, PyvalveResponseError, PyvalveScanningError,
+    PyvalveStreamMaxLength, PyvalveTimeout, ScanResult, check_reply, index_results,
+    is_error_reply, parse_result, parse_results, print_, signature_version
+)
+from .routing import (
+    ROUTE_FILDES, ROUTE_INSTREAM, ROUTE_SCAN, ROUTE_SPILL, RoutedScan, RoutingClient
+)
+from .session import Session
+from .streaming import StreamingClient
+from .streams import (
+    CHUNK_HEADER, DEFAULT_CHUNK_SIZE, FILE_CHUNK_SIZE, MAX_CHUNK_SIZE, MIN_CHUNK_SIZE,
+    AsyncReadable, ChunkSizer, FilePayload, StreamSource, aiter_chunks, close_source,
+    closing_stream, default_chunk_size, is_async_source, is_regular_file, iter_chunks,
+    map_file, open_file, remaining_length
+)
 
 __version__ = "0.1.3"
-DEBUG = 0
 
-def print_(msg: str) -> None:
+class Pyvalve(BatchClient):  # pylint: disable=abstract-method
     """
-        Debug print
-        :param str msg: The message
-    """
-    if DEBUG == 1:
-        print(msg)
-
-class PyvalveError(Exception):
-    """ Pyvalve exception base class """
+    Pyvalve base class
 
-class PyvalveResponseError(PyvalveError):
-    """ Exception processing response """
+    The client is built in layers, each in its own module: connections
+    (client), commands, INSTREAM (streaming), path scans and routes
+    (routing) and batches (batch).
 
-class PyvalveScanningError(PyvalveError):
-    """ Exception scanning. Could be path not found. """
-
-class PyvalveStreamMaxLength(PyvalveResponseError):
-    """
-    Exception using INSTREAM with a buffer
-    length > StreamMaxLength in /etc/clamav/clamd.conf
+    Instances survive a fork: a child process opens connections of its
+    own on first use instead of sharing the parent's.
     """
 
-class PyvalveConnectionError(PyvalveError):
-    """ Exception communicating with clamd """
-
-# pylint: disable=too-few-public-methods
-class Connection():
-    """ Connection class """
-    def __init__(self,
-        reader: asyncio.StreamReader,
-        writer: asyncio.StreamWriter):
-        """ Constructor"""
-        self.reader = reader
-        self.writer = writer
-
-@asyncinit
-class Pyvalve():
-    """ Pyvalve base class """
-    async def __init__(self):
-        """ Constructor """
-        self.conn: Connection = None
-        self.stream_buffer = 1024
-        self.persistant_connection = False
-
-    def set_connection(self,  conn: Connection) -> None:
-        """
-        Set connection
-
-        :param conn Connection: A connection object
-        """
-        self.conn = conn
-
-    def set_stream_buffer(self,  length: int) -> None:
-        """
-        Set stream buffer
-
-        :param length int: Desired stream buffer in bytes
-        """
-        self.stream_buffer = length
-
-    def set_persistant_connection(self,  persist: bool) -> None:
-        """
-        Set persistent connection
-
-        :param persist bool: persistent connection True/False
-        """
-        self.persistant_connection = persist
-
-    async def ping(self) -> str:
-        """
-        Send ping command
-
-        :return: Response from clamav
-        :rtype: str
-        """
-        return await self.send_command('PING')
-
-    async def stats(self) -> str:
-        """
-        Send stats command
-
-        :return: Response from clamav
-        :rtype: str
-        """
-        return await self.send_command('STATS')
-
-    async def version(self) -> str:
-        """
-        Send version command
-
-        :return: Response from clamav
-        :rtype: str
-        """
-        return await self.send_command('VERSION')
-
-    async def reload(self) -> str:
-        """
-        Send reload command
-
-        :return: Response from clamav
-        :rtype: str
-        """
-        return await self.send_command('RELOAD')
-
-    async def shutdown(self) -> str:
-        """
-        Send shutdown command
-
-        :return: Response from clamav
-        :rtype: str
-        """
-        return await self.send_command('SHUTDOWN')
-
-    async def scan(self, path: str) -> str:
-        """
-        Send scan command
-
-        :param path str: Path to file/directory to be scanned
-        :return: Response from clamav
-        :rtype: str
-        :raises PyvalveScanningError: If path is not found
-        """
-        if not await self.check_path(path):
-            raise PyvalveScanningError(f'Path not found: {path}')
-        return await self.send_command('SCAN', path)
-
-    async def contscan(self, path: str) -> str:
-        """
-        Send constscan command
-
-        :param path str: Path to file/directory to be scanned
-        :return: Response from clamav
-        :rtype: str
-        :raises PyvalveScanningError: If path is not found
-        """
-        if not await self.check_path(path):
-            raise PyvalveScanningError(f'Path not found: {path}')
-        return await self.send_command('CONTSCAN', path)
-
-    async def multiscan(self, path: str) -> str:
-        """
-        Send multiscan command
-
-        :param path str: Path to file/directory to be scanned
-        :return: Response from clamav
-        :rtype: str
-        :raises PyvalveScanningError: If path is not found
-        """
-        if not await self.check_path(path):
-            raise PyvalveScanningError(f'Path not found: {path}')
-        return await self.send_command('MULTISCAN', path)
-
-    async def allmatchscan(self, path: str) -> str:
-        """
-        Send allmatchscan command
-
-        :param path str: Path to file/directory to be scanned
-        :return: Response from clamav
-        :rtype: str
-        :raises PyvalveScanningError: If path is not found
-        """
-        if not await self.check_path(path):
-            raise PyvalveScanningError(f'Path not found: {path}')
-        return await self.send_command('ALLMATCHSCAN', path)
-
-    async def send_command(self,
-        msg: str,
-        *args: str) -> str:
-        """
-        Send a command to clamav
-
-        :param str msg: The command
-        :param list args: Command arguments
-        :return: Response from clamav
-        :rtype: str
-        :raises PyvalveResponseError: If clamav responds with an error
-        """
-        await self.get_connection()
-
-        jargs = ''
-        if args:
-            jargs = ' ' + ' '.join(args)
-
-        message = f'n{msg}{jargs}\n'
-        print_(f'Send: {message}')
-
-        self.conn.writer.write(message.encode('utf-8'))
-
-        await self.conn.writer.drain()
-        data = await self.conn.reader.read()
-        data_dec: str = data.decode().strip()
-
-        if "ERROR" in data_dec:
-            raise PyvalveResponseError(data_dec)
-        print_(f'Received: {data_dec}')
-
-        await self.close()
-
-        return data_dec
-
-    async def instream(self, buffer: BinaryIO) -> str:
-        """
-        Send a stream to clamav
-
-        :param BinaryIO buffer: a buffer object
-        :return: Response from clamav
-        :rtype: str
-        :raises PyvalveConnectionError: If connection is broken
-        :raises PyvalveStreamMaxLength: If stream size limit exceeded
-        """
-        await self.get_connection()
-
-        self.conn.writer.write('nINSTREAM\n'.encode('utf-8'))
-
-        def read_chunks(file_object: BinaryIO, size: int):
-            """ Read chunks generator """
-            while True:
-                chunk = file_object.read(size)
-                if not chunk:
-                    break
-                yield chunk
-
-        try:
-            with buffer as buffer_pointer:
-                for chunk in read_chunks(buffer_pointer, self.stream_buffer):
-                    size = struct.pack(b'!L', len(chunk))
-                    self.conn.writer.write(size + chunk)
-
-            print_("Printed chunks. Closing out request.")
-            self.conn.writer.write(struct.pack(b'!L', 0))
-
-            print_("Done writing stream. Check results")
-
-            data = await self.conn.reader.read()
-
-            data_dec: str = data.decode().strip()
-            if "INSTREAM size limit exceeded" in data_dec:
-                raise PyvalveStreamMaxLength(data_dec)
-
-            await self.conn.writer.drain()
-
-            print_(f'Received: {data_dec}')
-            print_('Close the connection')
-            await self.close()
-
-        except BrokenPipeError as exp:
-            raise PyvalveConnectionError(exp) from exp
-
-        return data_dec
-
-    async def close(self) -> None:
-        """ Close the stream """
-        if self.persistant_connection:
-            print_('Persist the connection')
-            return None
-        print_('Close the connection')
-        self.conn.writer.close()
-        await self.conn.writer.wait_closed()
-
-    async def check_path(self, path: str) -> bool:
-        """
-        Check scanning path
-
-        :param path str: Path to file/directory to be scanned
-        """
-        print_(f'Checking path {path}')
-        chk_path = AsyncPath(path)
-
-        return await chk_path.exists()
-
-    async def get_connection(self):
-        """ Place holder get_connection method """
-        raise NotImplementedError("Must override get_connection")
-
-class PyvalveSocket(Pyvalve):
+class PyvalveSocket(Pyvalve):  # pylint: disable=too-many-ancestors
     """
     Asyncio Clamd socket client
     """
+    local = True
+
     async def __init__(self, # type: ignore[misc]
-        socket: str = "/tmp/clamd.socket"):
+        socket: str = "/tmp/clamd.socket",
+        timeout: Optional[float] = None):
         """
             PyvalveSocket Constructor
 
             :param socket str: Path to socket file
-            :param timeout int: socket timemout
+            :param timeout float: Seconds to connect, None to wait forever
         """
         await super().__init__()
         self.socket = socket
+        self.timeout = timeout
 
-    async def get_connection(self) -> None:
+    @property
+    def endpoint(self) -> str:
+        """ Name of the clamd in metrics """
+        return self.socket
+
+    async def open_connection(self) -> Connection:
         """
-            Get a socket connection
+            Open a socket connection
 
+            :return: A new connection
+            :rtype: Connection
             :raises PyvalveConnectionError: If Pyvalve cannot connect to clamav
         """
-        if self.conn and self.persistant_connection:
-            if self.conn.writer.is_closing():
-                raise PyvalveConnectionError("Persitant connection no longer available")
         try:
-            reader, writer = await asyncio.open_unix_connection(
-                path = self.socket
-            )
-            self.set_connection(Connection(reader, writer))
+            async with asyncio.timeout(self.timeout):
+                reader, writer = await asyncio.open_unix_connection(
+                    path = self.socket
+                )
+            return Connection(reader, writer)
+        except TimeoutError as exc:
+            raise PyvalveTimeout(f"Connecting to {self.socket} timed out") from exc
         except FileNotFoundError as exc:
             raise PyvalveConnectionError(f"socket file not found: {self.socket}") from exc
         except Exception as exc:
             raise PyvalveConnectionError(str(exc)) from exc
 
-class PyvalveNetwork(Pyvalve):
+    async def scan_fd(self, fileobj: Union[int, BinaryIO]) -> str:
+        """
+        Scan an open file with FILDES
+
+        The file descriptor is passed to clamd over the socket, clamd reads
+        the file directly. No data is copied and clamd does not need
+        permission to access the file's path.
+
+        :param fileobj: An open file object or file descriptor
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveConnectionError: If Pyvalve cannot connect to clamav
+        :raises PyvalveResponseError: If clamav responds with an error
+        """
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        async with time_limit(self.call_timeout), self.traced('FILDES'), self.limited():
+            if self.use_pool('FILDES'):
+                async with self.acquire() as conn:
+                    conn.send(b'zFILDES\0')
+                    await conn.writer.drain()
+                    await conn.send_fd(fd)
+                    data = await conn.read_reply()
+            else:
+                conn = await self.open_connection()
+                try:
+                    conn.send(b'nFILDES\n')
+                    await conn.writer.drain()
+                    await conn.send_fd(fd)
+                    data = await conn.read_reply()
+                finally:
+                    await conn.close()
+
+        return check_reply(data)
+
+class PyvalveNetwork(Pyvalve):  # pylint: disable=too-many-ancestors
     """
     Asyncio Clamd network client
     """
     async def __init__(self, # type: ignore[misc]
         host: str = "localhost",
         port: int = 3310,
-        timeout: int = 60):
+        timeout: Optional[float] = 60):
         """
         PyvalveNetwork Constructor
 
         :param host str: host address for clamav
         :param port int: listening port for clamav
-        :param timeout int: socket timemout
+        :param timeout float: Seconds to connect, None to wait forever
         """
         await super().__init__()
         self.host = host
         self.port = port
         self.timeout = timeout
 
-    async def get_connection(self) -> None:
+    @property
+    def endpoint(self) -> str:
+        """ Name of the clamd in metrics """
+        return f'{self.host}:{self.port}'
+
+    async def open_connection(self) -> Connection:
         """
-        Get a network connection
+        Open a network connection
 
+        :return: A new connection
+        :rtype: Connection
         :raises PyvalveConnectionError: If Pyvalve cannot connect to clamav
         """
-        if self.conn and self.persistant_connection:
-            if self.conn.writer.is_closing():
-                raise PyvalveConnectionError("Persitant connection no longer available")
         try:
-            reader, writer = await asyncio.open_connection(
-                host = self.host,
-                port = self.port,
-                ssl_handshake_timeout = self.timeout
-            )
-            self.set_connection(Connection(reader, writer))
+            async with asyncio.timeout(self.timeout):
+                reader, writer = await asyncio.open_connection(
+                    host = self.host,
+                    port = self.port
+                )
+            return Connection(reader, writer)
+        except TimeoutError as exc:
+            raise PyvalveTimeout(f"Connecting to {self.host}:{self.port} timed out") from exc
         except Exception as exc:
             raise PyvalveConnectionError(str(exc)) from exc
+
+_LAZY = {
+    'PyvalveCluster': 'cluster',
+    'LoopThread': 'sync',
+    'PyvalveSync': 'sync',
+    'ScanManifest': 'manifest',
+    'scan_incremental': 'manifest',
+    'TreeFilter': 'walk',
+    'walk_tree': 'walk',
+    'TeeStream': 'tee',
+    'StagedFile': 'tee',
+    'ArchiveLimits': 'archive',
+    'ArchiveMember': 'archive',
+    'ArchiveResult': 'archive',
+}
+
+def __getattr__(name: str) -> Any:
+    """ Import add-on modules on first use, they import this module """
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,412 @@
+""" Client side archive expansion, to scan the members of an archive in parallel """
+import asyncio
+import io
+import os
+import tarfile
+import tempfile
+import threading
+import zipfile
+from typing import (
+    Any, AsyncIterator, Awaitable, BinaryIO, Callable, Iterator, List, Optional, Tuple, Union, cast
+)
+from . import (
+    FILE_CHUNK_SIZE, BatchResult, PyvalveScanningError, ScanResult, StreamSource, is_async_source,
+    open_file, parse_result, print_
+)
+
+# Members of zip based documents and packages. clamd has signatures for
+# the whole container, e.g. macros in an OOXML document, so they are
+# scanned whole instead of expanded.
+CONTAINER_MEMBERS = frozenset((
+    '[Content_Types].xml', 'mimetype', 'META-INF/MANIFEST.MF', 'AndroidManifest.xml'
+))
+
+# pylint: disable=too-few-public-methods
+class ArchiveLimits():
+    """
+    Bounds of an archive expansion, against archive bombs
+
+    The defaults are the ones of clamd for MaxFiles, MaxScanSize and
+    MaxFileSize.
+    """
+    __slots__ = ('max_depth', 'max_members', 'max_size', 'max_member_size', 'spool_size')
+
+    def __init__(self,
+        max_depth: int = 3,
+        max_members: int = 10000,
+        max_size: int = 400 << 20,
+        max_member_size: int = 100 << 20,
+        spool_size: int = 1 << 20):
+        """
+        ArchiveLimits Constructor
+
+        :param max_depth int: Levels of nested archives expanded, deeper
+            archives are scanned whole by clamd
+        :param max_members int: Members expanded, across nested archives
+        :param max_size int: Bytes expanded, across nested archives
+        :param max_member_size int: Bytes expanded for a single member
+        :param spool_size int: Members larger than this are spooled to a
+            temporary file instead of memory
+        """
+        self.max_depth = max_depth
+        self.max_members = max_members
+        self.max_size = max_size
+        self.max_member_size = max_member_size
+        self.spool_size = spool_size
+
+class ArchiveMember():
+    """ An expanded member, waiting to be scanned """
+    __slots__ = ('path', 'size', 'file')
+
+    def __init__(self, path: str, size: int, file: BinaryIO):
+        """
+        ArchiveMember Constructor
+
+        :param path str: Archive path followed by the member name, e.g.
+            'upload.zip/docs/report.pdf'
+        :param size int: Expanded size in bytes
+        :param file BinaryIO: The content, spooled to memory or disk
+        """
+        self.path = path
+        self.size = size
+        self.file = file
+
+class ArchiveResult():
+    """ Combined verdict of the members of an archive """
+    __slots__ = ('path', 'hits', 'errors', 'members', 'expanded', 'fallback')
+
+    def __init__(self, path: str):
+        """
+        ArchiveResult Constructor
+
+        :param path str: The archive path, 'stream' for a buffer
+        """
+        self.path = path
+        self.hits: List[ScanResult] = []
+        self.errors: List[ScanResult] = []
+        self.members = 0
+        self.expanded = 0
+        self.fallback: Optional[str] = None
+
+    @property
+    def status(self) -> str:
+        """ FOUND if a member matched, ERROR if one could not be scanned, or OK """
+        if self.hits:
+            return ScanResult.FOUND
+        if self.errors:
+            return ScanResult.ERROR
+        return ScanResult.OK
+
+    @property
+    def infected(self) -> bool:
+        """ True if a signature matched in a member """
+        return bool(self.hits)
+
+    def add(self, path: str, response: str) -> ScanResult:
+        """
+        Record the response of a scanned member, or of the whole archive
+
+        :param path str: Path of the member
+        :param response str: Response from clamav
+        :return: The result, with the member path
+        :rtype: ScanResult
+        """
+        result = parse_result(response.strip().encode('utf-8', 'surrogateescape'))
+        result.path = path
+        if result.infected:
+            self.hits.append(result)
+        elif result.status == ScanResult.ERROR:
+            self.errors.append(result)
+        return result
+
+    def __repr__(self) -> str:
+        detail = ', '.join(f'{hit.path}: {", ".join(hit.signatures)}' for hit in self.hits)
+        return f'ArchiveResult({self.path!r}, {self.status}{": " if detail else ""}{detail})'
+
+class ArchiveLimitExceeded(PyvalveScanningError):
+    """ Exception expanding an archive past its limits """
+
+def archive_kind(file: BinaryIO) -> Optional[str]:
+    """
+    Recognize an archive expanded client side, blocking
+
+    :param BinaryIO file: A seekable file
+    :return: 'zip', 'tar', including compressed tars, or None. The file
+        position is left unchanged
+    :rtype: str
+    """
+    start = file.tell()
+    try:
+        if file.read(4) in (b'PK\x03\x04', b'PK\x05\x06'):
+            file.seek(start)
+            try:
+                with zipfile.ZipFile(file) as archive:
+                    names = set(archive.namelist())
+            except (zipfile.BadZipFile, OSError, ValueError):
+                return None
+            return None if names & CONTAINER_MEMBERS else 'zip'
+        file.seek(start)
+        try:
+            with tarfile.open(fileobj=file, mode='r:*'):
+                return 'tar'
+        except (tarfile.TarError, OSError, EOFError):
+            return None
+    finally:
+        file.seek(start)
+
+class Expansion():
+    """ Blocking expansion of an archive and of the archives it contains """
+    def __init__(self, limits: ArchiveLimits):
+        """
+        Expansion Constructor
+
+        :param limits ArchiveLimits: Bounds of the expansion
+        """
+        self.limits = limits
+        self.stop = threading.Event()
+        self.members = 0
+        self.expanded = 0
+        self.error: Optional[str] = None
+
+    def count(self, path: str, size: int) -> None:
+        """
+        Count a member against the limits, by its declared size
+
+        :param path str: Path of the member
+        :param size int: Size declared by the archive
+        :raises ArchiveLimitExceeded: If a limit is reached
+        """
+        limits = self.limits
+        self.members += 1
+        if self.members > limits.max_members:
+            raise ArchiveLimitExceeded(f'More than {limits.max_members} members')
+        if size > limits.max_member_size:
+            raise ArchiveLimitExceeded(f'{path} exceeds {limits.max_member_size} bytes')
+
+    def spool(self, stream: BinaryIO, path: str) -> Tuple[BinaryIO, int]:
+        """
+        Expand a member, counting the bytes actually read
+
+        Declared sizes can not be trusted, a crafted archive may
+        expand far beyond them. Members up to limits.spool_size are kept
+        in memory, larger ones in an unlinked temporary file, which is
+        then sent with sendfile.
+
+        :param stream BinaryIO: The member, as read from its archive
+        :param path str: Path of the member
+        :return: The spooled content at position 0, and its size
+        :rtype: tuple
+        :raises ArchiveLimitExceeded: If a limit is reached
+        """
+        limits = self.limits
+        # tempfile.SpooledTemporaryFile moves to disk as soon as its
+        # fileno is asked for, which the stream fast paths do
+        spooled: BinaryIO = io.BytesIO()
+        size = 0
+        try:
+            while True:
+                chunk = stream.read(FILE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                self.expanded += len(chunk)
+                if size > limits.max_member_size:
+                    raise ArchiveLimitExceeded(
+                        f'{path} exceeds {limits.max_member_size} bytes'
+                    )
+                if self.expanded > limits.max_size:
+                    raise ArchiveLimitExceeded(f'More than {limits.max_size} bytes expanded')
+                if size > limits.spool_size and isinstance(spooled, io.BytesIO):
+                    # pylint: disable=consider-using-with
+                    file = cast(BinaryIO, tempfile.TemporaryFile())
+                    with spooled.getbuffer() as spilled:
+                        file.write(spilled)
+                    spooled.close()
+                    spooled = file
+                spooled.write(chunk)
+        except BaseException:
+            spooled.close()
+            raise
+        spooled.seek(0)
+        return spooled, size
+
+    def entries(self, file: BinaryIO, path: str, kind: str) -> Iterator[Tuple[str, BinaryIO]]:
+        """
+        List the regular files of an archive, in archive order
+
+        :param BinaryIO file: The archive
+        :param path str: Path of the archive
+        :param kind str: zip or tar
+        :return: Iterator of member names and content streams
+        """
+        if kind == 'zip':
+            with zipfile.ZipFile(file) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    self.count(f'{path}/{info.filename}', info.file_size)
+                    with archive.open(info) as stream:
+                        yield info.filename, cast(BinaryIO, stream)
+            return
+        with tarfile.open(fileobj=file, mode='r:*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                self.count(f'{path}/{member.name}', member.size)
+                yield member.name, cast(BinaryIO, tar.extractfile(member))
+
+    def expand(self,
+        file: BinaryIO,
+        path: str,
+        kind: str,
+        depth: int = 1) -> Iterator[ArchiveMember]:
+        """
+        Expand an archive, and the archives it contains up to max_depth
+
+        :param BinaryIO file: The archive
+        :param path str: Path of the archive
+        :param kind str: zip or tar
+        :param depth int: Nesting level of the archive
+        :return: Iterator of members, their file is closed by the consumer
+        :raises ArchiveLimitExceeded: If a limit is reached
+        """
+        for name, stream in self.entries(file, path, kind):
+            if self.stop.is_set():
+                return
+            member_path = f'{path}/{name}'
+            spooled, size = self.spool(stream, member_path)
+            nested = archive_kind(spooled) if depth < self.limits.max_depth else None
+            if nested is None:
+                yield ArchiveMember(member_path, size, spooled)
+                continue
+            with spooled:
+                yield from self.expand(spooled, member_path, nested, depth + 1)
+
+async def expand_members(
+    expansion: Expansion,
+    file: BinaryIO,
+    path: str,
+    kind: str,
+    buffered: int = 16) -> AsyncIterator[ArchiveMember]:
+    """
+    Expand an archive in a worker thread, as members are consumed
+
+    At most `buffered` members wait to be consumed. An archive that can
+    not be expanded ends the iteration, and the reason is left in
+    expansion.error.
+
+    :param expansion Expansion: State and limits of the expansion
+    :param BinaryIO file: The archive
+    :param path str: Path of the archive
+    :param kind str: zip or tar
+    :param buffered int: Members expanded ahead of the consumer
+    :return: Async iterator of members
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(buffered)
+
+    def put(member: Optional[ArchiveMember]) -> None:
+        asyncio.run_coroutine_threadsafe(queue.put(member), loop).result()
+
+    def produce() -> None:
+        try:
+            for member in expansion.expand(file, path, kind):
+                put(member)
+        except Exception as exc: # pylint: disable=broad-except
+            # decompressors raise their own errors on corrupt input
+            expansion.error = str(exc) or type(exc).__name__
+        finally:
+            put(None)
+
+    worker = asyncio.ensure_future(asyncio.to_thread(produce))
+    finished = False
+    try:
+        while True:
+            member = await queue.get()
+            if member is None:
+                finished = True
+                break
+            yield member
+    finally:
+        expansion.stop.set()
+        # unblock the worker, members it still expands are dropped
+        while not finished:
+            member = await queue.get()
+            if member is None:
+                break
+            member.file.close()
+        await worker
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+async def expand_and_scan(
+    source: Union[str, os.PathLike, StreamSource],
+    scan_many: Callable[[AsyncIterator[ArchiveMember]], AsyncIterator[BatchResult]],
+    scan_whole: Callable[[Any], Awaitable[str]],
+    limits: Optional[ArchiveLimits] = None,
+    stop_on_hit: bool = False,
+    buffered: int = 16) -> ArchiveResult:
+    """
+    Expand an archive and scan its members, combining their verdicts
+
+    Sources that are not a zip or tar archive, or can not be read
+    twice, are scanned whole. So is an archive that can not be expanded
+    within the limits, is corrupt or encrypted, unless a member already
+    matched: clamd then applies its own limits and heuristics.
+
+    :param source: A path, or a stream source as taken by instream
+    :param scan_many callable: Function scanning an async iterator of
+        members, returning an async iterator of BatchResult
+    :param scan_whole callable: Coroutine function streaming a buffer
+    :param limits ArchiveLimits: Bounds of the expansion, clamd's by default
+    :param stop_on_hit bool: Stop at the first member matching a signature
+    :param buffered int: Members expanded ahead of the scans
+    :return: The combined verdict
+    :rtype: ArchiveResult
+    :raises PyvalveScanningError: If the path can not be opened
+    """
+    limits = limits or ArchiveLimits()
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        file: Any = open_file(path)
+    else:
+        path, file = 'stream', source
+    result = ArchiveResult(path)
+
+    kind, start = None, 0
+    if not is_async_source(file) and getattr(file, 'seekable', bool)():
+        start = file.tell()
+        kind = await asyncio.to_thread(archive_kind, file)
+    if kind is None:
+        result.add(path, await scan_whole(file))
+        return result
+
+    expansion = Expansion(limits)
+    try:
+        outcomes = scan_many(expand_members(expansion, file, path, kind, buffered))
+        try:
+            async for outcome in outcomes:
+                member = outcome.item
+                member.file.close()
+                result.members += 1
+                if outcome.error is not None:
+                    result.errors.append(ScanResult(member.path, ScanResult.ERROR,
+                        reason=str(outcome.error)))
+                elif result.add(member.path, cast(str, outcome.result)).infected and stop_on_hit:
+                    break
+        finally:
+            if hasattr(outcomes, 'aclose'):
+                await outcomes.aclose()
+    except BaseException:
+        file.close()
+        raise
+    result.expanded = expansion.expanded
+    if expansion.error is None or result.hits:
+        file.close()
+        return result
+
+    print_(f'Scanning {path} whole: {expansion.error}')
+    result.fallback = expansion.error
+    result.errors.clear()
+    file.seek(start)
+    result.add(path, await scan_whole(file))
+    return result
@@ -0,0 +1,376 @@
+""" Scans of many sources at once, with a bound on the requests in flight """
+import asyncio
+import importlib
+import itertools
+import os
+from typing import (
+    AsyncGenerator, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Any, Iterable,
+    Optional, Tuple, Union, TYPE_CHECKING, cast
+)
+from .protocol import PyvalveResponseError, PyvalveScanningError, check_reply, signature_version
+from .streams import StreamSource, open_file
+from .hedging import time_limit
+from .connection import Connection
+from .pool import ConnectionPool
+from .routing import RoutingClient
+
+if TYPE_CHECKING:
+    from .archive import ArchiveLimits, ArchiveResult
+    from .manifest import ScanManifest
+
+class BatchResult():
+    """ Outcome of one item of a batch """
+    __slots__ = ('index', 'item', 'result', 'error')
+
+    def __init__(self,
+        index: int,
+        item: Any,
+        result: Optional[str] = None,
+        error: Optional[Exception] = None):
+        """
+        BatchResult Constructor
+
+        :param index int: Position of the item in the batch
+        :param item: The path or buffer that was scanned
+        :param result str: Response from clamav
+        :param error Exception: The error raised scanning the item
+        """
+        self.index = index
+        self.item = item
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        """ True if the item was scanned without error """
+        return self.error is None
+
+    def __repr__(self) -> str:
+        outcome = self.result if self.error is None else repr(self.error)
+        return f'BatchResult({self.index}, {self.item!r}, {outcome})'
+
+def _taker(
+    items: Union[Iterable[Any], AsyncIterator[Any]]) -> Callable[[], Awaitable[Tuple[int, Any]]]:
+    """
+    Take the items of a batch one at a time, with their index
+
+    :param items: Items, an iterable or async iterator shared by the workers
+    :return: Coroutine function raising StopAsyncIteration after the last item
+    """
+    if isinstance(items, AsyncIterator):
+        source = items
+        taking = asyncio.Lock()
+        counter = itertools.count()
+
+        async def take_async() -> Tuple[int, Any]:
+            # an async generator can not be resumed by two workers at once
+            async with taking:
+                item = await anext(source)
+            return next(counter), item
+        return take_async
+    pending = enumerate(items)
+
+    async def take() -> Tuple[int, Any]:
+        entry = next(pending, None)
+        if entry is None:
+            # StopIteration can not be raised through a coroutine
+            raise StopAsyncIteration
+        return entry
+    return take
+
+async def map_bounded(
+    func: Callable[[Any], Awaitable[str]],
+    items: Union[Iterable[Any], AsyncIterable[Any]],
+    concurrency: int = 16,
+    ordered: bool = False) -> AsyncGenerator[BatchResult, None]:
+    """
+    Run a coroutine function for many items with bounded concurrency
+
+    A fixed number of workers consume the items lazily. At most
+    2 * concurrency results are held back waiting for the consumer.
+    Exceptions are captured in the item's BatchResult.
+
+    :param func callable: Coroutine function taking an item
+    :param items: Items, an iterable or async iterable consumed lazily.
+        An async generator is closed when the batch ends
+    :param concurrency int: Maximum calls in flight
+    :param ordered bool: Yield results in input order instead of as they complete
+    :return: Async iterator of BatchResult
+    """
+    if concurrency < 1:
+        raise ValueError(f'Invalid concurrency: {concurrency}')
+    window = asyncio.Semaphore(2 * concurrency)
+    done: asyncio.Queue = asyncio.Queue()
+    source = aiter(items) if isinstance(items, AsyncIterable) else None
+    take = _taker(source if source is not None else cast(Iterable[Any], items))
+
+    async def worker() -> None:
+        while True:
+            await window.acquire()
+            try:
+                index, item = await take()
+            except StopAsyncIteration:
+                window.release()
+                return
+            outcome = BatchResult(index, item)
+            try:
+                outcome.result = await func(item)
+            except Exception as exc: # pylint: disable=broad-except
+                outcome.error = exc
+            done.put_nowait(outcome)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    finished = asyncio.ensure_future(asyncio.gather(*workers))
+    finished.add_done_callback(lambda _: done.put_nowait(None))
+    held: Dict[int, BatchResult] = {}
+    next_index = 0
+    try:
+        while True:
+            outcome = await done.get()
+            if outcome is None:
+                break
+            if not ordered:
+                window.release()
+                yield outcome
+                continue
+            held[outcome.index] = outcome
+            while next_index in held:
+                window.release()
+                yield held.pop(next_index)
+                next_index += 1
+        await finished
+    finally:
+        finished.cancel()
+        await asyncio.gather(finished, return_exceptions=True)
+        if source is not None and hasattr(source, 'aclose'):
+            await source.aclose()
+
+class BatchClient(RoutingClient):  # pylint: disable=abstract-method
+    """ Batch scans of a Pyvalve client """
+    def scan_many(self,
+        paths: Iterable[str],
+        concurrency: int = 16,
+        ordered: bool = False) -> AsyncIterator[BatchResult]:
+        """
+        Scan many paths with bounded concurrency::
+
+            async for item in pv.scan_many(paths, concurrency=32):
+                if item.ok:
+                    print(item.item, item.result)
+
+        Errors are captured per path and do not stop the batch.
+
+        :param paths iterable: Paths to scan, consumed lazily
+        :param concurrency int: Maximum requests in flight
+        :param ordered bool: Yield results in input order instead of as they complete
+        :return: Async iterator of BatchResult
+        """
+        async def scan(conn: Connection, path: str) -> str:
+            if not await self.check_path(path):
+                raise PyvalveScanningError(f'Path not found: {path}')
+            return check_reply(await conn.request(f'zSCAN {path}\0'.encode('utf-8')))
+        return self.run_many(scan, paths, concurrency, ordered)
+
+    def instream_many(self,
+        buffers: Iterable[StreamSource],
+        concurrency: int = 16,
+        ordered: bool = False) -> AsyncIterator[BatchResult]:
+        """
+        Stream many buffers with bounded concurrency
+
+        Errors are captured per buffer and do not stop the batch.
+
+        :param buffers iterable: Stream sources as taken by instream, consumed lazily
+        :param concurrency int: Maximum requests in flight
+        :param ordered bool: Yield results in input order instead of as they complete
+        :return: Async iterator of BatchResult
+        """
+        async def instream(conn: Connection, buffer: StreamSource) -> str:
+            await self.refresh_cache_version()
+            return await self.send_stream(conn, b'zINSTREAM\0', buffer)
+        return self.run_many(instream, buffers, concurrency, ordered)
+
+    # pylint: disable=too-many-arguments
+    def scan_tree(self,
+        root: str,
+        include: Optional[Iterable[str]] = None,
+        exclude: Iterable[str] = (),
+        max_size: Optional[int] = None,
+        concurrency: int = 16,
+        *,
+        command: str = 'INSTREAM',
+        workers: int = 4,
+        follow_symlinks: bool = False,
+        onerror: Optional[Callable[[OSError], Any]] = None,
+        manifest: Optional['ScanManifest'] = None) -> AsyncIterator[BatchResult]:
+        """
+        Walk a local directory tree and scan its files in parallel::
+
+            async for item in pv.scan_tree('/srv/uploads', exclude=['.git', '*.iso']):
+                if item.ok and item.result.endswith('FOUND'):
+                    print(item.item, item.result)
+
+        Directories are listed in a thread pool and filtered here, so
+        clamd only sees the files kept. Results are yielded as they
+        complete, errors are captured per file.
+
+        With a manifest, only files that are new, changed, or were
+        scanned with other signatures are sent to clamd, and only their
+        results are yielded.
+
+        :param root str: The directory to walk
+        :param include iterable: Glob patterns of the files to scan, None for all
+        :param exclude iterable: Glob patterns of the files and directories to skip
+        :param max_size int: Size in bytes above which files are skipped
+        :param concurrency int: Maximum requests in flight
+        :param command str: INSTREAM to send the content, which works with a
+            remote clamd, or SCAN to send the path, translated by set_routing
+        :param workers int: Directories listed in parallel
+        :param follow_symlinks bool: Follow links to files and directories
+        :param onerror callable: Called with the OSError of an unreadable
+            directory, from a walker thread. Errors are ignored by
+            default, as in os.walk
+        :param manifest ScanManifest: Record of the previous scans, for an incremental scan
+        :return: Async iterator of BatchResult, the items are file paths
+        :raises ValueError: If the command is not INSTREAM or SCAN
+        """
+        operation = self._tree_operation(command, manifest)
+        walk = importlib.import_module('.walk', __package__)
+        paths = walk.walk_tree(root, walk.TreeFilter(include, exclude, max_size, follow_symlinks),
+            workers, onerror)
+        if manifest is None:
+            return self.run_many(operation, paths, concurrency)
+
+        async def version() -> Optional[str]:
+            return signature_version(await self.version())
+        return importlib.import_module('.manifest', __package__).scan_incremental(
+            manifest, root, version, paths,
+            lambda changed: self.run_many(operation, changed, concurrency))
+
+    def _tree_operation(self,
+        command: str,
+        manifest: Optional['ScanManifest']) -> Callable[[Connection, str], Awaitable[str]]:
+        """
+        Get the operation scan_tree runs for each file
+
+        :param command str: INSTREAM or SCAN
+        :param manifest ScanManifest: Record hashing the streamed files, if any
+        :return: Coroutine function taking a connection and a path
+        :raises ValueError: If the command is not INSTREAM or SCAN
+        """
+        if command not in ('INSTREAM', 'SCAN'):
+            raise ValueError(f'Unsupported command: {command}')
+
+        async def instream(conn: Connection, path: str) -> str:
+            await self.refresh_cache_version()
+            file = open_file(path)
+            hasher = manifest.stream_hasher(path) if manifest is not None else None
+            with file:
+                reply = await self.send_stream(conn, b'zINSTREAM\0', file, hasher)
+            if hasher is not None:
+                # the content was hashed as it was sent, not read again
+                cast('ScanManifest', manifest).streamed(path, hasher.digest(), conn.streamed)
+            return reply
+
+        async def scan(conn: Connection, path: str) -> str:
+            target = self.shared_path(path) if self.shared_paths else path
+            if target is None:
+                raise PyvalveScanningError(f'{path} is not shared with clamd')
+            return check_reply(await conn.request(f'zSCAN {target}\0'.encode('utf-8')))
+
+        return instream if command == 'INSTREAM' else scan
+
+    async def run_many(self,
+        operation: Callable[[Connection, Any], Awaitable[str]],
+        items: Union[Iterable[Any], AsyncIterable[Any]],
+        concurrency: int = 16,
+        ordered: bool = False) -> AsyncIterator[BatchResult]:
+        """
+        Run an operation on pooled session connections for many items
+
+        Uses the client's pool, or a pool of `concurrency` connections
+        for the duration of the batch. At most 2 * concurrency results
+        are held back waiting for the consumer.
+
+        :param operation callable: Coroutine function taking a connection and an item
+        :param items: Items, an iterable or async iterable consumed lazily
+        :param concurrency int: Maximum requests in flight
+        :param ordered bool: Yield results in input order
+        :return: Async iterator of BatchResult
+        """
+        if concurrency < 1:
+            raise ValueError(f'Invalid concurrency: {concurrency}')
+        pool = self.pool
+        own_pool = pool is None
+        if pool is None:
+            pool = ConnectionPool(self.open_session, max_size=concurrency)
+
+        # scan_many and instream_many name their operations after the command
+        command = getattr(operation, '__name__', 'operation').upper()
+
+        async def run(item: Any) -> str:
+            async with self.traced(command):
+                conn = await pool.acquire()
+                # errors reported by clamd leave the connection usable
+                discard = True
+                try:
+                    async with time_limit(self.call_timeout), self.limited():
+                        result = await operation(conn, item)
+                    discard = False
+                    return result
+                except (PyvalveResponseError, PyvalveScanningError):
+                    discard = False
+                    raise
+                finally:
+                    await pool.release(conn, discard)
+
+        outcomes = map_bounded(run, items, concurrency, ordered)
+        try:
+            async for outcome in outcomes:
+                yield outcome
+        finally:
+            await outcomes.aclose()
+            if own_pool:
+                await pool.close()
+
+    async def scan_archive(self,
+        source: Union[str, os.PathLike, StreamSource],
+        limits: Optional['ArchiveLimits'] = None,
+        concurrency: int = 16,
+        stop_on_hit: bool = False) -> 'ArchiveResult':
+        """
+        Expand a zip or tar archive here and scan its members in parallel::
+
+            result = await pv.scan_archive('/srv/uploads/backup.tar.gz')
+            for hit in result.hits:
+                print(hit.path, hit.signatures)
+
+        Members are expanded in a worker thread as they are scanned, on
+        pooled connections, and nested archives are expanded up to
+        limits.max_depth. Each hit names the member, e.g.
+        'backup.tar.gz/docs/invoice.zip/invoice.exe'.
+
+        Other files, zip based documents and archives that can not be
+        expanded within the limits are streamed whole, and clamd applies
+        its own limits.
+
+        :param source: A path, or a stream source as taken by instream.
+            Only paths and seekable buffers are expanded
+        :param limits ArchiveLimits: Bounds of the expansion, clamd's
+            defaults when not given
+        :param concurrency int: Maximum requests in flight
+        :param stop_on_hit bool: Stop at the first member matching a signature
+        :return: The combined verdict
+        :rtype: ArchiveResult
+        :raises PyvalveScanningError: If the path can not be opened
+        :raises PyvalveConnectionError: If connection is broken
+        """
+        # imported on first use, as it imports this module
+        archive = importlib.import_module('.archive', __package__)
+
+        async def instream(conn: Connection, member: Any) -> str:
+            await self.refresh_cache_version()
+            return await self.send_stream(conn, b'zINSTREAM\0', member.file)
+        return await archive.expand_and_scan(source,
+            lambda members: self.run_many(instream, members, concurrency),
+            self.instream, limits, stop_on_hit, concurrency)
@@ -0,0 +1,269 @@
+""" Verdict caches keyed by content digest """
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Tuple, TYPE_CHECKING
+from .fork import ForkSafe
+
+if TYPE_CHECKING:
+    import sqlite3
+
+class SqliteDatabase(ForkSafe):
+    """
+    SQLite connection used from worker threads
+
+    A forked child opens the database again, SQLite connections must not
+    cross a fork.
+    """
+    def __init__(self, path: str):
+        """
+        SqliteDatabase Constructor
+
+        :param path str: Database file
+        """
+        super().__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = self.connect()
+        self.inherited: Optional['sqlite3.Connection'] = None
+
+    def connect(self) -> 'sqlite3.Connection':
+        """
+        Open the database, sqlite3 is imported on first use
+
+        :rtype: sqlite3.Connection
+        """
+        # pylint: disable=import-outside-toplevel
+        import sqlite3
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def after_fork(self) -> None:
+        """ Open the database again, the parent's connection stays with the parent """
+        # kept open, closing it from here could checkpoint the parent's WAL
+        self.inherited = self.db
+        self.lock = threading.Lock()
+        self.db = self.connect()
+
+    async def execute(self, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run a function in a worker thread, holding the connection
+
+        :param function callable: Function taking the connection and args
+        :param args: Function arguments
+        :return: What the function returns
+        """
+        self.check_fork()
+
+        def locked() -> Any:
+            with self.lock:
+                return function(self.db, *args)
+        return await asyncio.to_thread(locked)
+
+    def close(self) -> None:
+        """ Close the database """
+        with self.lock:
+            self.db.close()
+
+class VerdictCache():
+    """
+    Verdict cache base class
+
+    Verdicts are only valid for the signature database version they were
+    produced with. The client reports the version with set_version, and
+    a change clears the cache.
+    """
+    def __init__(self,
+        max_entries: int = 100000,
+        ttl: Optional[float] = None,
+        check_interval: float = 60.0):
+        """
+        VerdictCache Constructor
+
+        :param max_entries int: Entries kept before the least recently used are evicted
+        :param ttl float: Seconds a verdict stays valid, None to keep it until evicted
+        :param check_interval float: Seconds between signature version checks
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.version: Optional[str] = None
+        self.checked = 0.0
+
+    def hasher(self) -> Any:
+        """
+        Create the digest used as key
+
+        :return: A hashlib object
+        """
+        return hashlib.blake2b(digest_size=32)
+
+    def needs_version(self) -> bool:
+        """
+        Check if the signature version should be queried again
+
+        :rtype: bool
+        """
+        return (self.version is None
+            or time.monotonic() - self.checked > self.check_interval)
+
+    async def set_version(self, version: Optional[str]) -> None:
+        """
+        Record the signature database version, clearing the cache if it changed
+
+        :param version str: Signature version reported by clamd, None if unknown
+        """
+        self.checked = time.monotonic()
+        if version != self.version:
+            await self.clear()
+            self.version = version
+
+    async def invalidate(self) -> None:
+        """ Clear the cache and query the signature version again """
+        await self.clear()
+        self.version = None
+
+    async def get(self, digest: bytes) -> Optional[str]:
+        """
+        Look up a verdict
+
+        :param digest bytes: Content digest
+        :return: The cached response from clamav, None on a miss
+        """
+        raise NotImplementedError("Must override get")
+
+    async def set(self, digest: bytes, verdict: str) -> None:
+        """
+        Store a verdict
+
+        :param digest bytes: Content digest
+        :param verdict str: Response from clamav
+        """
+        raise NotImplementedError("Must override set")
+
+    async def clear(self) -> None:
+        """ Remove all verdicts """
+        raise NotImplementedError("Must override clear")
+
+class MemoryVerdictCache(VerdictCache):
+    """ In memory LRU verdict cache """
+    def __init__(self, *args, **kwargs):
+        """ MemoryVerdictCache Constructor, see VerdictCache """
+        super().__init__(*args, **kwargs)
+        self.entries: 'OrderedDict[bytes, Tuple[float, str]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    async def get(self, digest: bytes) -> Optional[str]:
+        entry = self.entries.get(digest)
+        if entry is None:
+            return None
+        expires, verdict = entry
+        if expires < time.monotonic():
+            del self.entries[digest]
+            return None
+        self.entries.move_to_end(digest)
+        return verdict
+
+    async def set(self, digest: bytes, verdict: str) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float('inf')
+        self.entries[digest] = (expires, verdict)
+        self.entries.move_to_end(digest)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def clear(self) -> None:
+        self.entries.clear()
+
+class SqliteVerdictCache(VerdictCache):
+    """
+    On disk verdict cache
+
+    Verdicts and the signature version they belong to survive restarts.
+    Queries run in a worker thread.
+    """
+    def __init__(self, path: str, *args, **kwargs):
+        """
+        SqliteVerdictCache Constructor
+
+        :param path str: Database file
+        :param args: See VerdictCache
+        """
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.database = SqliteDatabase(path)
+        db = self.database.db
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS verdicts ('
+            'digest BLOB PRIMARY KEY, verdict TEXT, expires REAL, used REAL)'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS verdicts_used ON verdicts (used)')
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        self.version = row[0] if row else None
+        self.count = db.execute('SELECT COUNT(*) FROM verdicts').fetchone()[0]
+
+    def __len__(self) -> int:
+        return self.count
+
+    async def run(self, query: str, *params: Any) -> Any:
+        """
+        Run a query in a worker thread
+
+        :param query str: SQL statement
+        :param params: Query parameters
+        :return: The first row, if any
+        """
+        return await self.database.execute(
+            lambda db: db.execute(query, params).fetchone()
+        )
+
+    async def set_version(self, version: Optional[str]) -> None:
+        changed = version != self.version
+        await super().set_version(version)
+        if changed:
+            await self.run(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", version
+            )
+
+    async def get(self, digest: bytes) -> Optional[str]:
+        now = time.time()
+        row = await self.run('SELECT verdict, expires FROM verdicts WHERE digest = ?', digest)
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < now:
+            await self.run('DELETE FROM verdicts WHERE digest = ?', digest)
+            self.count -= 1
+            return None
+        await self.run('UPDATE verdicts SET used = ? WHERE digest = ?', now, digest)
+        return row[0]
+
+    async def set(self, digest: bytes, verdict: str) -> None:
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        known = await self.run('SELECT 1 FROM verdicts WHERE digest = ?', digest)
+        await self.run(
+            'INSERT OR REPLACE INTO verdicts (digest, verdict, expires, used) VALUES (?, ?, ?, ?)',
+            digest, verdict, expires, now
+        )
+        if known is None:
+            self.count += 1
+        if self.count > self.max_entries:
+            excess = self.count - self.max_entries
+            await self.run(
+                'DELETE FROM verdicts WHERE digest IN '
+                '(SELECT digest FROM verdicts ORDER BY used LIMIT ?)', excess
+            )
+            self.count -= excess
+
+    async def clear(self) -> None:
+        await self.run('DELETE FROM verdicts')
+        self.count = 0
+
+    def close(self) -> None:
+        """ Close the database """
+        self.database.close()
@@ -0,0 +1,228 @@
+""" Connections of the client: one shot, persistant or pooled """
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, TYPE_CHECKING, cast
+from asyncinit import asyncinit
+from .cache import VerdictCache
+from .fork import ForkSafe
+from .metrics import Metrics, current_trace
+from .protocol import print_, PyvalveConnectionError, SESSION_COMMANDS
+from .hedging import LatencyWindow, Hedging
+from .connection import Connection
+from .pool import ConnectionPool
+from .session import Session
+
+if TYPE_CHECKING:
+    from . import Pyvalve
+
+@asyncinit
+class Client(Hedging, ForkSafe):
+    """ Connections of a Pyvalve client, opened for a command or borrowed from a pool """
+    # True when clamd runs on this host and can receive file descriptors
+    local = False
+
+    async def __init__(self):
+        """ Constructor """
+        super().__init__()
+        self.conn: Connection = None
+        self.pool: Optional[ConnectionPool] = None
+        self.call_timeout: Optional[float] = None
+        self.latencies: Dict[str, LatencyWindow] = {}
+        self.persistant_connection = False
+        self.cache: Optional[VerdictCache] = None
+        self.metrics: Optional[Metrics] = None
+
+    def after_fork(self) -> None:
+        """ Drop the parent's connection """
+        self.conn = None  # type: ignore[assignment]
+
+    def set_connection(self,  conn: Connection) -> None:
+        """
+        Set connection
+
+        :param conn Connection: A connection object
+        """
+        self.conn = conn
+
+    def set_persistant_connection(self,  persist: bool) -> None:
+        """
+        Set persistent connection
+
+        When True, commands clamd allows inside an IDSESSION are sent
+        over pooled connections. A default pool is created on first use.
+
+        :param persist bool: persistent connection True/False
+        """
+        self.persistant_connection = persist
+
+    def set_call_timeout(self, timeout: Optional[float]) -> None:
+        """
+        Set the time a call may take, covering connecting, sending and receiving
+
+        Calls taking longer raise PyvalveTimeout. Use deadline() to bound
+        a single call.
+
+        :param timeout float: Seconds, None to wait forever
+        """
+        self.call_timeout = timeout
+
+    @property
+    def endpoint(self) -> str:
+        """ Name of the clamd in metrics """
+        return 'clamd'
+
+    def set_metrics(self, metrics: Optional[Metrics]) -> None:
+        """
+        Set the collector requests are reported to
+
+        Requests are traced only while a collector is set, otherwise
+        instrumentation costs a context variable lookup per step.
+
+        :param metrics Metrics: A collector, possibly shared with other clients,
+            None to disable instrumentation
+        """
+        self.metrics = metrics
+
+    @asynccontextmanager
+    async def traced(self, command: str) -> AsyncIterator[None]:
+        """
+        Trace a request, unless it is part of a traced request
+
+        :param command str: The command, e.g. SCAN
+        """
+        metrics = self.metrics
+        if metrics is None or current_trace.get() is not None:
+            yield
+            return
+        trace = metrics.start(command, self.endpoint)
+        token = current_trace.set(trace)
+        try:
+            yield
+        except BaseException as exc:
+            current_trace.reset(token)
+            trace.finish(exc)
+            raise
+        current_trace.reset(token)
+        trace.finish()
+
+    def set_pool(self, pool: ConnectionPool) -> None:
+        """
+        Set connection pool
+
+        :param pool ConnectionPool: A pool, possibly shared with other instances
+        """
+        self.pool = pool
+
+    async def create_pool(self, **kwargs) -> ConnectionPool:
+        """
+        Create a connection pool for this client and use it
+
+        :param kwargs: ConnectionPool options
+        :return: The new pool, which can be passed to set_pool on other instances
+        :rtype: ConnectionPool
+        """
+        pool = ConnectionPool(self.open_session, **kwargs)
+        await pool.fill()
+        self.set_pool(pool)
+        return pool
+
+    def acquire(self):
+        """
+        Borrow a pooled session connection::
+
+            async with pv.acquire() as conn:
+                reply = await conn.request(b'zPING\\0')
+
+        :return: Async context manager yielding a Connection
+        """
+        self.check_fork()
+        if self.pool is None:
+            self.pool = ConnectionPool(self.open_session)
+        return self.pool.connection()
+
+    @asynccontextmanager
+    async def session(self, max_pending: int = 32) -> AsyncIterator[Session]:
+        """
+        Run a pipelined IDSESSION on a pooled connection::
+
+            async with pv.session() as session:
+                results = await asyncio.gather(
+                    session.ping(), session.scan(path), session.instream(buffer)
+                )
+
+        :param max_pending int: Maximum requests in flight
+        :return: Async context manager yielding a Session
+        """
+        async with self.acquire() as conn:
+            session = Session(cast('Pyvalve', self), conn, max_pending)
+            await session.start()
+            try:
+                yield session
+            finally:
+                await session.stop()
+                if session.error is not None:
+                    await conn.close()
+
+    def use_pool(self, command: str) -> bool:
+        """
+        Check if a command should be sent over a pooled session
+
+        :param command str: The clamd command
+        :rtype: bool
+        """
+        if self.pool is None and not self.persistant_connection:
+            return False
+        return command in SESSION_COMMANDS
+
+    async def close(self, conn: Optional[Connection] = None) -> None:
+        """
+        Close the stream
+
+        :param conn Connection: The connection of a single command, the
+            last one opened by default
+        """
+        if self.persistant_connection:
+            print_('Persist the connection')
+            return None
+        print_('Close the connection')
+        conn = conn or self.conn
+        conn.writer.close()
+        await conn.writer.wait_closed()
+
+    async def get_connection(self) -> Connection:
+        """
+        Get a connection for a single command
+
+        Each call opens a connection of its own, used and closed by the
+        caller, so concurrent commands never share one.
+
+        :return: A new connection
+        :rtype: Connection
+        :raises PyvalveConnectionError: If Pyvalve cannot connect to clamav
+        """
+        self.check_fork()
+        if self.conn and self.persistant_connection:
+            if self.conn.writer.is_closing():
+                raise PyvalveConnectionError("Persitant connection no longer available")
+        conn = await self.open_connection()
+        self.set_connection(conn)
+        return conn
+
+    async def open_session(self) -> Connection:
+        """
+        Open a new connection and start an IDSESSION on it
+
+        :return: A session connection
+        :rtype: Connection
+        :raises PyvalveConnectionError: If Pyvalve cannot connect to clamav
+        """
+        conn = await self.open_connection()
+        try:
+            await conn.start_session()
+        except OSError as exc:
+            await conn.close()
+            raise PyvalveConnectionError(str(exc)) from exc
+        return conn
+
+    async def open_connection(self) -> Connection:
+        """ Place holder open_connection method """
+        raise NotImplementedError("Must override open_connection")
@@ -0,0 +1,665 @@
+""" Load balancing over several clamd """
+import asyncio
+import os
+import random
+from typing import (
+    Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple, Union
+)
+from asyncinit import asyncinit
+from . import (
+    Pyvalve, PyvalveSocket, PyvalveNetwork, PyvalveConnectionError, PyvalveStreamMaxLength,
+    PyvalveTimeout, BatchResult, ConcurrencyLimiter, ForkSafe, Hedging, HEDGED_COMMANDS,
+    LatencyWindow, Metrics, RoutedScan, ScanResult, ServerStats, StreamSource, map_bounded,
+    remaining_length, print_, signature_version
+)
+from .archive import ArchiveLimits, ArchiveResult, expand_and_scan
+from .manifest import ScanManifest, scan_incremental
+from .walk import TreeFilter, walk_tree
+
+LEAST_OUTSTANDING = 'least_outstanding'
+POWER_OF_TWO = 'power_of_two'
+
+# Client methods that can be sent to two endpoints, for hedging. Directory
+# scans are left out, a duplicate would walk the whole tree again.
+HEDGED_METHODS = frozenset((
+    'ping', 'version', 'stats', 'server_stats', 'scan', 'scan_results', 'scan_index'
+))
+
+class Endpoint():
+    """ A clamd in a cluster """
+    def __init__(self, client: Pyvalve, name: str):
+        """
+        Endpoint Constructor
+
+        :param client Pyvalve: Client for the clamd
+        :param name str: Name used in logs
+        """
+        self.client = client
+        self.name = name
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+
+    @property
+    def load(self) -> float:
+        """ Requests in flight, relative to the concurrency limit if there is one """
+        if self.client.limiter is None:
+            return self.outstanding
+        return self.outstanding / self.client.limiter.current
+
+    def __repr__(self) -> str:
+        state = 'up' if self.healthy else 'down'
+        return f'Endpoint({self.name}, {state}, outstanding={self.outstanding})'
+
+async def create_client(endpoint: str) -> Pyvalve:
+    """
+    Create a client from an endpoint string
+
+    :param endpoint str: A socket path, or host:port
+    :return: A PyvalveSocket or PyvalveNetwork
+    :rtype: Pyvalve
+    """
+    if endpoint.startswith('/'):
+        return await PyvalveSocket(endpoint)  # type: ignore[misc]
+    host, _, port = endpoint.rpartition(':')
+    if not host or not port.isdigit():
+        return await PyvalveNetwork(endpoint)  # type: ignore[misc]
+    return await PyvalveNetwork(host.strip('[]'), int(port))  # type: ignore[misc]
+
+@asyncinit
+class Balancer(Hedging, ForkSafe):
+    """
+    Endpoints of a cluster, checked in the background, and the client
+    calls balanced over them
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    # pylint: disable=too-many-instance-attributes
+    async def __init__(self, # type: ignore[misc]
+        endpoints: Iterable[Union[str, Pyvalve]],
+        strategy: str = LEAST_OUTSTANDING,
+        check_interval: float = 5.0,
+        check_timeout: float = 2.0,
+        max_failures: int = 2,
+        retries: int = 1):
+        """
+        Balancer Constructor
+
+        :param endpoints iterable: Clients, socket paths or host:port strings
+        :param strategy str: least_outstanding or power_of_two
+        :param check_interval float: Seconds between health checks, 0 to disable them
+        :param check_timeout float: Seconds to wait for a ping
+        :param max_failures int: Failed pings before an endpoint is ejected
+        :param retries int: Retries on another endpoint for requests that are safe to repeat
+        """
+        if strategy not in (LEAST_OUTSTANDING, POWER_OF_TWO):
+            raise ValueError(f'Unknown strategy: {strategy}')
+        super().__init__()
+        self.endpoints: List[Endpoint] = []
+        for endpoint in endpoints:
+            client = endpoint if isinstance(endpoint, Pyvalve) else await create_client(endpoint)
+            self.endpoints.append(Endpoint(client, str(endpoint)))
+        if not self.endpoints:
+            raise ValueError('A cluster needs at least one endpoint')
+        self.strategy = strategy
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.max_failures = max_failures
+        self.retries = retries
+        self.latencies: Dict[str, LatencyWindow] = {}
+        self.checker: Optional[asyncio.Task] = None
+        if check_interval > 0:
+            self.checker = asyncio.create_task(self.check_loop())
+
+    def after_fork(self) -> None:
+        """ Restart the health checks, the parent's task runs on its own event loop """
+        for endpoint in self.endpoints:
+            endpoint.outstanding = 0
+        self.checker = None
+        if self.check_interval > 0:
+            self.checker = asyncio.create_task(self.check_loop())
+
+    @property
+    def healthy(self) -> List[Endpoint]:
+        """ Endpoints currently in rotation """
+        return [endpoint for endpoint in self.endpoints if endpoint.healthy]
+
+    def pick(self,
+        exclude: Iterable[Endpoint] = (),
+        avoid: Iterable[Endpoint] = ()) -> Endpoint:
+        """
+        Choose an endpoint for a request
+
+        When every endpoint is ejected all of them are tried, as the
+        health checks may be behind.
+
+        :param exclude iterable: Endpoints that already failed this request
+        :param avoid iterable: Endpoints to use only if no other is left
+        :return: The endpoint
+        :rtype: Endpoint
+        :raises PyvalveConnectionError: If every endpoint was excluded
+        """
+        candidates = [e for e in self.endpoints if e.healthy and e not in exclude]
+        if not candidates:
+            candidates = [e for e in self.endpoints if e not in exclude]
+        if not candidates:
+            raise PyvalveConnectionError('No clamd endpoint available')
+        preferred = [e for e in candidates if e not in avoid]
+        if preferred:
+            candidates = preferred
+        if self.strategy == POWER_OF_TWO and len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        least = min(endpoint.load for endpoint in candidates)
+        return random.choice([e for e in candidates if e.load == least])
+
+    def mark_failed(self, endpoint: Endpoint, eject: bool = False) -> None:
+        """
+        Record a failure, ejecting the endpoint after max_failures
+
+        :param endpoint Endpoint: The failing endpoint
+        :param eject bool: Eject immediately
+        """
+        endpoint.failures = self.max_failures if eject else endpoint.failures + 1
+        if endpoint.healthy and endpoint.failures >= self.max_failures:
+            print_(f'Ejecting {endpoint.name}')
+            endpoint.healthy = False
+
+    def mark_healthy(self, endpoint: Endpoint) -> None:
+        """
+        Record a success, bringing the endpoint back in rotation
+
+        :param endpoint Endpoint: The recovered endpoint
+        """
+        if not endpoint.healthy:
+            print_(f'Restoring {endpoint.name}')
+        endpoint.failures = 0
+        endpoint.healthy = True
+
+    async def check(self, endpoint: Endpoint) -> bool:
+        """
+        Ping an endpoint and update its health
+
+        :param endpoint Endpoint: The endpoint
+        :return: True if clamd answered
+        :rtype: bool
+        """
+        try:
+            async with asyncio.timeout(self.check_timeout):
+                await endpoint.client.ping()
+        except Exception: # pylint: disable=broad-except
+            self.mark_failed(endpoint)
+            return False
+        self.mark_healthy(endpoint)
+        return True
+
+    async def check_loop(self) -> None:
+        """ Check every endpoint every check_interval seconds """
+        while True:
+            await asyncio.gather(*(self.check(endpoint) for endpoint in self.endpoints))
+            await asyncio.sleep(self.check_interval)
+
+    async def close(self) -> None:
+        """ Stop the health checks and close the endpoints' pools """
+        self.check_fork()
+        if self.checker is not None:
+            self.checker.cancel()
+            try:
+                await self.checker
+            except asyncio.CancelledError:
+                pass
+            self.checker = None
+        for endpoint in self.endpoints:
+            if endpoint.client.pool is not None:
+                await endpoint.client.pool.close()
+
+    def set_call_timeout(self, timeout: Optional[float]) -> None:
+        """
+        Set the time a call may take on each endpoint
+
+        A call timing out on one endpoint is retried on another when it
+        is safe to repeat.
+
+        :param timeout float: Seconds, None to wait forever
+        """
+        for endpoint in self.endpoints:
+            endpoint.client.set_call_timeout(timeout)
+
+    def set_path_check(self, mode: Optional[str]) -> None:
+        """
+        Set how every endpoint checks paths before sending them
+
+        :param mode str: 'thread', 'stat' or None, see Pyvalve.set_path_check
+        """
+        for endpoint in self.endpoints:
+            endpoint.client.set_path_check(mode)
+
+    def set_limiters(self, **kwargs: Any) -> None:
+        """
+        Give every endpoint its own adaptive concurrency limiter
+
+        Requests then go to the endpoint using the least of its limit.
+
+        :param kwargs: ConcurrencyLimiter arguments
+        """
+        for endpoint in self.endpoints:
+            endpoint.client.set_limiter(ConcurrencyLimiter(**kwargs))
+
+    def set_metrics(self, metrics: Optional[Metrics]) -> None:
+        """
+        Report the requests of every endpoint to a collector
+
+        :param metrics Metrics: A collector, None to disable instrumentation
+        """
+        for endpoint in self.endpoints:
+            endpoint.client.set_metrics(metrics)
+
+    async def call(self,
+        method: str,
+        *args: Any,
+        retry: bool = True,
+        length: Optional[int] = None) -> Any:
+        """
+        Call a client method on a balanced endpoint
+
+        :param method str: Name of the Pyvalve method
+        :param args: Method arguments
+        :param retry bool: Retry on another endpoint if connecting fails
+        :param length int: Stream length, endpoints with a lower
+            StreamMaxLength are skipped
+        :return: What the method returns
+        :raises PyvalveConnectionError: If no endpoint could be reached
+        :raises PyvalveStreamMaxLength: If the stream is too long for every endpoint
+        """
+        self.check_fork()
+        tried: List[Endpoint] = []
+        if length is not None:
+            tried = [e for e in self.endpoints if not e.client.accepts_stream(length)]
+            if len(tried) == len(self.endpoints):
+                raise PyvalveStreamMaxLength(
+                    f'Stream of {length} bytes exceeds StreamMaxLength of every endpoint'
+                )
+        if self.hedge_quantile is None or not self.hedgeable(method, args):
+            return await self.attempt(method, args, retry, tried)
+
+        busy: List[Endpoint] = []
+        return await self.hedged(
+            method, lambda: self.attempt(method, args, retry, list(tried), busy)
+        )
+
+    @staticmethod
+    def hedgeable(method: str, args: Tuple[Any, ...]) -> bool:
+        """
+        Check if a call can be sent to two endpoints
+
+        :param method str: Name of the Pyvalve method
+        :param args tuple: Method arguments
+        :rtype: bool
+        """
+        if method in ('scan_results', 'scan_index'):
+            # hedged as long as the command is not a directory scan
+            return len(args) < 2 or args[1] in HEDGED_COMMANDS
+        return method in HEDGED_METHODS
+
+    async def attempt(self,
+        method: str,
+        args: Tuple[Any, ...],
+        retry: bool,
+        tried: List[Endpoint],
+        busy: Optional[List[Endpoint]] = None) -> Any:
+        """
+        Call a client method, retrying on another endpoint if it fails
+
+        :param method str: Name of the Pyvalve method
+        :param args tuple: Method arguments
+        :param retry bool: Retry on another endpoint if connecting fails
+        :param tried list: Endpoints not to use, failed ones are added
+        :param busy list: Endpoints serving duplicates of this request
+        :return: What the method returns
+        """
+        attempts = len(tried)
+        while True:
+            endpoint = self.pick(tried, busy or ())
+            endpoint.outstanding += 1
+            if busy is not None:
+                busy.append(endpoint)
+            try:
+                return await getattr(endpoint.client, method)(*args)
+            except PyvalveConnectionError as exc:
+                # a slow endpoint is not ejected until it fails again
+                self.mark_failed(endpoint, eject=not isinstance(exc, PyvalveTimeout))
+                tried.append(endpoint)
+                if not retry or len(tried) - attempts > self.retries:
+                    raise
+                print_(f'Retrying {method} after {endpoint.name} failed')
+            finally:
+                endpoint.outstanding -= 1
+                if busy is not None:
+                    busy.remove(endpoint)
+
+    async def broadcast(self, method: str, *args: Any) -> List[Any]:
+        """
+        Call a client method on every endpoint
+
+        :param method str: Name of the Pyvalve method
+        :param args: Method arguments
+        :return: Results, or the exception raised, in endpoint order
+        :rtype: list
+        """
+        return await asyncio.gather(
+            *(getattr(endpoint.client, method)(*args) for endpoint in self.endpoints),
+            return_exceptions=True
+        )
+
+    async def reload(self) -> str:
+        """
+        Send reload command to every endpoint
+
+        :return: Response from the first clamav
+        :rtype: str
+        :raises PyvalveError: If an endpoint failed
+        """
+        return self.first(await self.broadcast('reload'))
+
+    async def shutdown(self) -> str:
+        """
+        Send shutdown command to every endpoint
+
+        :return: Response from the first clamav
+        :rtype: str
+        :raises PyvalveError: If an endpoint failed
+        """
+        return self.first(await self.broadcast('shutdown'))
+
+    @staticmethod
+    def first(results: List[Any]) -> Any:
+        """ Raise the first error of a broadcast, or return the first result """
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results[0]
+
+class PyvalveCluster(Balancer):
+    """
+    Asyncio client spreading requests over several clamd
+
+    Unhealthy endpoints are ejected when a request fails to connect, or
+    after failed background pings, and brought back once a ping succeeds.
+    """
+    async def ping(self) -> str:
+        """
+        Send ping command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.call('ping')
+
+    async def stats(self) -> str:
+        """
+        Send stats command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.call('stats')
+
+    async def server_stats(self) -> ServerStats:
+        """
+        Get the load of a clamd
+
+        :return: Threads, queue and memory use parsed from STATS
+        :rtype: ServerStats
+        """
+        return await self.call('server_stats')
+
+    async def version(self) -> str:
+        """
+        Send version command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.call('version')
+
+    async def scan(self, path: str) -> str:
+        """
+        Send scan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        return await self.call('scan', path)
+
+    async def contscan(self, path: str) -> str:
+        """
+        Send contscan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        return await self.call('contscan', path)
+
+    async def multiscan(self, path: str) -> str:
+        """
+        Send multiscan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        return await self.call('multiscan', path)
+
+    async def allmatchscan(self, path: str) -> str:
+        """
+        Send allmatchscan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        return await self.call('allmatchscan', path)
+
+    async def scan_results(self, path: str, command: str = 'SCAN') -> List[ScanResult]:
+        """
+        Scan a path and parse the response
+
+        :param path str: Path to file/directory to be scanned
+        :param command str: SCAN, CONTSCAN, MULTISCAN or ALLMATCHSCAN
+        :return: One result per path
+        :rtype: list
+        """
+        return await self.call('scan_results', path, command)
+
+    async def scan_index(self, path: str, command: str = 'SCAN') -> Dict[str, ScanResult]:
+        """
+        Scan a path and index the results by path
+
+        :param path str: Path to file/directory to be scanned
+        :param command str: SCAN, CONTSCAN, MULTISCAN or ALLMATCHSCAN
+        :return: Results keyed by path
+        :rtype: dict
+        """
+        return await self.call('scan_index', path, command)
+
+    async def iter_scan(self,
+        path: str,
+        command: str = 'MULTISCAN') -> AsyncIterator[ScanResult]:
+        """
+        Scan a path and yield results as clamd reports them
+
+        :param path str: Path to file/directory to be scanned
+        :param command str: SCAN, CONTSCAN, MULTISCAN or ALLMATCHSCAN
+        :return: Async iterator of ScanResult
+        """
+        endpoint = self.pick()
+        endpoint.outstanding += 1
+        try:
+            async for result in endpoint.client.iter_scan(path, command):
+                yield result
+        except PyvalveConnectionError:
+            self.mark_failed(endpoint, eject=True)
+            raise
+        finally:
+            endpoint.outstanding -= 1
+
+    async def instream(self, buffer: StreamSource) -> str:
+        """
+        Send a stream to clamav
+
+        The stream is consumed, so it is not retried on another endpoint.
+        When its length is known, it goes to an endpoint whose
+        StreamMaxLength allows it.
+
+        :param buffer: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveConnectionError: If connection is broken
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        return await self.call('instream', buffer, retry=False, length=remaining_length(buffer))
+
+    async def instream_tee(self, source: StreamSource, destination: Any) -> str:
+        """
+        Stream to clamav while forwarding the same chunks to a destination
+
+        The stream is consumed, so it is not retried on another endpoint.
+
+        :param source: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :param destination: Where the chunks are forwarded, see TeeStream
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveResponseError: If clamav replied before the end of the stream
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        return await self.call('instream_tee', source, destination, retry=False)
+
+    async def scan_archive(self,
+        source: Union[str, os.PathLike, StreamSource],
+        limits: Optional[ArchiveLimits] = None,
+        concurrency: int = 16,
+        stop_on_hit: bool = False) -> ArchiveResult:
+        """
+        Expand a zip or tar archive here and scan its members, spread over the endpoints
+
+        :param source: A path, or a stream source as taken by instream.
+            Only paths and seekable buffers are expanded
+        :param limits ArchiveLimits: Bounds of the expansion, clamd's
+            defaults when not given
+        :param concurrency int: Maximum requests in flight
+        :param stop_on_hit bool: Stop at the first member matching a signature
+        :return: The combined verdict
+        :rtype: ArchiveResult
+        :raises PyvalveScanningError: If the path can not be opened
+        """
+        return await expand_and_scan(source,
+            lambda members: map_bounded(lambda member: self.instream(member.file),
+                members, concurrency),
+            self.instream, limits, stop_on_hit, concurrency)
+
+    async def instream_file(self, path: str) -> str:
+        """
+        Send a file on disk to clamav
+
+        :param path str: Path to the file
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If the file can not be opened
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        try:
+            length: Optional[int] = os.stat(path).st_size
+        except OSError:
+            length = None
+        return await self.call('instream_file', path, length=length)
+
+    async def scan_auto(self, source: Any) -> RoutedScan:
+        """
+        Scan a path, bytes or a buffer over the cheapest transport
+        of a balanced endpoint
+
+        :param source: A path, bytes, or a buffer object
+        :return: The response and the route taken
+        :rtype: RoutedScan
+        """
+        retry = isinstance(source, (str, os.PathLike, bytes, bytearray, memoryview))
+        return await self.call('scan_auto', source, retry=retry)
+
+    def scan_many(self,
+        paths: Iterable[str],
+        concurrency: int = 16,
+        ordered: bool = False) -> AsyncIterator[BatchResult]:
+        """
+        Scan many paths with bounded concurrency, spread over the endpoints
+
+        :param paths iterable: Paths to scan, consumed lazily
+        :param concurrency int: Maximum requests in flight
+        :param ordered bool: Yield results in input order instead of as they complete
+        :return: Async iterator of BatchResult
+        """
+        return map_bounded(self.scan, paths, concurrency, ordered)
+
+    def instream_many(self,
+        buffers: Iterable[StreamSource],
+        concurrency: int = 16,
+        ordered: bool = False) -> AsyncIterator[BatchResult]:
+        """
+        Stream many buffers with bounded concurrency, spread over the endpoints
+
+        :param buffers iterable: Stream sources as taken by instream, consumed lazily
+        :param concurrency int: Maximum requests in flight
+        :param ordered bool: Yield results in input order instead of as they complete
+        :return: Async iterator of BatchResult
+        """
+        return map_bounded(self.instream, buffers, concurrency, ordered)
+
+    # pylint: disable=too-many-arguments
+    def scan_tree(self,
+        root: str,
+        include: Optional[Iterable[str]] = None,
+        exclude: Iterable[str] = (),
+        max_size: Optional[int] = None,
+        concurrency: int = 16,
+        *,
+        command: str = 'INSTREAM',
+        workers: int = 4,
+        follow_symlinks: bool = False,
+        onerror: Optional[Callable[[OSError], Any]] = None,
+        manifest: Optional[ScanManifest] = None) -> AsyncIterator[BatchResult]:
+        """
+        Walk a local directory tree and scan its files, spread over the endpoints
+
+        See Pyvalve.scan_tree. With SCAN every clamd must see the files
+        at the same paths.
+
+        :param root str: The directory to walk
+        :param include iterable: Glob patterns of the files to scan, None for all
+        :param exclude iterable: Glob patterns of the files and directories to skip
+        :param max_size int: Size in bytes above which files are skipped
+        :param concurrency int: Maximum requests in flight
+        :param command str: INSTREAM or SCAN
+        :param workers int: Directories listed in parallel
+        :param follow_symlinks bool: Follow links to files and directories
+        :param onerror callable: Called with the OSError of an unreadable directory
+        :param manifest ScanManifest: Record of the previous scans, for an incremental scan
+        :return: Async iterator of BatchResult, the items are file paths
+        :raises ValueError: If the command is not INSTREAM or SCAN
+        """
+        operations = {'INSTREAM': self.instream_file, 'SCAN': self.scan}
+        if command not in operations:
+            raise ValueError(f'Unsupported command: {command}')
+        tree_filter = TreeFilter(include, exclude, max_size, follow_symlinks)
+        paths = walk_tree(root, tree_filter, workers, onerror)
+        if manifest is None:
+            return map_bounded(operations[command], paths, concurrency)
+
+        async def version() -> Optional[str]:
+            return signature_version(await self.version())
+        return scan_incremental(manifest, root, version, paths,
+            lambda changed: map_bounded(operations[command], changed, concurrency))
@@ -0,0 +1,272 @@
+""" Commands of the client, and the checks and limits around them """
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import List, AsyncIterator, Iterable, Optional
+from .limiter import ConcurrencyLimiter, ServerStats, parse_stats
+from .protocol import (
+    DEBUG, print_, PyvalveError, PyvalveResponseError, PyvalveConnectionError, is_error_reply,
+    signature_version, HEDGED_COMMANDS, LIMITED_COMMANDS, check_reply
+)
+from .hedging import time_limit, deadline_passed
+from .client import Client
+
+# Ways to check a path exists before sending it, see Pyvalve.set_path_check
+PATH_CHECKS = ('thread', 'stat', None)
+
+class CommandClient(Client):  # pylint: disable=abstract-method
+    """ Commands of a Pyvalve client, other than scans """
+    async def __init__(self):
+        """ Constructor """
+        await super().__init__()
+        self.path_check: Optional[str] = 'thread'
+        self.limiter: Optional[ConcurrencyLimiter] = None
+
+    def set_path_check(self, mode: Optional[str]) -> None:
+        """
+        Set how paths are checked before SCAN and the other path commands
+
+        'thread' stats the path in a worker thread, the default. 'stat'
+        stats it on the event loop, which saves the thread hop and is
+        the fastest on a local disk, but blocks the loop while a slow
+        network file system answers. None skips the check and lets
+        clamd report a missing path in its reply.
+
+        :param mode str: 'thread', 'stat' or None
+        :raises ValueError: If the mode is unknown
+        """
+        if mode not in PATH_CHECKS:
+            raise ValueError(f'Invalid path check: {mode}')
+        self.path_check = mode
+
+    def set_limiter(self, limiter: Optional[ConcurrencyLimiter]) -> None:
+        """
+        Set a concurrency limiter
+
+        Scans and streams wait for the limiter before they are sent, so
+        clamd is kept busy without queueing requests on its side.
+
+        :param limiter ConcurrencyLimiter: A limiter, None to send requests as they come
+        """
+        self.limiter = limiter
+
+    @asynccontextmanager
+    async def limited(self, command: Optional[str] = None) -> AsyncIterator[None]:
+        """
+        Hold a concurrency limiter slot for the duration of a request
+
+        :param command str: The command, requests that do not keep a
+            clamd thread busy are not limited. None for a scan or stream
+        """
+        limiter = self.limiter
+        if limiter is None or (command is not None and command not in LIMITED_COMMANDS):
+            yield
+            return
+        if limiter.stats_due():
+            await self.refresh_server_stats()
+        await limiter.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        except PyvalveConnectionError:
+            limiter.release(dropped=True)
+            raise
+        except PyvalveError:
+            limiter.release(time.monotonic() - started)
+            raise
+        except asyncio.CancelledError:
+            # an enclosing time_limit turns its expiry into PyvalveTimeout
+            # only once the cancellation has left this block
+            limiter.release(dropped=deadline_passed())
+            raise
+        except BaseException:
+            limiter.release()
+            raise
+        limiter.release(time.monotonic() - started)
+
+    async def refresh_server_stats(self) -> None:
+        """ Feed clamd STATS to the concurrency limiter, errors are ignored """
+        if self.limiter is None:
+            return
+        try:
+            self.limiter.observe(await self.server_stats())
+        except PyvalveError as exc:
+            print_(f'Could not read clamd stats: {exc}')
+
+    async def ping(self) -> str:
+        """
+        Send ping command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.send_command('PING')
+
+    async def stats(self) -> str:
+        """
+        Send stats command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.send_command('STATS')
+
+    async def server_stats(self) -> ServerStats:
+        """
+        Get the load of clamd
+
+        :return: Threads, queue and memory use parsed from STATS
+        :rtype: ServerStats
+        :raises PyvalveResponseError: If the reply can not be parsed
+        """
+        data = await self.stats()
+        try:
+            return parse_stats(data)
+        except ValueError as exc:
+            raise PyvalveResponseError(f'Invalid STATS reply: {exc}') from exc
+
+    async def version(self) -> str:
+        """
+        Send version command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        data_dec = await self.send_command('VERSION')
+        if self.cache is not None:
+            await self.cache.set_version(signature_version(data_dec))
+        return data_dec
+
+    async def reload(self) -> str:
+        """
+        Send reload command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        data_dec = await self.send_command('RELOAD')
+        if self.cache is not None:
+            await self.cache.invalidate()
+        return data_dec
+
+    async def shutdown(self) -> str:
+        """
+        Send shutdown command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.send_command('SHUTDOWN')
+
+    async def send_command(self,
+        msg: str,
+        *args: str) -> str:
+        """
+        Send a command to clamav
+
+        :param str msg: The command
+        :param list args: Command arguments
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveResponseError: If clamav responds with an error
+        """
+        # traced here so error replies are counted
+        async with self.traced(msg):
+            data = await self.send_raw_command(msg, *args)
+            if is_error_reply(data):
+                raise PyvalveResponseError(data.decode().strip())
+        return check_reply(data)
+
+    async def send_raw_command(self,
+        msg: str,
+        *args: str) -> bytes:
+        """
+        Send a command to clamav without interpreting the response
+
+        :param str msg: The command
+        :param list args: Command arguments
+        :return: Raw response from clamav
+        :rtype: bytes
+        """
+        jargs = ''
+        if args:
+            jargs = ' ' + ' '.join(args)
+
+        async with time_limit(self.call_timeout), self.traced(msg), self.limited(msg):
+            if self.hedge_quantile is not None and msg in HEDGED_COMMANDS:
+                return await self.hedged(msg, lambda: self.exchange(msg, jargs))
+            if self.use_pool(msg):
+                return await self.exchange(msg, jargs)
+
+            # a connection of its own, concurrent calls must not share one
+            conn = await self.get_connection()
+            try:
+                message = f'n{msg}{jargs}\n'
+                if DEBUG:
+                    print_(f'Send: {message}')
+
+                conn.send(message.encode('utf-8'))
+
+                await conn.flush()
+                data = await conn.read_reply()
+            finally:
+                await self.close(conn)
+
+        return data
+
+    async def exchange(self, msg: str, jargs: str = '') -> bytes:
+        """
+        Send a command on a connection of its own, pooled or one shot
+
+        :param str msg: The command
+        :param str jargs: Command arguments, with a leading space
+        :return: Raw response from clamav
+        :rtype: bytes
+        """
+        if self.use_pool(msg):
+            if DEBUG:
+                print_(f'Send: z{msg}{jargs}')
+            async with self.acquire() as conn:
+                return await conn.request(f'z{msg}{jargs}\0'.encode('utf-8'))
+
+        conn = await self.open_connection()
+        try:
+            if DEBUG:
+                print_(f'Send: n{msg}{jargs}')
+            conn.send(f'n{msg}{jargs}\n'.encode('utf-8'))
+            await conn.flush()
+            return await conn.read_reply()
+        finally:
+            await conn.close()
+
+    async def check_path(self, path: str) -> bool:
+        """
+        Check scanning path, as set by set_path_check
+
+        :param path str: Path to file/directory to be scanned
+        :return: False if the path does not exist, True when checks are off
+        :rtype: bool
+        """
+        if DEBUG:
+            print_(f'Checking path {path}')
+        if self.path_check is None:
+            return True
+        if self.path_check == 'stat':
+            return os.path.exists(path)
+        return await asyncio.to_thread(os.path.exists, path)
+
+    async def check_paths(self, paths: Iterable[str]) -> List[bool]:
+        """
+        Check many scanning paths with a single thread hop
+
+        :param paths iterable: Paths to files/directories to be scanned
+        :return: Whether each path exists, in order
+        :rtype: list
+        """
+        paths = list(paths)
+        if self.path_check is None:
+            return [True] * len(paths)
+        if self.path_check == 'stat':
+            return [os.path.exists(path) for path in paths]
+        return await asyncio.to_thread(lambda: [os.path.exists(path) for path in paths])
@@ -0,0 +1,200 @@
+""" Connection to clamd """
+import asyncio
+import socket as _socket
+import time
+from typing import Optional, Tuple
+from .fork import ForkSafe
+from .metrics import current_trace
+from .protocol import PyvalveResponseError, PyvalveConnectionError
+from .streams import ChunkSizer
+
+def _resolve(future: 'asyncio.Future[None]') -> None:
+    """ Resolve a future once, from a loop reader or writer callback """
+    if not future.done():
+        future.set_result(None)
+
+class Connection(ForkSafe):
+    """ Connection class """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter):
+        """ Constructor"""
+        super().__init__()
+        self.inherited = False
+        self.reader = reader
+        self.writer = writer
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.session = False
+        self.request_id = 0
+        self.sizer: Optional[ChunkSizer] = None
+        self.streamed = 0
+        trace = current_trace.get()
+        if trace is not None:
+            trace.connected(reused=False)
+
+    def is_usable(self) -> bool:
+        """
+        Check the connection can carry another request
+
+        :return: True if neither side has closed the connection
+            and it was opened by this process
+        :rtype: bool
+        """
+        self.check_fork()
+        if self.inherited:
+            return False
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def after_fork(self) -> None:
+        """ Stop using the socket, the parent process owns it """
+        self.inherited = True
+
+    async def start_session(self) -> None:
+        """ Switch the connection to an IDSESSION """
+        self.writer.write(b'zIDSESSION\0')
+        await self.writer.drain()
+        self.session = True
+
+    def send(self, message: bytes) -> int:
+        """
+        Write a framed command
+
+        :param message bytes: The framed command, e.g. b'zPING\\0'
+        :return: The session request id clamd will use for the reply
+        :rtype: int
+        """
+        self.writer.write(message)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.wrote(len(message))
+        if self.session:
+            self.request_id += 1
+        return self.request_id
+
+    async def flush(self) -> None:
+        """ Wait until the request is handed to the socket """
+        await self.writer.drain()
+        trace = current_trace.get()
+        if trace is not None:
+            trace.flushed()
+
+    async def request(self, message: bytes) -> bytes:
+        """
+        Send a null terminated command inside the session and wait for the reply
+
+        :param message bytes: The framed command, e.g. b'zPING\\0'
+        :return: Reply with the session request id removed
+        :rtype: bytes
+        """
+        self.send(message)
+        await self.flush()
+        return await self.read_reply()
+
+    async def send_fd(self, fd: int) -> None:
+        """
+        Pass a file descriptor to clamd with SCM_RIGHTS, after a FILDES command
+
+        :param fd int: An open file descriptor
+        :raises PyvalveConnectionError: If the connection is not a unix socket
+        """
+        sock = self.writer.get_extra_info('socket')
+        if sock is None or sock.family != _socket.AF_UNIX:
+            raise PyvalveConnectionError('FILDES requires a unix socket connection')
+        # the descriptor must follow the command, drain until the transport
+        # buffer is empty rather than just below its high water mark
+        transport = self.writer.transport
+        if transport.get_write_buffer_size():
+            low, high = transport.get_write_buffer_limits()
+            transport.set_write_buffer_limits(high=0, low=0)
+            try:
+                await self.writer.drain()
+            finally:
+                transport.set_write_buffer_limits(high=high, low=low)
+        # sendmsg on a duplicate, the transport owns the original socket
+        # and its selector registration
+        loop = asyncio.get_running_loop()
+        with _socket.fromfd(sock.fileno(), sock.family, sock.type) as raw:
+            while True:
+                try:
+                    _socket.send_fds(raw, [b'\0'], [fd])
+                    break
+                except BlockingIOError:
+                    writable: asyncio.Future[None] = loop.create_future()
+                    loop.add_writer(raw.fileno(), _resolve, writable)
+                    try:
+                        await writable
+                    finally:
+                        loop.remove_writer(raw.fileno())
+        trace = current_trace.get()
+        if trace is not None:
+            trace.flushed()
+
+    def wrote_stream(self) -> None:
+        """ Count the stream just written in the trace of the request """
+        trace = current_trace.get()
+        if trace is not None:
+            trace.wrote(self.streamed)
+
+    async def read_reply(self) -> bytes:
+        """
+        Read a single reply
+
+        Outside a session clamd closes the connection after replying,
+        inside a session every reply is '<id>: <reply>\\0'.
+
+        :return: Raw reply
+        :rtype: bytes
+        :raises PyvalveConnectionError: If clamd closed the session
+        """
+        if not self.session:
+            reply = await self.reader.read()
+        else:
+            request_id, reply = await self.read_session_reply()
+            if request_id != self.request_id:
+                raise PyvalveResponseError(
+                    f'Unexpected reply id {request_id}, expected {self.request_id}'
+                )
+        trace = current_trace.get()
+        if trace is not None:
+            trace.received(len(reply))
+        return reply
+
+    async def read_session_reply(self) -> Tuple[int, bytes]:
+        """
+        Read the next '<id>: <reply>\\0' reply of a session
+
+        :return: The request id and the reply
+        :rtype: tuple
+        :raises PyvalveConnectionError: If clamd closed the session
+        :raises PyvalveResponseError: If the reply has no request id
+        """
+        try:
+            data = await self.reader.readuntil(b'\0')
+        except asyncio.IncompleteReadError as exc:
+            raise PyvalveConnectionError('Session closed by clamd') from exc
+        request_id, _, reply = data[:-1].partition(b': ')
+        if not request_id.isdigit():
+            raise PyvalveResponseError(data[:-1].decode(errors='replace'))
+        return int(request_id), reply
+
+    def abort(self) -> None:
+        """ Drop the connection immediately, without ending the session """
+        self.check_fork()
+        if not self.inherited:
+            self.writer.transport.abort()
+
+    async def close(self) -> None:
+        """ End the session, if any, and close the connection """
+        self.check_fork()
+        if self.inherited or self.writer.is_closing():
+            # closing would unregister the socket from the parent's event loop
+            return
+        if self.session:
+            self.writer.write(b'zEND\0')
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
@@ -0,0 +1,34 @@
+""" Detection of forked processes, for preforking servers """
+import os
+
+class ForkSafe():
+    """
+    Mixin rebuilding process local state in a forked child
+
+    Forking bumps a class wide generation in the child. Objects remember
+    the generation they were built in and call check_fork before using
+    sockets, locks or tasks, so a child inheriting them rebuilds that
+    state on first use. Inherited sockets are dropped, never closed, as
+    the parent process still reads and writes them.
+    """
+    generation = 0
+
+    def __init__(self) -> None:
+        """ ForkSafe Constructor """
+        self.fork_generation = ForkSafe.generation
+
+    def check_fork(self) -> None:
+        """ Rebuild the state inherited from the parent, once per fork """
+        if self.fork_generation != ForkSafe.generation:
+            self.fork_generation = ForkSafe.generation
+            self.after_fork()
+
+    def after_fork(self) -> None:
+        """ Drop the state inherited from the parent process """
+
+def forked() -> None:
+    """ Mark the objects of this process as inherited, called in the child after a fork """
+    ForkSafe.generation += 1
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forked)
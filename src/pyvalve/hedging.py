@@ -0,0 +1,226 @@
+""" Deadlines of calls and hedged requests """
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import List, AsyncIterator, Awaitable, Callable, Deque, Dict, Any, Iterator, Optional
+from .protocol import print_, PyvalveTimeout
+
+# Loop time by which calls made in the current context must complete
+_deadline: ContextVar[Optional[float]] = ContextVar('pyvalve_deadline', default=None)
+
+# Deadline already enforced by an enclosing time limit
+_enforced: ContextVar[Optional[float]] = ContextVar('pyvalve_enforced', default=None)
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[None]:
+    """
+    Bound the time clamd calls made in the block may take::
+
+        with deadline(2.0):
+            await pv.scan(path)
+
+    A deadline covers connecting, sending and receiving. A nested
+    deadline can only shorten the enclosing one.
+
+    :param seconds float: Seconds from now
+    """
+    when = asyncio.get_running_loop().time() + seconds
+    current = _deadline.get()
+    token = _deadline.set(when if current is None else min(when, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+@asynccontextmanager
+async def time_limit(timeout: Optional[float] = None) -> AsyncIterator[None]:
+    """
+    Enforce the current deadline, and a timeout, on the block
+
+    :param timeout float: Seconds from now, None for the deadline only
+    :raises PyvalveTimeout: If the block does not complete in time
+    """
+    when = _deadline.get()
+    if timeout is not None:
+        own = asyncio.get_running_loop().time() + timeout
+        when = own if when is None else min(when, own)
+    enforced = _enforced.get()
+    if when is None or (enforced is not None and enforced <= when):
+        yield
+        return
+    token = _enforced.set(when)
+    try:
+        async with asyncio.timeout_at(when):
+            yield
+    except TimeoutError as exc:
+        raise PyvalveTimeout('clamd did not answer before the deadline') from exc
+    finally:
+        _enforced.reset(token)
+
+def deadline_passed() -> bool:
+    """
+    Check if the deadline enforced by an enclosing time_limit has passed
+
+    :rtype: bool
+    """
+    enforced = _enforced.get()
+    return enforced is not None and asyncio.get_running_loop().time() >= enforced
+
+class LatencyWindow():
+    """ Latencies of the most recent requests """
+    def __init__(self, size: int = 1000):
+        """
+        LatencyWindow Constructor
+
+        :param size int: Requests remembered
+        """
+        self.samples: Deque[float] = deque(maxlen=size)
+        self._sorted: List[float] = []
+        self._stale = 0
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def record(self, seconds: float) -> None:
+        """
+        Record the latency of a request
+
+        :param seconds float: Time the request took
+        """
+        self.samples.append(seconds)
+        self._stale += 1
+
+    def quantile(self, fraction: float) -> Optional[float]:
+        """
+        Get a latency quantile, sorting the samples at most every 5% of the window
+
+        :param fraction float: e.g. 0.95
+        :return: The latency, None without samples
+        :rtype: float
+        """
+        if not self.samples:
+            return None
+        if self._stale > len(self.samples) // 20:
+            self._sorted = sorted(self.samples)
+            self._stale = 0
+        return self._sorted[min(int(fraction * len(self._sorted)), len(self._sorted) - 1)]
+
+async def first_of(
+    start: Callable[[], Awaitable[Any]],
+    delay: Optional[float],
+    hedges: int = 1) -> Any:
+    """
+    Run a request, and duplicates of it when it is slow
+
+    A duplicate is started each time delay passes without an answer, up
+    to hedges duplicates. The first answer wins and the other requests
+    are cancelled.
+
+    :param start callable: Coroutine function starting a request
+    :param delay float: Seconds before a duplicate, None for no duplicates
+    :param hedges int: Maximum duplicates
+    :return: The first answer
+    :raises Exception: The first error, if every request failed
+    """
+    tasks = {asyncio.ensure_future(start())}
+    started = 1
+    error: Optional[BaseException] = None
+    try:
+        while tasks:
+            timeout = delay if started <= hedges else None
+            done, tasks = await asyncio.wait(
+                tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                print_(f'No answer after {delay}s, hedging')
+                tasks.add(asyncio.ensure_future(start()))
+                started += 1
+                continue
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+        assert error is not None
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+class Hedging():
+    """
+    Hedging of slow idempotent requests
+
+    Latencies are kept per command, a SCAN of a large file saying
+    nothing about how long a PING should take.
+    """
+    hedge_quantile: Optional[float] = None
+    hedge_min_samples = 20
+    max_hedges = 1
+    latencies: Dict[str, LatencyWindow]
+
+    def set_hedging(self,
+        quantile: Optional[float] = 0.95,
+        min_samples: int = 20,
+        max_hedges: int = 1) -> None:
+        """
+        Send a duplicate of slow idempotent requests
+
+        A duplicate is sent when no reply arrived within the given latency
+        quantile of recent requests of the same command, and the first
+        reply wins. Streams, FILDES, directory scans, RELOAD and SHUTDOWN
+        are never duplicated.
+
+        :param quantile float: Latency quantile to wait for, None to disable hedging
+        :param min_samples int: Requests measured before hedging starts
+        :param max_hedges int: Maximum duplicates of a request
+        """
+        self.hedge_quantile = quantile
+        self.hedge_min_samples = min_samples
+        self.max_hedges = max_hedges
+
+    def latency(self, command: str) -> LatencyWindow:
+        """
+        Get the recent latencies of a command
+
+        :param command str: e.g. SCAN
+        :rtype: LatencyWindow
+        """
+        window = self.latencies.get(command)
+        if window is None:
+            window = self.latencies[command] = LatencyWindow()
+        return window
+
+    def hedge_delay(self, command: str) -> Optional[float]:
+        """
+        Get the time to wait before sending a duplicate
+
+        :param command str: e.g. SCAN
+        :return: Seconds, None when not hedging
+        :rtype: float
+        """
+        window = self.latencies.get(command)
+        if self.hedge_quantile is None or window is None or len(window) < self.hedge_min_samples:
+            return None
+        return window.quantile(self.hedge_quantile)
+
+    async def hedged(self, command: str, request: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run a request, hedging it when it is slow
+
+        :param command str: e.g. SCAN, the latencies it is measured against
+        :param request callable: Coroutine function sending the request on its own connection
+        :return: The first answer
+        """
+        loop = asyncio.get_running_loop()
+        window = self.latency(command)
+
+        async def attempt() -> Any:
+            started = loop.time()
+            answer = await request()
+            window.record(loop.time() - started)
+            return answer
+
+        return await first_of(attempt, self.hedge_delay(command), self.max_hedges)
@@ -0,0 +1,247 @@
+""" clamd load and adaptive concurrency """
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from .fork import ForkSafe
+
+class ServerStats():
+    """
+    Load of a clamd, parsed from its STATS reply
+
+    Thread and queue counts are summed over all thread pools.
+    """
+    # pylint: disable=too-many-instance-attributes
+    __slots__ = ('pools', 'state', 'threads_live', 'threads_idle', 'threads_max',
+        'queue', 'queue_wait', 'tasks', 'memory')
+
+    def __init__(self) -> None:
+        """ ServerStats Constructor """
+        self.pools = 0
+        self.state = ''
+        self.threads_live = 0
+        self.threads_idle = 0
+        self.threads_max = 0
+        self.queue = 0
+        self.queue_wait = 0.0
+        self.tasks: List[Tuple[str, float, str]] = []
+        self.memory: Dict[str, float] = {}
+
+    @property
+    def threads_busy(self) -> int:
+        """ Threads working on a request """
+        return self.threads_live - self.threads_idle
+
+    @property
+    def threads_free(self) -> int:
+        """ Requests clamd can take before queueing them """
+        return max(0, self.threads_max - self.threads_busy)
+
+    def __repr__(self) -> str:
+        return (f'ServerStats(threads {self.threads_busy}/{self.threads_max}, '
+            f'queue {self.queue}, {self.state})')
+
+def parse_stats(data: str) -> ServerStats:
+    """
+    Parse the reply to a STATS command::
+
+        POOLS: 1
+
+        STATE: VALID PRIMARY
+        THREADS: live 2  idle 0 max 10 idle-timeout 30
+        QUEUE: 1 items
+            min_wait: 0.000012 max_wait: 0.000012 avg_wait: 0.000012
+
+            SCAN 0.001203 /srv/uploads/report.pdf
+            STATS 0.000052
+
+        MEMSTATS: heap 9.082M mmap 0.000M used 6.902M free 2.184M ...
+        END
+
+    :param data str: STATS reply
+    :return: The parsed stats
+    :rtype: ServerStats
+    :raises ValueError: If the reply has no thread pool
+    """
+    stats = ServerStats()
+    for line in data.splitlines():
+        name, _, value = line.strip().partition(' ')
+        fields = value.split()
+        if name == 'POOLS:':
+            stats.pools = int(value)
+        elif name == 'STATE:':
+            stats.state = stats.state or value.strip()
+        elif name == 'THREADS:':
+            # live 2  idle 0 max 10 idle-timeout 30
+            counts = dict(zip(fields[::2], fields[1::2]))
+            stats.threads_live += int(counts.get('live', 0))
+            stats.threads_idle += int(counts.get('idle', 0))
+            stats.threads_max += int(counts.get('max', 0))
+        elif name == 'QUEUE:':
+            stats.queue += int(fields[0])
+        elif name == 'min_wait:':
+            stats.queue_wait = max(stats.queue_wait, float(fields[2]))
+        elif name == 'MEMSTATS:':
+            for key, amount in zip(fields[::2], fields[1::2]):
+                if amount.endswith('M'):
+                    stats.memory[key] = float(amount[:-1])
+        elif line.startswith('\t') and name and name != 'END':
+            # a request being processed: command, seconds, file
+            seconds, _, path = value.partition(' ')
+            stats.tasks.append((name, float(seconds), path.strip()))
+    if not stats.pools and not stats.threads_max:
+        raise ValueError('Not a STATS reply')
+    return stats
+
+class ConcurrencyLimiter(ForkSafe):
+    """
+    Adaptive cap on the requests in flight to one clamd
+
+    The limit follows the gradient between the lowest latency seen and
+    the latest one: it grows by about its square root while latency
+    stays within tolerance of that baseline, and shrinks once requests
+    start queueing. Failures cut it multiplicatively, and so does a
+    queue reported by clamd STATS, which also caps it at MaxThreads.
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+        initial: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        tolerance: float = 1.5,
+        backoff: float = 0.9,
+        smoothing: float = 0.2,
+        stats_interval: Optional[float] = 5.0):
+        """
+        ConcurrencyLimiter Constructor
+
+        :param initial int: Starting limit
+        :param min_limit int: Lowest limit
+        :param max_limit int: Highest limit
+        :param tolerance float: Latency over the baseline, as a ratio, still
+            considered free of queueing
+        :param backoff float: Factor applied to the limit on failures
+        :param smoothing float: Weight of each latency sample
+        :param stats_interval float: Seconds between STATS queries, None to never query
+        :raises ValueError: If the limits are inconsistent
+        """
+        if not 1 <= min_limit <= initial <= max_limit:
+            raise ValueError(
+                f'Invalid limits: min {min_limit}, initial {initial}, max {max_limit}'
+            )
+        super().__init__()
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.ceiling = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.stats_interval = stats_interval
+        self.stats: Optional[ServerStats] = None
+        self.checked = 0.0
+        self.baseline: Optional[float] = None
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def current(self) -> int:
+        """ Requests allowed in flight """
+        return max(self.min_limit, min(int(self.limit), self.ceiling))
+
+    def after_fork(self) -> None:
+        """ Forget the parent's requests in flight, the limit learnt is kept """
+        self.in_flight = 0
+        self._waiters = deque()
+
+    def _wake(self) -> None:
+        """ Hand free slots to waiting requests """
+        while self._waiters and self.in_flight < self.current:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self) -> None:
+        """ Wait until a request may be sent """
+        self.check_fork()
+        if self.in_flight < self.current and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over as the wait was cancelled
+                self.in_flight -= 1
+                self._wake()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, latency: Optional[float] = None, dropped: bool = False) -> None:
+        """
+        Record the outcome of a request and free its slot
+
+        :param latency float: Seconds the request took, None if it did not complete
+        :param dropped bool: The request failed for lack of capacity, e.g. a timeout
+        """
+        self.in_flight -= 1
+        if dropped:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif latency is not None:
+            self.update(latency)
+        self._wake()
+
+    def update(self, latency: float) -> None:
+        """
+        Adjust the limit to a latency sample
+
+        :param latency float: Seconds a request took
+        """
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            # drift up slowly so a clamd that got slower for good is followed
+            self.baseline += (latency - self.baseline) * 0.001
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline / max(latency, 1e-9)))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        if target > self.limit and self.in_flight + 1 < self.limit / 2:
+            # far from the limit, latency says nothing about more requests
+            return
+        limit = self.limit * (1 - self.smoothing) + target * self.smoothing
+        self.limit = max(self.min_limit, min(limit, self.ceiling))
+
+    def stats_due(self) -> bool:
+        """
+        Check if clamd STATS should be queried, claiming the query
+
+        :rtype: bool
+        """
+        now = time.monotonic()
+        if self.stats_interval is None or now - self.checked < self.stats_interval:
+            return False
+        self.checked = now
+        return True
+
+    def observe(self, stats: ServerStats) -> None:
+        """
+        Adjust the limit to the load clamd reports
+
+        :param stats ServerStats: Parsed STATS reply
+        """
+        self.stats = stats
+        if stats.threads_max:
+            self.ceiling = max(self.min_limit, min(self.max_limit, stats.threads_max))
+        self.limit = min(self.limit, self.ceiling)
+        if stats.queue:
+            # clamd is queueing, more requests would only wait longer
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        self._wake()
+
+    def __repr__(self) -> str:
+        return f'ConcurrencyLimiter({self.in_flight}/{self.current})'
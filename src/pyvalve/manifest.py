@@ -0,0 +1,353 @@
+""" Manifest of scanned files, for incremental scans """
+import asyncio
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+)
+from .cache import SqliteDatabase
+
+# Size, modification time in nanoseconds and inode of a file
+FileStat = Tuple[int, int, int]
+
+def manifest_key(path: str) -> bytes:
+    """
+    Key of a file in the manifest
+
+    :param path str: File path
+    :return: The absolute path, as bytes since paths may not decode
+    :rtype: bytes
+    """
+    return os.fsencode(os.path.abspath(path))
+
+class ScanManifest():
+    """
+    On disk record of the files scanned and their verdicts
+
+    Each file is stored with its size, modification time, inode, content
+    digest and the signature version of its verdict. A file is scanned
+    again when any of them changes. Rows are looked up by path as the
+    walk goes, nothing is loaded upfront, so opening a manifest of tens
+    of millions of files is immediate.
+
+    New files are not hashed before they are scanned. Their digest is
+    taken from the stream sent to clamd when there is one, see
+    stream_hasher, and otherwise computed when their verdict is written.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+        path: str,
+        digests: bool = True,
+        batch_size: int = 1000,
+        workers: int = 8):
+        """
+        ScanManifest Constructor
+
+        :param path str: Database file
+        :param digests bool: Hash files whose size or time changed, and skip
+            them if the content is the same. New files are hashed too
+        :param batch_size int: Files checked or recorded per query batch
+        :param workers int: Files hashed in parallel
+        """
+        self.path = path
+        self.digests = digests
+        self.batch_size = batch_size
+        self.workers = workers
+        self.database = SqliteDatabase(path)
+        db = self.database.db
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS files (path BLOB PRIMARY KEY, size INTEGER, '
+            'mtime INTEGER, inode INTEGER, digest BLOB, version TEXT, verdict TEXT, '
+            'run INTEGER) WITHOUT ROWID'
+        )
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = db.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()
+        self.run = int(row[0]) if row else 0
+        self.version: Optional[str] = None
+        self.pending: Dict[str, Tuple[FileStat, Optional[bytes]]] = {}
+        self.results: List[Tuple[str, FileStat, Optional[bytes], str]] = []
+
+    async def start(self, version: Optional[str]) -> None:
+        """
+        Start a scan
+
+        :param version str: Signature version reported by clamd, files
+            scanned with another version are scanned again. None if unknown
+        """
+        def begin(db: sqlite3.Connection) -> None:
+            db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('run', ?)", (self.run + 1,)
+            )
+        await self.database.execute(begin)
+        self.run += 1
+        self.version = version
+
+    def hasher(self) -> Any:
+        """
+        Create the hash of file contents
+
+        :return: A hashlib object
+        """
+        return hashlib.blake2b(digest_size=32)
+
+    def digest(self, path: str, stat: FileStat) -> Optional[bytes]:
+        """
+        Hash the content of a file, blocking
+
+        :param path str: The file
+        :param stat tuple: Size, time and inode the file is recorded with
+        :return: The digest, None if the file can not be read or does
+            not match stat, e.g. it changed since it was scanned
+        :rtype: bytes
+        """
+        def current(file: Any) -> FileStat:
+            info = os.fstat(file.fileno())
+            return info.st_size, info.st_mtime_ns, info.st_ino
+        try:
+            with open(path, 'rb') as file:
+                if current(file) != stat:
+                    return None
+                digest = hashlib.file_digest(file, self.hasher).digest()
+                return digest if current(file) == stat else None
+        except OSError:
+            return None
+
+    def digest_many(self, files: List[Tuple[str, FileStat]]) -> List[Optional[bytes]]:
+        """
+        Hash files in a thread pool, blocking
+
+        :param files list: Path and stat pairs, as taken by digest
+        :return: The digests, in order
+        :rtype: list
+        """
+        if len(files) < 2 or self.workers < 2:
+            return [self.digest(path, stat) for path, stat in files]
+        with ThreadPoolExecutor(min(self.workers, len(files))) as executor:
+            return list(executor.map(lambda file: self.digest(*file), files))
+
+    def compare(self, paths: List[str]) -> Tuple[
+        List[Tuple[str, FileStat, Optional[bytes]]], List[Tuple[int, bytes]]]:
+        """
+        Compare a batch of files with their rows, blocking
+
+        :param paths list: File paths
+        :return: The new and changed files with their stat and known
+            digest, and the run and key of the unchanged files
+        :rtype: tuple
+        """
+        stats: List[Tuple[str, FileStat]] = []
+        for path in paths:
+            try:
+                info = os.stat(path)
+            except OSError:
+                # gone since the walk
+                continue
+            stats.append((path, (info.st_size, info.st_mtime_ns, info.st_ino)))
+
+        changed: List[Tuple[str, FileStat, Optional[bytes]]] = []
+        seen: List[Tuple[int, bytes]] = []
+        database = self.database
+        with database.lock:
+            for path, stat in stats:
+                key = manifest_key(path)
+                row = database.db.execute(
+                    'SELECT size, mtime, inode, digest, version FROM files WHERE path = ?', (key,)
+                ).fetchone()
+                if row is None or row[4] != self.version:
+                    changed.append((path, stat, None))
+                elif row[:3] == stat:
+                    seen.append((self.run, key))
+                else:
+                    changed.append((path, stat, row[3]))
+        return changed, seen
+
+    def check(self, paths: List[str]) -> List[str]:
+        """
+        Find the files to scan among a batch, blocking
+
+        Unchanged files are marked as seen by this run.
+
+        :param paths list: File paths
+        :return: The new and changed files
+        :rtype: list
+        """
+        changed, seen = self.compare(paths)
+        # only files with a known digest are hashed before scanning,
+        # new files are hashed from their scan
+        hashed = [(path, stat) for path, stat, known in changed if known is not None]
+        digests = dict(zip(hashed, self.digest_many(hashed))) if self.digests else {}
+        scan: List[str] = []
+        renewed: List[Tuple[int, int, int, int, bytes]] = []
+        for path, stat, known in changed:
+            digest = digests.get((path, stat))
+            if known is not None and digest == known:
+                # touched, the content is the same
+                renewed.append((*stat, self.run, manifest_key(path)))
+                continue
+            self.pending[path] = (stat, digest)
+            scan.append(path)
+
+        database = self.database
+        with database.lock:
+            database.db.execute('BEGIN')
+            database.db.executemany('UPDATE files SET run = ? WHERE path = ?', seen)
+            database.db.executemany(
+                'UPDATE files SET size = ?, mtime = ?, inode = ?, run = ? WHERE path = ?', renewed
+            )
+            database.db.execute('COMMIT')
+        return scan
+
+    async def changed(self, paths: AsyncIterable[str]) -> AsyncIterator[str]:
+        """
+        Filter the files to scan, in batches checked in a worker thread
+
+        :param paths: Async iterable of file paths, e.g. a walk_tree
+        :return: Async iterator of the new and changed files
+        """
+        self.database.check_fork()
+        batch: List[str] = []
+        try:
+            async for path in paths:
+                batch.append(path)
+                if len(batch) >= self.batch_size:
+                    for changed in await asyncio.to_thread(self.check, batch):
+                        yield changed
+                    batch = []
+            if batch:
+                for changed in await asyncio.to_thread(self.check, batch):
+                    yield changed
+        finally:
+            if hasattr(paths, 'aclose'):
+                await paths.aclose()
+
+    def stream_hasher(self, path: str) -> Any:
+        """
+        Create a hasher for the content of a file returned by changed,
+        updated while it is streamed to clamd
+
+        Pass the digest to streamed once the whole file was sent.
+
+        :param path str: The file
+        :return: A hashlib object, None if its digest is not needed
+        """
+        if not self.digests or self.pending[path][1] is not None:
+            return None
+        return self.hasher()
+
+    def streamed(self, path: str, digest: bytes, length: int) -> None:
+        """
+        Set the digest of a file computed from the content streamed
+
+        :param path str: A file returned by changed
+        :param digest bytes: Digest of the content sent to clamd
+        :param length int: Bytes sent, the digest is ignored unless it is
+            the size of the file, e.g. when clamd replied early
+        """
+        stat, _ = self.pending[path]
+        if length == stat[0]:
+            self.pending[path] = (stat, digest)
+
+    async def record(self, path: str, verdict: Optional[str]) -> None:
+        """
+        Record the verdict of a file returned by changed
+
+        :param path str: The file
+        :param verdict str: Response from clamav, None if the scan failed
+            and the file should be scanned again next time
+        """
+        stat, digest = self.pending.pop(path)
+        if verdict is None:
+            return
+        self.results.append((path, stat, digest, verdict))
+        if len(self.results) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """ Hash the files recorded without a digest, write the verdicts """
+        results, self.results = self.results, []
+        if not results:
+            return
+        if self.digests:
+            missing = [(path, stat) for path, stat, digest, _ in results if digest is None]
+            if missing:
+                digests = dict(zip(missing, await asyncio.to_thread(self.digest_many, missing)))
+                results = [(path, stat, digest or digests[path, stat], verdict)
+                    for path, stat, digest, verdict in results]
+        rows = [(manifest_key(path), *stat, digest, self.version, verdict, self.run)
+            for path, stat, digest, verdict in results]
+        await self.database.execute(lambda db: db.executemany(
+            'INSERT OR REPLACE INTO files '
+            '(path, size, mtime, inode, digest, version, verdict, run) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows
+        ))
+
+    async def prune(self, root: str) -> int:
+        """
+        Forget the files under a directory not seen by this run
+
+        Call it once the walk of the directory completed.
+
+        :param root str: The walked directory
+        :return: Number of files removed
+        :rtype: int
+        """
+        prefix = os.path.join(manifest_key(root), b'')
+        # every path starting with 'root/' sorts below 'root0'
+        bound = prefix[:-1] + b'0'
+        cursor = await self.database.execute(lambda db: db.execute(
+            'DELETE FROM files WHERE path >= ? AND path < ? AND run < ?',
+            (prefix, bound, self.run)
+        ))
+        return cursor.rowcount
+
+    async def infected(self) -> List[Tuple[str, str]]:
+        """
+        List the files whose last verdict found a signature
+
+        :return: Path and verdict pairs
+        :rtype: list
+        """
+        rows = await self.database.execute(lambda db: db.execute(
+            "SELECT path, verdict FROM files WHERE verdict LIKE '% FOUND'"
+        ).fetchall())
+        return [(os.fsdecode(path), verdict) for path, verdict in rows]
+
+    def close(self) -> None:
+        """ Close the database """
+        self.database.close()
+
+async def scan_incremental(
+    manifest: ScanManifest,
+    root: str,
+    version: Callable[[], Awaitable[Optional[str]]],
+    paths: AsyncIterable[str],
+    scan: Callable[[AsyncIterable[str]], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+    """
+    Scan the new and changed files of a walk, recording their verdicts
+
+    Files under the root that were not seen are forgotten once the walk
+    completes, they are scanned as new if they come back.
+
+    :param manifest ScanManifest: Record of the previous scans
+    :param root str: The walked directory
+    :param version callable: Coroutine function returning the signature version
+    :param paths: Async iterable of the file paths walked
+    :param scan callable: Function scanning an async iterable of paths,
+        returning an async iterator of BatchResult
+    :return: Async iterator of the BatchResult of the files scanned
+    """
+    await manifest.start(await version())
+    results = scan(manifest.changed(paths))
+    try:
+        async for outcome in results:
+            # failed scans are not recorded, the file is scanned next time
+            await manifest.record(outcome.item, outcome.result if outcome.ok else None)
+            yield outcome
+    finally:
+        if hasattr(results, 'aclose'):
+            await results.aclose()
+        await manifest.flush()
+    await manifest.prune(root)
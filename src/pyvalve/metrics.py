@@ -0,0 +1,369 @@
+""" Request instrumentation and latency histograms """
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Bucket bounds in seconds used when exporting to Prometheus
+PROMETHEUS_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+class Histogram():
+    """
+    Latency histogram with logarithmic buckets, as HDR histograms
+
+    Values are kept in microseconds. Below 2**precision each value has
+    its own bucket, above it every power of two is split in
+    2**(precision - 1) buckets, so quantiles are within about 3% of the
+    recorded values at any scale, for a fixed cost per power of two.
+    """
+    __slots__ = ('precision', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, precision: int = 5):
+        """
+        Histogram Constructor
+
+        :param precision int: Significant bits kept of each value
+        """
+        self.precision = precision
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max = 0.0
+
+    def index(self, micros: int) -> int:
+        """
+        Get the bucket of a value
+
+        :param micros int: Value in microseconds
+        :rtype: int
+        """
+        shift = micros.bit_length() - self.precision
+        if shift <= 0:
+            return micros
+        return (shift << (self.precision - 1)) + (micros >> shift)
+
+    def bounds(self, index: int) -> Tuple[int, int]:
+        """
+        Get the values held by a bucket
+
+        :param index int: The bucket
+        :return: Lowest value and the lowest value of the next bucket, in microseconds
+        :rtype: tuple
+        """
+        half = 1 << (self.precision - 1)
+        if index < half << 1:
+            return index, index + 1
+        shift = index // half - 1
+        mantissa = index - shift * half
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, seconds: float) -> None:
+        """
+        Record a value
+
+        :param seconds float: e.g. the latency of a request
+        """
+        index = self.index(max(0, int(seconds * 1e6)))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: 'Histogram') -> None:
+        """
+        Add the values of another histogram of the same precision
+
+        :param other Histogram: The histogram to add
+        """
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def quantile(self, fraction: float) -> Optional[float]:
+        """
+        Get a quantile
+
+        :param fraction float: e.g. 0.99
+        :return: Seconds, None without values
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        rank = max(1, round(fraction * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.bounds(index)[1] / 1e6, self.max)
+        return self.max
+
+    def cumulative(self,
+        bounds: Tuple[float, ...] = PROMETHEUS_BUCKETS) -> List[Tuple[float, int]]:
+        """
+        Count the values up to each bound
+
+        :param bounds tuple: Increasing bounds in seconds
+        :return: (bound, count) pairs, exact to the bucket width
+        :rtype: list
+        """
+        limits = [int(bound * 1e6) for bound in bounds]
+        counts = [0] * len(bounds)
+        for index, count in self.counts.items():
+            low = self.bounds(index)[0]
+            for position, limit in enumerate(limits):
+                if low <= limit:
+                    counts[position] += count
+        return list(zip(bounds, counts))
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the histogram
+
+        :return: count, sum, min, max and the p50, p90, p99 and p999 quantiles in seconds
+        :rtype: dict
+        """
+        return {
+            'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max,
+            'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99), 'p999': self.quantile(0.999),
+        }
+
+class Trace():
+    """
+    Progress of one request
+
+    Times are seconds since the request started, None until reached.
+    """
+    # pylint: disable=too-many-instance-attributes
+    __slots__ = ('metrics', 'command', 'endpoint', 'started', 'reused', 'connect',
+        'sent', 'first_byte', 'elapsed', 'bytes_sent', 'bytes_received', 'error')
+
+    def __init__(self, metrics: 'Metrics', command: str, endpoint: str):
+        """
+        Trace Constructor
+
+        :param metrics Metrics: Collector the request is reported to
+        :param command str: e.g. SCAN
+        :param endpoint str: The clamd
+        """
+        self.metrics = metrics
+        self.command = command
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.reused: Optional[bool] = None
+        self.connect: Optional[float] = None
+        self.sent: Optional[float] = None
+        self.first_byte: Optional[float] = None
+        self.elapsed: Optional[float] = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error: Optional[str] = None
+
+    def connected(self, reused: bool) -> None:
+        """
+        Record the request got a connection
+
+        :param reused bool: The connection was pooled
+        """
+        if self.connect is None:
+            self.reused = reused
+            self.connect = time.perf_counter() - self.started
+            self.metrics.emit('connect', self)
+
+    def wrote(self, count: int) -> None:
+        """
+        Count bytes sent
+
+        :param count int: Bytes
+        """
+        self.bytes_sent += count
+
+    def flushed(self) -> None:
+        """ Record the request was handed to the socket """
+        if self.sent is None:
+            self.sent = time.perf_counter() - self.started
+            self.metrics.emit('send', self)
+
+    def received(self, count: int) -> None:
+        """
+        Count bytes received, the first time marks the first byte
+
+        :param count int: Bytes
+        """
+        self.bytes_received += count
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter() - self.started
+            self.metrics.emit('first_byte', self)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """
+        Record the request completed
+
+        :param error Exception: What the request raised, if it failed
+        """
+        self.elapsed = time.perf_counter() - self.started
+        if error is not None:
+            self.error = type(error).__name__
+        self.metrics.record(self)
+        self.metrics.emit('complete', self)
+
+    def __repr__(self) -> str:
+        return f'Trace({self.command} on {self.endpoint}, {self.elapsed})'
+
+# Trace of the request running in the current context
+current_trace: ContextVar[Optional[Trace]] = ContextVar('pyvalve_trace', default=None)
+
+# pylint: disable=too-few-public-methods
+class CommandStats():
+    """ Totals of one command on one endpoint """
+    __slots__ = ('count', 'errors', 'connects', 'reused', 'bytes_sent',
+        'bytes_received', 'latency')
+
+    def __init__(self, precision: int = 5):
+        """
+        CommandStats Constructor
+
+        :param precision int: Significant bits of the latency histogram
+        """
+        self.count = 0
+        self.errors = 0
+        self.connects = 0
+        self.reused = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = Histogram(precision)
+
+class Metrics():
+    """
+    Collects traces of requests into per command and endpoint totals
+
+    Hooks are called with the event name, connect, send, first_byte or
+    complete, and the Trace.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, precision: int = 5):
+        """
+        Metrics Constructor
+
+        :param precision int: Significant bits of the latency histograms
+        """
+        self.precision = precision
+        self.hooks: List[Callable[[str, Trace], Any]] = []
+        self.stats: Dict[Tuple[str, str], CommandStats] = {}
+
+    def add_hook(self, hook: Callable[[str, Trace], Any]) -> None:
+        """
+        Call a function on every request event
+
+        :param hook callable: Function taking the event name and the Trace
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[str, Trace], Any]) -> None:
+        """
+        Stop calling a hook
+
+        :param hook callable: A hook passed to add_hook
+        """
+        self.hooks.remove(hook)
+
+    def start(self, command: str, endpoint: str) -> Trace:
+        """
+        Start tracing a request
+
+        :param command str: e.g. SCAN
+        :param endpoint str: The clamd
+        :rtype: Trace
+        """
+        return Trace(self, command, endpoint)
+
+    def emit(self, event: str, trace: Trace) -> None:
+        """
+        Call the hooks
+
+        :param event str: connect, send, first_byte or complete
+        :param trace Trace: The request
+        """
+        for hook in self.hooks:
+            hook(event, trace)
+
+    def record(self, trace: Trace) -> None:
+        """
+        Add a completed request to the totals
+
+        :param trace Trace: The request
+        """
+        key = (trace.command, trace.endpoint)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = CommandStats(self.precision)
+        stats.count += 1
+        if trace.error is not None:
+            stats.errors += 1
+        if trace.reused is not None:
+            stats.connects += 1
+            stats.reused += trace.reused
+        stats.bytes_sent += trace.bytes_sent
+        stats.bytes_received += trace.bytes_received
+        stats.latency.record(trace.elapsed or 0.0)
+
+    def reset(self) -> None:
+        """ Clear the totals """
+        self.stats = {}
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """
+        Get the totals, e.g. to send them to StatsD
+
+        :return: One dict per command and endpoint with the counters,
+            a latency summary and cumulative Prometheus buckets
+        :rtype: list
+        """
+        return [{
+            'command': command, 'endpoint': endpoint,
+            'count': stats.count, 'errors': stats.errors,
+            'connects': stats.connects, 'reused': stats.reused,
+            'bytes_sent': stats.bytes_sent, 'bytes_received': stats.bytes_received,
+            'latency': stats.latency.summary(),
+            'buckets': stats.latency.cumulative(),
+        } for (command, endpoint), stats in sorted(self.stats.items())]
+
+    def prometheus(self, prefix: str = 'pyvalve') -> str:
+        """
+        Format the totals in the Prometheus text exposition format
+
+        :param prefix str: Metric name prefix
+        :rtype: str
+        """
+        entries = self.snapshot()
+        labels = []
+        for entry in entries:
+            endpoint = entry['endpoint'].replace('\\', '\\\\').replace('"', '\\"')
+            labels.append(f'command="{entry["command"]}",endpoint="{endpoint}"')
+
+        # all samples of a family follow its TYPE line
+        name = f'{prefix}_request_seconds'
+        lines = [f'# TYPE {name} histogram']
+        for entry, label in zip(entries, labels):
+            for bound, count in entry['buckets']:
+                lines.append(f'{name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{label},le="+Inf"}} {entry["count"]}')
+            lines.append(f'{name}_sum{{{label}}} {entry["latency"]["sum"]}')
+            lines.append(f'{name}_count{{{label}}} {entry["count"]}')
+        for family, key in (
+                ('request_errors_total', 'errors'),
+                ('connections_reused_total', 'reused'),
+                ('sent_bytes_total', 'bytes_sent'),
+                ('received_bytes_total', 'bytes_received')):
+            lines.append(f'# TYPE {prefix}_{family} counter')
+            for entry, label in zip(entries, labels):
+                lines.append(f'{prefix}_{family}{{{label}}} {entry[key]}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,174 @@
+""" Pool of IDSESSION connections """
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque
+from .fork import ForkSafe
+from .metrics import current_trace
+from .protocol import PyvalveConnectionError
+from .connection import Connection
+
+class ConnectionPool(ForkSafe):
+    """
+    Bounded pool of reusable clamd session connections
+
+    A pool can be shared by any number of Pyvalve instances that talk
+    to the same clamd. In a forked child the pool starts over empty.
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+        factory: Callable[[], Awaitable[Connection]],
+        min_size: int = 0,
+        max_size: int = 10,
+        idle_timeout: float = 20.0,
+        max_lifetime: float = 300.0,
+        acquire_timeout: float = 10.0):
+        """
+        ConnectionPool Constructor
+
+        :param factory callable: Coroutine function returning a new session Connection
+        :param min_size int: Connections kept open even when idle
+        :param max_size int: Maximum number of open connections
+        :param idle_timeout float: Seconds an idle connection is kept.
+            Keep this below IdleTimeout in clamd.conf
+        :param max_lifetime float: Seconds before a connection is retired
+        :param acquire_timeout float: Seconds to wait for a free connection
+        :raises ValueError: If the sizes are inconsistent
+        """
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError(f'Invalid pool size: min {min_size}, max {max_size}')
+        super().__init__()
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.acquire_timeout = acquire_timeout
+        self.size = 0
+        self.closed = False
+        self._idle: Deque[Connection] = deque()
+        self._slots = asyncio.Semaphore(max_size)
+
+    @property
+    def idle(self) -> int:
+        """ Number of idle connections """
+        return len(self._idle)
+
+    def after_fork(self) -> None:
+        """ Forget the parent's connections, in use ones included """
+        self.size = 0
+        self._idle = deque()
+        # the parent's semaphore may be bound to its event loop
+        self._slots = asyncio.Semaphore(self.max_size)
+
+    def _expired(self, conn: Connection, now: float) -> bool:
+        """ Check if a connection should be retired """
+        if not conn.is_usable() or now - conn.created > self.max_lifetime:
+            return True
+        return self.size > self.min_size and now - conn.last_used > self.idle_timeout
+
+    async def _discard(self, conn: Connection) -> None:
+        """ Close a connection and forget about it """
+        self.size -= 1
+        await conn.close()
+
+    async def _prune(self) -> None:
+        """ Close the least recently used connections that expired """
+        now = time.monotonic()
+        while self._idle and self._expired(self._idle[0], now):
+            await self._discard(self._idle.popleft())
+
+    async def fill(self) -> None:
+        """ Open connections until min_size is reached """
+        self.check_fork()
+        while self.size < self.min_size and not self.closed:
+            conn = await self.factory()
+            self.size += 1
+            self._idle.append(conn)
+
+    async def acquire(self) -> Connection:
+        """
+        Take a connection out of the pool, opening one if needed
+
+        :return: A session connection
+        :rtype: Connection
+        :raises PyvalveConnectionError: If the pool is closed or no
+            connection became available within acquire_timeout
+        """
+        if self.closed:
+            raise PyvalveConnectionError('Connection pool is closed')
+        self.check_fork()
+        try:
+            # asyncio.timeout, unlike wait_for, never swallows a cancellation
+            async with asyncio.timeout(self.acquire_timeout):
+                await self._slots.acquire()
+        except TimeoutError as exc:
+            raise PyvalveConnectionError(
+                f'No connection available after {self.acquire_timeout}s'
+            ) from exc
+        try:
+            await self._prune()
+            now = time.monotonic()
+            while self._idle:
+                # LIFO keeps the hot connections busy and lets the rest idle out
+                conn = self._idle.pop()
+                if self._expired(conn, now):
+                    await self._discard(conn)
+                    continue
+                trace = current_trace.get()
+                if trace is not None:
+                    trace.connected(reused=True)
+                return conn
+            conn = await self.factory()
+            self.size += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, conn: Connection, discard: bool = False) -> None:
+        """
+        Return a connection to the pool
+
+        :param conn Connection: A connection obtained from acquire
+        :param discard bool: Close the connection instead of reusing it
+        """
+        self.check_fork()
+        conn.check_fork()
+        if conn.inherited:
+            # borrowed before the fork, its slot belongs to the parent
+            return
+        try:
+            now = time.monotonic()
+            conn.last_used = now
+            if discard or self.closed or self._expired(conn, now):
+                await self._discard(conn)
+            else:
+                self._idle.append(conn)
+                await self._prune()
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Connection]:
+        """
+        Borrow a connection for the duration of a with block
+
+        The connection is discarded if the block raises, as its
+        stream position is unknown.
+        """
+        conn = await self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            await self.release(conn, discard=True)
+            raise
+        await self.release(conn)
+
+    async def close(self) -> None:
+        """ Close all idle connections, in use ones are closed on release """
+        self.closed = True
+        while self._idle:
+            await self._discard(self._idle.popleft())
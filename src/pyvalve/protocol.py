@@ -0,0 +1,202 @@
+""" Replies of clamd and the errors raised on them """
+from typing import List, Dict, Optional, Tuple
+
+DEBUG = 0
+
+def print_(msg: str) -> None:
+    """
+        Debug print
+        :param str msg: The message
+    """
+    if DEBUG == 1:
+        print(msg)
+
+class PyvalveError(Exception):
+    """ Pyvalve exception base class """
+
+class PyvalveResponseError(PyvalveError):
+    """ Exception processing response """
+
+class PyvalveScanningError(PyvalveError):
+    """ Exception scanning. Could be path not found. """
+
+class PyvalveStreamMaxLength(PyvalveResponseError):
+    """
+    Exception using INSTREAM with a buffer
+    length > StreamMaxLength in /etc/clamav/clamd.conf
+    """
+
+class PyvalveConnectionError(PyvalveError):
+    """ Exception communicating with clamd """
+
+class PyvalveTimeout(PyvalveConnectionError):
+    """ Exception when clamd does not answer before the deadline """
+
+class ScanResult():
+    """ Verdict for a single scanned path """
+    __slots__ = ('path', 'status', 'signatures', 'reason')
+
+    OK = 'OK'
+    FOUND = 'FOUND'
+    ERROR = 'ERROR'
+
+    def __init__(self,
+        path: str,
+        status: str,
+        signatures: Tuple[str, ...] = (),
+        reason: str = ''):
+        """
+        ScanResult Constructor
+
+        :param path str: The scanned path, 'stream' for INSTREAM
+        :param status str: OK, FOUND or ERROR
+        :param signatures tuple: Names of the matched signatures
+        :param reason str: Error message from clamd
+        """
+        self.path = path
+        self.status = status
+        self.signatures = signatures
+        self.reason = reason
+
+    @property
+    def infected(self) -> bool:
+        """ True if a signature matched """
+        return self.status == ScanResult.FOUND
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ScanResult):
+            return NotImplemented
+        return (self.path, self.status, self.signatures, self.reason) == (
+            other.path, other.status, other.signatures, other.reason)
+
+    def __repr__(self) -> str:
+        detail = ', '.join(self.signatures) or self.reason
+        return f'ScanResult({self.path!r}, {self.status}{": " if detail else ""}{detail})'
+
+def _fsdecode(data: bytes) -> str:
+    """ Decode a path from clamd, keeping undecodable bytes """
+    return data.decode('utf-8', 'surrogateescape')
+
+def parse_result(line: bytes) -> ScanResult:
+    """
+    Parse a single clamd result line
+
+    :param line bytes: e.g. b'/tmp/eicar.com.txt: Win.Test.EICAR_HDB-1 FOUND'
+    :return: The parsed result
+    :rtype: ScanResult
+    """
+    if line.endswith(b' FOUND'):
+        # signature names never contain ': ', paths may
+        path, _, signature = line[:-6].rpartition(b': ')
+        return ScanResult(_fsdecode(path), ScanResult.FOUND, (signature.decode(),))
+    if line.endswith(b': OK'):
+        return ScanResult(_fsdecode(line[:-4]), ScanResult.OK)
+    if line.endswith(b' ERROR'):
+        line = line[:-6]
+    path, sep, reason = line.partition(b': ')
+    if not sep or path == b'ERROR':
+        return ScanResult('', ScanResult.ERROR, reason=_fsdecode(reason or line))
+    return ScanResult(_fsdecode(path), ScanResult.ERROR, reason=_fsdecode(reason))
+
+def parse_results(data: bytes) -> List[ScanResult]:
+    """
+    Parse the output of SCAN, CONTSCAN, MULTISCAN, ALLMATCHSCAN or INSTREAM
+
+    Consecutive ALLMATCHSCAN matches for a path are merged into one result.
+
+    :param data bytes: Raw response from clamav
+    :return: One result per path
+    :rtype: list
+    """
+    results: List[ScanResult] = []
+    last = None
+    for line in data.split(b'\n'):
+        line = line.strip(b'\0\r ')
+        if not line:
+            continue
+        result = parse_result(line)
+        if (last is not None and result.status == ScanResult.FOUND
+                and last.status == ScanResult.FOUND and last.path == result.path):
+            last.signatures += result.signatures
+            continue
+        results.append(result)
+        last = result
+    return results
+
+def index_results(results: List[ScanResult]) -> Dict[str, ScanResult]:
+    """
+    Index results by path
+
+    :param results list: Parsed results
+    :return: Results keyed by path
+    :rtype: dict
+    """
+    index: Dict[str, ScanResult] = {}
+    for result in results:
+        known = index.get(result.path)
+        if known is not None and known.status == result.status == ScanResult.FOUND:
+            known.signatures += result.signatures
+        else:
+            index[result.path] = result
+    return index
+
+def is_error_reply(data: bytes) -> bool:
+    """
+    Check if a response reports an error
+
+    Only the status at the end of a line counts, so paths containing
+    'ERROR' are not mistaken for errors.
+
+    :param data bytes: Raw response from clamav
+    :rtype: bool
+    """
+    data = data.rstrip(b'\0\r\n ')
+    return (data.endswith(b'ERROR') or data.startswith(b'ERROR')
+        or b'ERROR\n' in data)
+
+def check_reply(data: bytes) -> str:
+    """
+    Decode a reply, raising if clamd reports an error
+
+    :param data bytes: Raw response from clamav
+    :return: Response from clamav
+    :rtype: str
+    :raises PyvalveStreamMaxLength: If stream size limit exceeded
+    :raises PyvalveResponseError: If clamav responds with an error
+    """
+    data_dec = data.decode().strip()
+    if b'INSTREAM size limit exceeded' in data:
+        raise PyvalveStreamMaxLength(data_dec)
+    if is_error_reply(data):
+        raise PyvalveResponseError(data_dec)
+    if DEBUG:
+        print_(f'Received: {data_dec}')
+    return data_dec
+
+def signature_version(version: str) -> Optional[str]:
+    """
+    Extract the signature database version from a VERSION response
+
+    :param version str: e.g. 'ClamAV 1.0.0/26789/Mon Jan 30 08:17:46 2023'
+    :return: The signature version, None if clamd did not report one
+    :rtype: str
+    """
+    parts = version.split('/')
+    if len(parts) < 2 or not parts[1].strip().isdigit():
+        return None
+    return parts[1].strip()
+
+# Commands clamd accepts inside an IDSESSION
+SESSION_COMMANDS = frozenset(
+    ('PING', 'VERSION', 'STATS', 'SCAN', 'INSTREAM', 'FILDES')
+)
+
+# Commands that can be sent twice, for hedging. Directory scans are
+# left out, a duplicate would walk the whole tree again.
+HEDGED_COMMANDS = frozenset(('PING', 'VERSION', 'STATS', 'SCAN'))
+
+# Commands returning one result line per scanned file
+SCAN_COMMANDS = frozenset(('SCAN', 'CONTSCAN', 'MULTISCAN', 'ALLMATCHSCAN'))
+
+# Commands keeping a clamd thread busy, capped by the concurrency limiter
+LIMITED_COMMANDS = SCAN_COMMANDS | {'INSTREAM', 'FILDES'}
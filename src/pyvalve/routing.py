@@ -0,0 +1,433 @@
+""" Scans by path, and routing of a source to the cheapest of them and INSTREAM """
+import asyncio
+import os
+import shutil
+import stat
+import tempfile
+import time
+from io import BytesIO
+from typing import List, BinaryIO, AsyncIterator, Dict, Any, Optional, Tuple, Union
+from .protocol import (
+    DEBUG, print_, PyvalveResponseError, PyvalveScanningError, PyvalveConnectionError,
+    ScanResult, parse_result, parse_results, index_results, SCAN_COMMANDS
+)
+from .streams import FILE_CHUNK_SIZE, is_regular_file, remaining_length
+from .hedging import time_limit
+from .streaming import StreamingClient
+
+# pylint: disable=too-few-public-methods
+class RoutedScan():
+    """ Response of scan_auto, with the transport it picked """
+    __slots__ = ('route', 'response', 'size', 'elapsed')
+
+    def __init__(self,
+        route: str,
+        response: str,
+        size: Optional[int] = None,
+        elapsed: float = 0.0):
+        """
+        RoutedScan Constructor
+
+        :param route str: SCAN, FILDES, SPILL or INSTREAM
+        :param response str: Response from clamav
+        :param size int: Size of the scanned content, None if unknown
+        :param elapsed float: Seconds the scan took
+        """
+        self.route = route
+        self.response = response
+        self.size = size
+        self.elapsed = elapsed
+
+    def __repr__(self) -> str:
+        return (f'RoutedScan({self.route}, {self.response!r}, '
+            f'size={self.size}, elapsed={self.elapsed:.3f})')
+
+# Transports picked by scan_auto
+ROUTE_SCAN = 'SCAN'
+
+ROUTE_FILDES = 'FILDES'
+
+ROUTE_SPILL = 'SPILL'
+
+ROUTE_INSTREAM = 'INSTREAM'
+
+class RoutingClient(StreamingClient):  # pylint: disable=abstract-method
+    """ Path scans of a Pyvalve client, and the routes to them """
+    async def __init__(self):
+        """ Constructor """
+        await super().__init__()
+        self.shared_paths: Dict[str, str] = {}
+        self.spill_dir: Optional[str] = None
+        self.spill_min = 1 << 20
+        self.spill_mode = 0o640
+
+    async def scan(self, path: str) -> str:
+        """
+        Send scan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        if not await self.check_path(path):
+            raise PyvalveScanningError(f'Path not found: {path}')
+        return await self.send_command('SCAN', path)
+
+    async def contscan(self, path: str) -> str:
+        """
+        Send constscan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        if not await self.check_path(path):
+            raise PyvalveScanningError(f'Path not found: {path}')
+        return await self.send_command('CONTSCAN', path)
+
+    async def multiscan(self, path: str) -> str:
+        """
+        Send multiscan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        if not await self.check_path(path):
+            raise PyvalveScanningError(f'Path not found: {path}')
+        return await self.send_command('MULTISCAN', path)
+
+    async def allmatchscan(self, path: str) -> str:
+        """
+        Send allmatchscan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        if not await self.check_path(path):
+            raise PyvalveScanningError(f'Path not found: {path}')
+        return await self.send_command('ALLMATCHSCAN', path)
+
+    async def iter_scan(self,
+        path: str,
+        command: str = 'MULTISCAN') -> AsyncIterator[ScanResult]:
+        """
+        Scan a path and yield results as clamd reports them::
+
+            async for result in pv.iter_scan(path):
+                if result.infected:
+                    ...
+
+        Results are read line by line, so memory use does not grow with
+        the number of files. Leaving the loop early closes the connection,
+        which stops clamd. The call timeout applies to each result.
+
+        :param path str: Path to file/directory to be scanned
+        :param command str: SCAN, CONTSCAN, MULTISCAN or ALLMATCHSCAN
+        :return: Async iterator of ScanResult
+        :raises PyvalveScanningError: If path is not found
+        :raises PyvalveResponseError: If clamav rejects the command
+        """
+        if command not in SCAN_COMMANDS:
+            raise ValueError(f'Not a scan command: {command}')
+        if not await self.check_path(path):
+            raise PyvalveScanningError(f'Path not found: {path}')
+
+        async with time_limit(self.call_timeout):
+            conn = await self.open_connection()
+        try:
+            async with time_limit(self.call_timeout):
+                conn.send(f'n{command} {path}\n'.encode('utf-8'))
+                await conn.writer.drain()
+            # ALLMATCHSCAN reports each match on its own line
+            merge = command == 'ALLMATCHSCAN'
+            last = None
+            while True:
+                # the call timeout bounds the wait for each result
+                async with time_limit(self.call_timeout):
+                    line = await conn.reader.readline()
+                line = line.strip(b'\0\r\n ')
+                if not line:
+                    if conn.reader.at_eof():
+                        break
+                    continue
+                result = parse_result(line)
+                if not result.path:
+                    raise PyvalveResponseError(line.decode(errors='replace'))
+                if not merge:
+                    yield result
+                elif (last is not None and last.path == result.path
+                        and last.status == result.status == ScanResult.FOUND):
+                    last.signatures += result.signatures
+                else:
+                    if last is not None:
+                        yield last
+                    last = result
+            if last is not None:
+                yield last
+        finally:
+            await conn.close()
+
+    def iter_contscan(self, path: str) -> AsyncIterator[ScanResult]:
+        """
+        Send contscan command, yielding results as they arrive
+
+        :param path str: Path to file/directory to be scanned
+        :return: Async iterator of ScanResult
+        :raises PyvalveScanningError: If path is not found
+        """
+        return self.iter_scan(path, 'CONTSCAN')
+
+    def iter_multiscan(self, path: str) -> AsyncIterator[ScanResult]:
+        """
+        Send multiscan command, yielding results as they arrive
+
+        :param path str: Path to file/directory to be scanned
+        :return: Async iterator of ScanResult
+        :raises PyvalveScanningError: If path is not found
+        """
+        return self.iter_scan(path, 'MULTISCAN')
+
+    def iter_allmatchscan(self, path: str) -> AsyncIterator[ScanResult]:
+        """
+        Send allmatchscan command, yielding results as they arrive
+
+        :param path str: Path to file/directory to be scanned
+        :return: Async iterator of ScanResult
+        :raises PyvalveScanningError: If path is not found
+        """
+        return self.iter_scan(path, 'ALLMATCHSCAN')
+
+    async def scan_results(self,
+        path: str,
+        command: str = 'SCAN') -> List[ScanResult]:
+        """
+        Scan a path and parse the response
+
+        Unlike scan(), a file clamd could not read does not raise,
+        it is reported as a result with status ERROR.
+
+        :param path str: Path to file/directory to be scanned
+        :param command str: SCAN, CONTSCAN, MULTISCAN or ALLMATCHSCAN
+        :return: One result per path
+        :rtype: list
+        :raises PyvalveScanningError: If path is not found
+        :raises PyvalveResponseError: If clamav rejects the command
+        """
+        if command not in SCAN_COMMANDS:
+            raise ValueError(f'Not a scan command: {command}')
+        if not await self.check_path(path):
+            raise PyvalveScanningError(f'Path not found: {path}')
+        data = await self.send_raw_command(command, path)
+        results = parse_results(data)
+        if not results or not results[0].path:
+            raise PyvalveResponseError(data.decode().strip())
+        return results
+
+    async def scan_index(self,
+        path: str,
+        command: str = 'SCAN') -> Dict[str, ScanResult]:
+        """
+        Scan a path and index the results by path
+
+        :param path str: Path to file/directory to be scanned
+        :param command str: SCAN, CONTSCAN, MULTISCAN or ALLMATCHSCAN
+        :return: Results keyed by path
+        :rtype: dict
+        :raises PyvalveScanningError: If path is not found
+        :raises PyvalveResponseError: If clamav rejects the command
+        """
+        return index_results(await self.scan_results(path, command))
+
+    async def scan_fd(self, fileobj: Union[int, BinaryIO]) -> str:
+        """
+        Scan an open file with FILDES, only possible on a local unix socket
+
+        :param fileobj: An open file object or file descriptor
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveConnectionError: As clamd is not local
+        """
+        raise PyvalveConnectionError(f'FILDES needs a local clamd, not {self.endpoint}')
+
+    def set_routing(self,
+        shared_paths: Optional[Dict[str, str]] = None,
+        spill_dir: Optional[str] = None,
+        spill_min: int = 1 << 20,
+        spill_mode: int = 0o640) -> None:
+        """
+        Configure how scan_auto reaches clamd
+
+        Spilled files are made readable by clamd with spill_mode, so
+        clamd should be in the group of this process rather than the
+        files being readable by every user. A local clamd gets spilled
+        files with FILDES and they stay private.
+
+        :param shared_paths dict: Local path prefixes clamd can read, mapped
+            to the same directory as clamd sees it
+        :param spill_dir str: Directory shared with clamd, ideally a tmpfs,
+            where large in memory content is written and scanned by path
+        :param spill_min int: Smallest content in bytes worth spilling
+        :param spill_mode int: Permissions of spilled files
+        """
+        self.shared_paths = {
+            os.path.abspath(local): remote for local, remote in (shared_paths or {}).items()
+        }
+        self.spill_dir = spill_dir
+        self.spill_min = spill_min
+        self.spill_mode = spill_mode
+
+    def shared_path(self, path: str) -> Optional[str]:
+        """
+        Translate a local path to the path clamd sees
+
+        :param path str: Local path
+        :return: The path for clamd, None if clamd can not read it
+        :rtype: str
+        """
+        path = os.path.abspath(path)
+        for local in sorted(self.shared_paths, key=len, reverse=True):
+            if path == local or path.startswith(local.rstrip('/') + '/'):
+                return self.shared_paths[local].rstrip('/') + path[len(local.rstrip('/')):]
+        return None
+
+    def route(self, source: Any) -> Tuple[str, Optional[int]]:
+        """
+        Pick the cheapest transport for scan_auto
+
+        Paths clamd can read are scanned in place, and open files are
+        passed to a local clamd. Large content is written to the spill
+        directory, small content and everything else is streamed.
+
+        :param source: A path, bytes, or a buffer object
+        :return: The route and the content size, None if unknown
+        :rtype: tuple
+        :raises OSError: If the path can not be read
+        :raises PyvalveScanningError: If the path is a directory clamd can not read
+        """
+        if isinstance(source, (str, os.PathLike)):
+            path = os.fspath(source)
+            info = os.stat(path)
+            if self.shared_path(path) is not None:
+                return ROUTE_SCAN, info.st_size
+            if stat.S_ISDIR(info.st_mode):
+                raise PyvalveScanningError(f'Directory not on a shared path: {path}')
+            return (ROUTE_FILDES if self.local else ROUTE_INSTREAM), info.st_size
+        size: Optional[int]
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            size = memoryview(source).nbytes
+        else:
+            if self.local and is_regular_file(source):
+                return ROUTE_FILDES, remaining_length(source)
+            size = remaining_length(source)
+        if self.spill_dir is not None and size is not None and (
+                size >= self.spill_min or not self.accepts_stream(size)):
+            return ROUTE_SPILL, size
+        return ROUTE_INSTREAM, size
+
+    async def scan_auto(self, source: Any) -> RoutedScan:
+        """
+        Scan a path, bytes or a buffer over the cheapest transport::
+
+            result = await pv.scan_auto('/srv/uploads/file')
+            print(result.route, result.response)
+
+        Responses read like the ones of scan for paths, and of instream
+        for content. Buffers are closed.
+
+        :param source: A path, bytes, or a stream source as taken by instream
+        :return: The response and the route taken
+        :rtype: RoutedScan
+        :raises PyvalveScanningError: If the path is not found
+        :raises PyvalveResponseError: If clamav responds with an error
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        started = time.perf_counter()
+        try:
+            route, size = self.route(source)
+        except OSError as exc:
+            raise PyvalveScanningError(f'Path not found: {source}') from exc
+        if DEBUG:
+            print_(f'Route {route} for {size} bytes')
+
+        if isinstance(source, (str, os.PathLike)):
+            path = os.fspath(source)
+            if route == ROUTE_SCAN:
+                remote = self.shared_path(path) or path
+                response = await self.send_command('SCAN', remote)
+                if response.startswith(remote):
+                    response = path + response[len(remote):]
+            elif route == ROUTE_FILDES:
+                with open(path, 'rb') as file:
+                    response = await self.scan_fd(file)
+                # clamd names the file fd[<n>]
+                response = f"{path}: {response.partition(': ')[2]}"
+            else:
+                response = await self.instream_file(path)
+        elif route == ROUTE_SPILL:
+            response = await self.spill(source)
+        elif route == ROUTE_FILDES:
+            with source:
+                response = await self.scan_fd(source)
+            response = f"stream: {response.partition(': ')[2]}"
+        else:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                source = BytesIO(source)
+            response = await self.instream(source)
+        return RoutedScan(route, response, size, time.perf_counter() - started)
+
+    async def spill(self, source: Any) -> str:
+        """
+        Write content to the spill directory and scan it by path
+
+        The file gets the spill_mode permissions, clamd usually running as
+        another user. A local clamd is passed the file with FILDES instead,
+        and the file stays readable by this user only.
+
+        :param source: bytes, or a buffer object
+        :return: Response from clamav, reading like an instream response
+        :rtype: str
+        :raises PyvalveResponseError: If clamav responds with an error
+        """
+        spill_dir = self.spill_dir or tempfile.gettempdir()
+
+        def write() -> Tuple[int, str]:
+            handle, path = tempfile.mkstemp(prefix='pyvalve-', dir=spill_dir)
+            try:
+                with os.fdopen(handle, 'wb', closefd=False) as file:
+                    if isinstance(source, (bytes, bytearray, memoryview)):
+                        file.write(source)
+                    else:
+                        with source:
+                            shutil.copyfileobj(source, file, FILE_CHUNK_SIZE)
+                if self.local:
+                    os.lseek(handle, 0, os.SEEK_SET)
+                else:
+                    os.fchmod(handle, self.spill_mode)
+            except BaseException:
+                os.close(handle)
+                os.unlink(path)
+                raise
+            return handle, path
+
+        def remove(handle: int, path: str) -> None:
+            os.close(handle)
+            os.unlink(path)
+
+        handle, path = await asyncio.to_thread(write)
+        try:
+            if self.local:
+                response = await self.scan_fd(handle)
+                return f"stream: {response.partition(': ')[2]}"
+            remote = self.shared_path(path) or path
+            response = await self.send_command('SCAN', remote)
+        finally:
+            await asyncio.to_thread(remove, handle, path)
+        if response.startswith(remote):
+            response = 'stream' + response[len(remote):]
+        return response
@@ -0,0 +1,285 @@
+""" Pipelined IDSESSION requests """
+import asyncio
+from typing import Any, BinaryIO, Dict, Optional, Tuple, Union, TYPE_CHECKING
+from .metrics import current_trace
+from .protocol import (
+    DEBUG, print_, PyvalveError, PyvalveResponseError, PyvalveScanningError,
+    PyvalveStreamMaxLength, PyvalveConnectionError, check_reply
+)
+from .streams import StreamSource, open_file, remaining_length
+from .hedging import time_limit
+from .connection import Connection
+
+if TYPE_CHECKING:
+    from . import Pyvalve
+
+class Session():
+    """
+    Pipelined clamd IDSESSION
+
+    Requests are written back to back on one connection. clamd processes
+    them in parallel and replies as results become available, replies
+    are matched to the waiting callers by request id.
+    """
+    def __init__(self,
+        client: 'Pyvalve',
+        conn: Connection,
+        max_pending: int = 32):
+        """
+        Session Constructor
+
+        :param client Pyvalve: Client used for path checks and stream settings
+        :param conn Connection: Connection carrying the session
+        :param max_pending int: Maximum requests in flight.
+            Keep this below MaxQueue in clamd.conf
+        """
+        self.client = client
+        self.conn = conn
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.error: Optional[PyvalveError] = None
+        self._slots = asyncio.Semaphore(max_pending)
+        self._write_lock = asyncio.Lock()
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """ Start the session and the reply reader """
+        if not self.conn.session:
+            await self.conn.start_session()
+        self._reader = asyncio.create_task(self._read_replies())
+
+    async def stop(self) -> None:
+        """ Wait for the requests in flight, then stop reading replies """
+        if self.pending:
+            await asyncio.gather(*self.pending.values(), return_exceptions=True)
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+
+    async def _read_replies(self) -> None:
+        """ Resolve pending requests as their replies arrive """
+        try:
+            while True:
+                request_id, reply = await self.conn.read_session_reply()
+                future = self.pending.pop(request_id, None)
+                if future is None:
+                    raise PyvalveResponseError(
+                        f'Reply for unknown request {request_id}: {reply!r}'
+                    )
+                if not future.done():
+                    future.set_result(reply)
+        except Exception as exc: # pylint: disable=broad-except
+            self._fail(exc)
+
+    def _fail(self, exc: BaseException) -> PyvalveError:
+        """
+        Fail all requests in flight, the session can not be used anymore
+
+        :param exc Exception: The cause
+        :return: The error requests fail with
+        :rtype: PyvalveError
+        """
+        if self.error is None:
+            self.error = PyvalveConnectionError(f'Session failed: {exc}')
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(self.error)
+        self.pending.clear()
+        return self.error
+
+    async def request(self,
+        msg: str,
+        *args: str,
+        buffer: Optional[StreamSource] = None,
+        fd: Optional[int] = None) -> str:
+        """
+        Send a command in the session
+
+        :param str msg: The command
+        :param list args: Command arguments
+        :param buffer: Data to stream after an INSTREAM command, see instream
+        :param fd int: File descriptor to pass after a FILDES command
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveConnectionError: If the session is broken
+        :raises PyvalveResponseError: If clamav responds with an error
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        jargs = ''
+        if args:
+            jargs = ' ' + ' '.join(args)
+
+        hasher = None
+        if buffer is not None:
+            self.client.check_stream_length(remaining_length(buffer))
+            await self.client.refresh_cache_version()
+            hasher = self.client.stream_hasher()
+
+        async with (self._slots, time_limit(self.client.call_timeout),
+                self.client.traced(msg), self.client.limited(msg)):
+            trace = current_trace.get()
+            if trace is not None:
+                trace.connected(reused=True)
+            future, cached, streamed = await self._send(
+                f'z{msg}{jargs}\0'.encode('utf-8'), buffer, fd, hasher
+            )
+            if cached is not None:
+                # the stream was terminated to keep the session in sync, its
+                # reply is still owed: the future stays pending so stop()
+                # waits for it, and its result is dropped
+                future.add_done_callback(lambda done: done.cancelled() or done.exception())
+                if DEBUG:
+                    print_(f'Cached: {cached}')
+                return cached
+            try:
+                data = await future
+            except asyncio.CancelledError:
+                # e.g. a deadline: the reply would be read by the next
+                # user of the connection, which is dropped instead
+                self._fail(PyvalveConnectionError('Request cancelled while waiting for its reply'))
+                raise
+            if trace is not None:
+                trace.received(len(data))
+
+        if b'INSTREAM size limit exceeded' in data:
+            self.client.learn_stream_max_length(streamed)
+        elif hasher is not None:
+            await self.client.cache_verdict(hasher.digest(), data)
+        return check_reply(data)
+
+    async def _send(self,
+        message: bytes,
+        buffer: Optional[StreamSource],
+        fd: Optional[int],
+        hasher: Any) -> Tuple[asyncio.Future, Optional[str], int]:
+        """
+        Write a request, with its stream or file descriptor
+
+        Requests are written one at a time, a request that can not be
+        written whole fails the session.
+
+        :param message bytes: The command
+        :param buffer: Data to stream after the command
+        :param fd int: File descriptor to pass after the command
+        :param hasher: Hash of the stream, for the verdict cache
+        :return: The future of the reply, the cached verdict if the
+            stream was answered from the cache, and the bytes streamed
+        :rtype: tuple
+        """
+        cached = None
+        streamed = 0
+        async with self._write_lock:
+            if self.error is not None:
+                raise self.error
+            request_id = self.conn.send(message)
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                if fd is not None:
+                    await self.conn.writer.drain()
+                    await self.conn.send_fd(fd)
+                if buffer is not None:
+                    completed, cached = await self.client.write_stream(
+                        self.conn, buffer, future, hasher
+                    )
+                    if not completed:
+                        # the rest of the stream would be read as new commands
+                        self._fail(PyvalveConnectionError('Stream interrupted by clamd'))
+                streamed = self.conn.streamed
+                await self.conn.flush()
+            except PyvalveStreamMaxLength as exc:
+                self._fail(exc)
+                raise
+            except asyncio.CancelledError:
+                # a partly written request leaves the session out of sync
+                self._fail(PyvalveConnectionError('Request cancelled while writing'))
+                raise
+            except (OSError, PyvalveError) as exc:
+                error = self._fail(exc)
+                if not future.done():
+                    raise error from exc
+        return future, cached, streamed
+
+    async def ping(self) -> str:
+        """
+        Send ping command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.request('PING')
+
+    async def version(self) -> str:
+        """
+        Send version command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.request('VERSION')
+
+    async def stats(self) -> str:
+        """
+        Send stats command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return await self.request('STATS')
+
+    async def scan(self, path: str) -> str:
+        """
+        Send scan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        if not await self.client.check_path(path):
+            raise PyvalveScanningError(f'Path not found: {path}')
+        return await self.request('SCAN', path)
+
+    async def instream(self, buffer: StreamSource) -> str:
+        """
+        Send a stream to clamav
+
+        :param buffer: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveConnectionError: If the session is broken
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        return await self.request('INSTREAM', buffer=buffer)
+
+    async def instream_file(self, path: str) -> str:
+        """
+        Send a file on disk to clamav
+
+        :param path str: Path to the file
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If the file can not be opened
+        :raises PyvalveConnectionError: If the session is broken
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        # the stream closes the file too, unless it is refused beforehand
+        with open_file(path) as file:
+            return await self.instream(file)
+
+    async def scan_fd(self, fileobj: Union[int, BinaryIO]) -> str:
+        """
+        Scan an open file with FILDES, the session must be on a unix socket
+
+        :param fileobj: An open file object or file descriptor
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveConnectionError: If the session is broken
+        :raises PyvalveResponseError: If clamav responds with an error
+        """
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        return await self.request('FILDES', fd=fd)
@@ -0,0 +1,501 @@
+""" Streams sent to clamd with INSTREAM, and the verdicts cached for them """
+import asyncio
+import importlib
+import os
+import time
+from contextlib import aclosing
+from typing import BinaryIO, Any, Optional, Tuple, cast
+from .cache import VerdictCache
+from .protocol import (
+    DEBUG, print_, PyvalveError, PyvalveResponseError, PyvalveScanningError,
+    PyvalveStreamMaxLength, PyvalveConnectionError, is_error_reply
+)
+from .streams import (
+    CHUNK_HEADER, FILE_CHUNK_SIZE, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, StreamSource,
+    is_regular_file, remaining_length, default_chunk_size, ChunkSizer, FilePayload,
+    aiter_chunks, closing_stream, open_file
+)
+from .hedging import time_limit
+from .connection import Connection
+from .commands import CommandClient
+
+class StreamingClient(CommandClient):  # pylint: disable=abstract-method
+    """ INSTREAM scans of a Pyvalve client """
+    async def __init__(self):
+        """ Constructor """
+        await super().__init__()
+        self.stream_buffer: Optional[int] = None
+        self.adaptive_chunks: Optional[Tuple[int, int]] = None
+        self.sizer: Optional[ChunkSizer] = None
+        self.stream_max_length: Optional[int] = None
+        self.cache_lock = asyncio.Lock()
+
+    def after_fork(self) -> None:
+        """ Drop the parent's connection and the locks bound to its event loop """
+        super().after_fork()
+        self.cache_lock = asyncio.Lock()
+
+    def set_stream_buffer(self,  length: Optional[int]) -> None:
+        """
+        Set stream buffer
+
+        By default the INSTREAM chunk size is picked from the stream length.
+
+        :param length int: Desired stream buffer in bytes, None for the default
+        """
+        self.stream_buffer = length
+        self.adaptive_chunks = None
+
+    def set_adaptive_stream_buffer(self,
+        min_size: int = MIN_CHUNK_SIZE,
+        max_size: int = MAX_CHUNK_SIZE) -> None:
+        """
+        Adapt the INSTREAM chunk size to the throughput of each connection
+
+        :param min_size int: Smallest chunk size in bytes
+        :param max_size int: Largest chunk size in bytes
+        """
+        if not 0 < min_size <= max_size:
+            raise ValueError(f'Invalid chunk size bounds: {min_size}, {max_size}')
+        self.stream_buffer = None
+        self.adaptive_chunks = (min_size, max_size)
+        self.sizer = None
+
+    def set_stream_max_length(self, length: Optional[int]) -> None:
+        """
+        Set the largest stream clamd accepts
+
+        Match StreamMaxLength in clamd.conf. When it is not set, it is
+        learned from the first stream clamd rejects.
+
+        :param length int: Limit in bytes, None to learn it
+        """
+        self.stream_max_length = length
+
+    def accepts_stream(self, length: Optional[int]) -> bool:
+        """
+        Check a stream fits in the known StreamMaxLength
+
+        :param length int: Stream length, None if unknown
+        :rtype: bool
+        """
+        return (length is None or self.stream_max_length is None
+            or length <= self.stream_max_length)
+
+    def check_stream_length(self, length: Optional[int]) -> None:
+        """
+        Reject a stream before sending it if it is too long
+
+        :param length int: Stream length, None if unknown
+        :raises PyvalveStreamMaxLength: If the stream exceeds StreamMaxLength
+        """
+        if not self.accepts_stream(length):
+            raise PyvalveStreamMaxLength(
+                f'Stream of {length} bytes exceeds StreamMaxLength of '
+                f'{self.stream_max_length} bytes'
+            )
+
+    def learn_stream_max_length(self, streamed: int) -> None:
+        """
+        Lower the known StreamMaxLength after clamd rejected a stream
+
+        clamd replies once it received more than its limit, so the limit
+        is below the bytes written when the reply arrived.
+
+        :param streamed int: Bytes written before the reply
+        """
+        if streamed > 0 and (self.stream_max_length is None
+                or streamed - 1 < self.stream_max_length):
+            print_(f'StreamMaxLength is below {streamed} bytes')
+            self.stream_max_length = streamed - 1
+
+    def chunk_sizer(self,
+        conn: Connection,
+        length: Optional[int]) -> Optional[ChunkSizer]:
+        """
+        Get the chunk sizer of a connection in adaptive mode
+
+        Pooled connections learn their own size. One shot connections
+        share the client's, as they come one after the other.
+
+        :param conn Connection: Connection the stream is written to
+        :param length int: Stream length, used for the initial size
+        :return: The sizer, None when adaptive chunk sizing is off
+        :rtype: ChunkSizer
+        """
+        if self.adaptive_chunks is None:
+            return None
+        owner = conn if conn.session else self
+        if owner.sizer is None:
+            owner.sizer = ChunkSizer(*self.adaptive_chunks, size=default_chunk_size(length))
+        return owner.sizer
+
+    def set_cache(self, cache: Optional[VerdictCache]) -> None:
+        """
+        Set verdict cache
+
+        INSTREAM verdicts are cached by content digest. The cache is
+        cleared when the signature version reported by clamd changes.
+
+        :param cache VerdictCache: A verdict cache, None to disable caching
+        """
+        self.cache = cache
+
+    async def refresh_cache_version(self) -> None:
+        """ Query the signature version if the verdict cache needs it """
+        if self.cache is None or not self.cache.needs_version():
+            return
+        self.check_fork()
+        async with self.cache_lock:
+            if self.cache.needs_version():
+                await self.version()
+
+    def stream_hasher(self) -> Any:
+        """
+        Create a hasher for a stream, if its verdict can be cached
+
+        :return: A hashlib object, None without a cache or signature version
+        """
+        if self.cache is None or self.cache.version is None:
+            return None
+        return self.cache.hasher()
+
+    async def cached_verdict(self, hasher: Any) -> Optional[str]:
+        """
+        Look up the verdict of a streamed content
+
+        :param hasher: hashlib object updated with the content, None if not cached
+        :return: The cached response, None on a miss
+        :rtype: str
+        """
+        cache = self.cache
+        if hasher is None or cache is None:
+            return None
+        return await cache.get(hasher.digest())
+
+    async def cache_verdict(self, digest: bytes, data: bytes) -> None:
+        """
+        Cache a verdict, unless it reports an error
+
+        :param digest bytes: Content digest
+        :param data bytes: Raw response from clamav
+        """
+        if self.cache is None or is_error_reply(data):
+            return
+        data = data.strip(b'\0\r\n ')
+        if data.endswith(b' FOUND') or data.endswith(b': OK'):
+            await self.cache.set(digest, data.decode())
+
+    async def instream(self, buffer: StreamSource) -> str:
+        """
+        Send a stream to clamav::
+
+            async with aiofiles.open(path, 'rb') as file:
+                await pv.instream(file)
+            await pv.instream(request.content)
+            await pv.instream(response.content.iter_chunked(1 << 16))
+
+        Buffer objects are read on the event loop. Async file objects and
+        StreamReaders are read with await, a chunk at a time, and the
+        chunks of async iterables are sent as they come, so memory use
+        stays bounded by a chunk. Their length is unknown, so
+        StreamMaxLength is checked while streaming. The source is closed
+        once sent, except StreamReaders.
+
+        :param buffer: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveConnectionError: If connection is broken
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        self.check_stream_length(remaining_length(buffer))
+        await self.refresh_cache_version()
+        async with time_limit(self.call_timeout), self.traced('INSTREAM'), self.limited():
+            if self.use_pool('INSTREAM'):
+                async with self.acquire() as conn:
+                    return await self.send_stream(conn, b'zINSTREAM\0', buffer)
+
+            conn = await self.get_connection()
+            try:
+                data_dec = await self.send_stream(conn, b'nINSTREAM\n', buffer)
+            finally:
+                await self.close(conn)
+        return data_dec
+
+    async def instream_file(self, path: str) -> str:
+        """
+        Send a file on disk to clamav
+
+        The file is streamed with sendfile, or memory mapped, instead of
+        being read into memory.
+
+        :param path str: Path to the file
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If the file can not be opened
+        :raises PyvalveConnectionError: If connection is broken
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        # the stream closes the file too, unless it is refused beforehand
+        with open_file(path) as file:
+            return await self.instream(file)
+
+    async def instream_tee(self, source: StreamSource, destination: Any) -> str:
+        """
+        Stream to clamav while forwarding the same chunks to a destination::
+
+            async with StagedFile('/srv/uploads/report.pdf') as stored:
+                response = await pv.instream_tee(request.content, stored)
+                if response.endswith(': OK'):
+                    await stored.commit()
+
+        Each chunk is stored while it is sent to clamd, so an upload is
+        stored and scanned in the time of the slower of the two. The
+        verdict comes once the destination has every chunk, the caller
+        then keeps or discards the stored copy.
+
+        :param source: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :param destination: An object with an async write method, such as
+            a StagedFile, an asyncio.StreamWriter, or a file, see TeeStream
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveResponseError: If clamav replied before the end of
+            the stream, the destination only has part of it
+        :raises PyvalveConnectionError: If connection is broken
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        # imported on first use, as it imports this module
+        tee = importlib.import_module('.tee', __package__).TeeStream(source, destination)
+        response = await self.instream(tee)
+        if not tee.complete:
+            raise PyvalveResponseError(f'Stream interrupted by clamd: {response}')
+        return response
+
+    async def send_stream(self,
+        conn: Connection,
+        command: bytes,
+        buffer: StreamSource,
+        hasher: Any = None) -> str:
+        """
+        Write an INSTREAM request on a connection and read the reply
+
+        With a verdict cache, the content digest is computed from the
+        chunks as they are written and checked before the terminating
+        chunk. On a hit the connection is dropped, so clamd never scans
+        the content.
+
+        A stream known to exceed StreamMaxLength is rejected before
+        anything is sent, and the buffer is left open.
+
+        :param conn Connection: Connection to write to
+        :param command bytes: The framed INSTREAM command
+        :param buffer: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :param hasher: hashlib object updated with the content, to use in
+            place of one created for the verdict cache. It must hash the
+            same way, e.g. ScanManifest.stream_hasher
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveConnectionError: If connection is broken
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        self.check_stream_length(remaining_length(buffer))
+        if hasher is None:
+            hasher = self.stream_hasher()
+        conn.send(command)
+        # clamd may reply before the end of the stream, e.g. when the
+        # size limit is exceeded, so wait for the reply while writing
+        reply = asyncio.ensure_future(conn.read_reply())
+
+        try:
+            try:
+                async with closing_stream(buffer) as buffer_pointer:
+                    completed = await self.write_chunks(
+                        conn, buffer_pointer, reply, hasher
+                    )
+                if completed:
+                    cached = await self.cached_verdict(hasher)
+                    if cached is not None:
+                        if DEBUG:
+                            print_(f'Cached: {cached}')
+                        conn.abort()
+                        return cached
+                    print_("Printed chunks. Closing out request.")
+                    conn.writer.write(CHUNK_HEADER.pack(0))
+                    conn.wrote_stream()
+                    await conn.flush()
+            except ConnectionError as exp:
+                try:
+                    data = await reply
+                except (PyvalveError, OSError):
+                    data = b''
+                if not data:
+                    raise PyvalveConnectionError(exp) from exp
+                completed = False
+
+            print_("Done writing stream. Check results")
+
+            data = await reply
+        finally:
+            reply.cancel()
+
+        data_dec: str = data.decode().strip()
+        if not completed and conn.session:
+            # the session is out of sync after a partial stream
+            conn.abort()
+        if b'INSTREAM size limit exceeded' in data:
+            self.learn_stream_max_length(conn.streamed)
+            raise PyvalveStreamMaxLength(data_dec)
+
+        if DEBUG:
+            print_(f'Received: {data_dec}')
+        if completed and hasher is not None:
+            await self.cache_verdict(hasher.digest(), data)
+
+        return data_dec
+
+    async def write_stream(self,
+        conn: Connection,
+        buffer: StreamSource,
+        reply: Optional[asyncio.Future] = None,
+        hasher: Any = None) -> Tuple[bool, Optional[str]]:
+        """
+        Write the INSTREAM chunks of a buffer, followed by the terminating chunk
+
+        With a hasher, the verdict cache is looked up before the
+        terminating chunk is written.
+
+        :param conn Connection: Connection to write to
+        :param buffer: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :param reply asyncio.Future: Reply of the request, writing stops
+            early if it completes
+        :param hasher: hashlib object updated with the content
+        :return: False if writing stopped because clamd already replied,
+            and the cached verdict, None on a cache miss
+        :rtype: tuple
+        """
+        async with closing_stream(buffer) as buffer_pointer:
+            if not await self.write_chunks(conn, buffer_pointer, reply, hasher):
+                return False, None
+        cached = await self.cached_verdict(hasher)
+
+        print_("Printed chunks. Closing out request.")
+        conn.writer.write(CHUNK_HEADER.pack(0))
+        conn.wrote_stream()
+        await conn.writer.drain()
+        return True, cached
+
+    async def write_chunks(self,
+        conn: Connection,
+        buffer: StreamSource,
+        reply: Optional[asyncio.Future] = None,
+        hasher: Any = None) -> bool:
+        """
+        Write the INSTREAM chunks of a buffer, without the terminating chunk
+
+        Each chunk header and payload are handed to the transport together
+        without concatenating them, and writing waits whenever the
+        transport is above its high water mark.
+
+        :param conn Connection: Connection to write to
+        :param buffer: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :param reply asyncio.Future: Reply of the request, writing stops
+            early if it completes
+        :param hasher: hashlib object updated with the content
+        :return: False if writing stopped because clamd already replied
+        :rtype: bool
+        :raises PyvalveStreamMaxLength: If the stream grows past the known
+            StreamMaxLength, the connection is dropped
+        """
+        conn.streamed = 0
+        if is_regular_file(buffer):
+            return await self.write_file(conn, cast(BinaryIO, buffer), reply, hasher)
+
+        writer = conn.writer
+        limit = self.stream_max_length
+        size = self.stream_buffer
+        sizer = None
+        if size is None:
+            length = remaining_length(buffer)
+            size = default_chunk_size(length)
+            sizer = self.chunk_sizer(conn, length)
+        clock = time.perf_counter
+        started = clock()
+        async with aclosing(aiter_chunks(buffer, size, sizer)) as chunks:
+            async for chunk in chunks:
+                conn.streamed += len(chunk)
+                if limit is not None and conn.streamed > limit:
+                    # the rest of the stream would be read as commands
+                    conn.abort()
+                    raise PyvalveStreamMaxLength(
+                        f'Stream exceeds StreamMaxLength of {limit} bytes'
+                    )
+                if hasher is not None:
+                    hasher.update(chunk)
+                writer.writelines((CHUNK_HEADER.pack(len(chunk)), chunk))
+                await writer.drain()
+                if sizer is not None:
+                    now = clock()
+                    sizer.record(len(chunk), now - started)
+                    started = now
+                if reply is not None and reply.done():
+                    print_('clamd replied before the end of the stream')
+                    return False
+        return True
+
+    async def write_file(self,
+        conn: Connection,
+        file: BinaryIO,
+        reply: Optional[asyncio.Future] = None,
+        hasher: Any = None) -> bool:
+        """
+        Write the INSTREAM chunks of a regular file, from its current position
+
+        The payload of each chunk is sent with sendfile, so it is never
+        copied through Python, or else from a memory mapping, see
+        FilePayload.
+
+        :param conn Connection: Connection to write to
+        :param BinaryIO file: a file opened in binary mode
+        :param reply asyncio.Future: Reply of the request, writing stops
+            early if it completes
+        :param hasher: hashlib object updated with the content
+        :return: False if writing stopped because clamd already replied
+        :rtype: bool
+        :raises PyvalveScanningError: If the file shrinks while streaming
+        """
+        writer = conn.writer
+        offset = file.tell()
+        end = os.fstat(file.fileno()).st_size
+        size = max(self.stream_buffer or 0, FILE_CHUNK_SIZE)
+        sizer = self.chunk_sizer(conn, end - offset)
+        clock = time.perf_counter
+        started = clock()
+        payload = FilePayload(file, hasher)
+
+        try:
+            while offset < end:
+                if sizer is not None:
+                    size = sizer.size
+                count = min(size, end - offset)
+                writer.write(CHUNK_HEADER.pack(count))
+                if await payload.write(writer, offset, count) != count:
+                    raise PyvalveScanningError('File changed while streaming')
+                offset += count
+                conn.streamed += count
+                await writer.drain()
+                if sizer is not None:
+                    now = clock()
+                    sizer.record(count, now - started)
+                    started = now
+                if reply is not None and reply.done():
+                    print_('clamd replied before the end of the stream')
+                    return False
+        finally:
+            file.seek(offset)
+            payload.close()
+        return True
@@ -0,0 +1,358 @@
+""" Sources of INSTREAM and the chunks they are sent in """
+import asyncio
+import inspect
+import mmap
+import os
+import stat
+import struct
+from contextlib import asynccontextmanager
+from io import BytesIO, SEEK_END
+from typing import (
+    BinaryIO, AsyncGenerator, AsyncIterable, AsyncIterator, Awaitable, Any, Iterator, Optional,
+    Protocol, Tuple, Union, cast
+)
+from .protocol import print_, PyvalveScanningError
+
+# INSTREAM chunk length prefix
+CHUNK_HEADER = struct.Struct('!L')
+
+# INSTREAM chunk size used for files on disk
+FILE_CHUNK_SIZE = 1 << 20
+
+# INSTREAM chunk size used for streams larger than it
+DEFAULT_CHUNK_SIZE = 256 << 10
+
+# Default bounds of adaptive INSTREAM chunk sizes
+MIN_CHUNK_SIZE = 16 << 10
+
+MAX_CHUNK_SIZE = 4 << 20
+
+def map_file(file: BinaryIO) -> Tuple[Optional[mmap.mmap], Optional[memoryview]]:
+    """
+    Memory map a file for reading
+
+    :param BinaryIO file: a file opened in binary mode
+    :return: The mapping and a view of it, both None if the file can not be mapped
+    :rtype: tuple
+    """
+    try:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        print_('File can not be memory mapped, reading it')
+        return None, None
+    return mapping, memoryview(mapping)
+
+class FilePayload():
+    """
+    Payload of the INSTREAM chunks of a regular file
+
+    Chunks are sent with sendfile, so they are never copied through
+    Python. When the transport does not support sendfile, or the content
+    has to be hashed, the file is memory mapped instead, and read when it
+    can not be mapped.
+    """
+    def __init__(self, file: BinaryIO, hasher: Any = None):
+        """
+        FilePayload Constructor
+
+        :param BinaryIO file: a file opened in binary mode
+        :param hasher: hashlib object updated with the content
+        """
+        self.file = file
+        self.hasher = hasher
+        self.sendfile = hasher is None
+        self.mapping, self.mapped = (None, None) if self.sendfile else map_file(file)
+
+    async def write(self, writer: asyncio.StreamWriter, offset: int, count: int) -> int:
+        """
+        Write a chunk of the file
+
+        :param writer asyncio.StreamWriter: Writer of the connection
+        :param offset int: Position of the chunk in the file
+        :param count int: Size of the chunk
+        :return: Bytes written, less than count if the file shrank
+        :rtype: int
+        """
+        if self.sendfile:
+            try:
+                return await asyncio.get_running_loop().sendfile(
+                    writer.transport, self.file, offset, count, fallback=False
+                )
+            except (asyncio.SendfileNotAvailableError, NotImplementedError, RuntimeError):
+                self.sendfile = False
+                self.mapping, self.mapped = map_file(self.file)
+        chunk: Union[bytes, memoryview]
+        if self.mapped is not None:
+            chunk = self.mapped[offset:offset + count]
+        else:
+            self.file.seek(offset)
+            chunk = self.file.read(count)
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+        writer.write(chunk)
+        return len(chunk)
+
+    def close(self) -> None:
+        """ Release the memory mapping, the file stays open """
+        if self.mapped is not None:
+            self.mapped.release()
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                # the transport still holds chunks, closed once they are sent
+                pass
+
+# pylint: disable=too-few-public-methods
+class AsyncReadable(Protocol):
+    """ An async file object, e.g. from aiofiles, or an asyncio.StreamReader """
+    def read(self, size: int = -1, /) -> Awaitable[bytes]:
+        """ Read up to size bytes, b'' at the end """
+
+# What INSTREAM can send: a buffer object, an async file object or
+# StreamReader, or an async iterable of bytes
+StreamSource = Union[BinaryIO, AsyncReadable, AsyncIterable[Union[bytes, memoryview]]]
+
+def is_async_source(source: Any) -> bool:
+    """
+    Check if a stream source is read with await
+
+    :param source: A buffer object, async file object, StreamReader or
+        async iterable of bytes
+    :rtype: bool
+    """
+    return (inspect.iscoroutinefunction(getattr(source, 'read', None))
+        or hasattr(source, '__aiter__'))
+
+def open_file(path: str) -> BinaryIO:
+    """
+    Open a file on disk to stream it
+
+    :param path str: Path to the file
+    :return: The file, opened for binary reads
+    :rtype: BinaryIO
+    :raises PyvalveScanningError: If the file can not be opened
+    """
+    try:
+        # pylint: disable=consider-using-with
+        return open(path, 'rb')
+    except OSError as exc:
+        raise PyvalveScanningError(f'Can not open {path}: {exc}') from exc
+
+def is_regular_file(buffer: StreamSource) -> bool:
+    """
+    Check if a buffer is backed by a regular file with data left to read
+
+    :param buffer: a buffer object, False for sources read with await
+    :rtype: bool
+    """
+    if is_async_source(buffer):
+        return False
+    file = cast(BinaryIO, buffer)
+    try:
+        info = os.fstat(file.fileno())
+    except (AttributeError, OSError, ValueError):
+        return False
+    return stat.S_ISREG(info.st_mode) and info.st_size > file.tell()
+
+def remaining_length(buffer: StreamSource) -> Optional[int]:
+    """
+    Get the number of bytes left to read in a buffer
+
+    :param buffer: a buffer object
+    :return: The length, None if the buffer is not seekable or is read with await
+    :rtype: int
+    """
+    if is_async_source(buffer):
+        return None
+    file = cast(BinaryIO, buffer)
+    try:
+        if isinstance(file, BytesIO):
+            with file.getbuffer() as view:
+                return max(view.nbytes - file.tell(), 0)
+        if not file.seekable():
+            return None
+        position = file.tell()
+        end = file.seek(0, SEEK_END)
+        file.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return max(end - position, 0)
+
+def default_chunk_size(length: Optional[int]) -> int:
+    """
+    Pick an INSTREAM chunk size from the stream length
+
+    Small streams are sent in a single chunk, larger ones in chunks big
+    enough that the cost of each chunk does not matter.
+
+    :param length int: Stream length, None if unknown
+    :return: Chunk size in bytes
+    :rtype: int
+    """
+    if length is None:
+        return DEFAULT_CHUNK_SIZE
+    return min(max(length, MIN_CHUNK_SIZE), DEFAULT_CHUNK_SIZE)
+
+class ChunkSizer():
+    """
+    Adapt the INSTREAM chunk size to the throughput achieved
+
+    Every window the size is doubled or halved, in the same
+    direction as long as throughput improves, and in the other direction
+    once it drops. The size stays put at a bound until throughput drops.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+        min_size: int = MIN_CHUNK_SIZE,
+        max_size: int = MAX_CHUNK_SIZE,
+        size: Optional[int] = None,
+        window: float = 0.02):
+        """
+        ChunkSizer Constructor
+
+        :param min_size int: Smallest chunk size in bytes
+        :param max_size int: Largest chunk size in bytes
+        :param size int: Initial chunk size, min_size if None
+        :param window float: Seconds measured before the size changes, at least two chunks
+        """
+        if not 0 < min_size <= max_size:
+            raise ValueError(f'Invalid chunk size bounds: {min_size}, {max_size}')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min(max(size or min_size, min_size), max_size)
+        self.window = window
+        self.grow = True
+        self.throughput = 0.0
+        self._bytes = 0
+        self._elapsed = 0.0
+        self._chunks = 0
+
+    def record(self, count: int, elapsed: float) -> None:
+        """
+        Record a written chunk
+
+        :param count int: Chunk size in bytes
+        :param elapsed float: Seconds since the previous chunk was written
+        """
+        self._bytes += count
+        self._elapsed += elapsed
+        self._chunks += 1
+        if self._chunks < 2 or self._elapsed < self.window:
+            return
+        throughput = self._bytes / self._elapsed
+        if throughput < self.throughput * 0.95:
+            self.grow = not self.grow
+        self.throughput = throughput
+        size = self.size * 2 if self.grow else self.size // 2
+        self.size = min(max(size, self.min_size), self.max_size)
+        self._bytes = 0
+        self._elapsed = 0.0
+        self._chunks = 0
+
+def iter_chunks(
+    buffer: BinaryIO,
+    size: int,
+    sizer: Optional[ChunkSizer] = None) -> Iterator[Union[bytes, memoryview]]:
+    """
+    Read a buffer in chunks
+
+    In memory buffers are sliced with memoryview instead of being copied.
+
+    :param BinaryIO buffer: a buffer object
+    :param size int: Chunk size in bytes
+    :param sizer ChunkSizer: Read the chunk size from it before each chunk
+    :return: Iterator of chunks
+    """
+    if isinstance(buffer, BytesIO):
+        # getvalue() shares the buffer's bytes, slicing them copies nothing
+        data = memoryview(buffer.getvalue())[buffer.tell():]
+        buffer.seek(0, SEEK_END)
+        offset = 0
+        while offset < len(data):
+            step = size if sizer is None else sizer.size
+            yield data[offset:offset + step]
+            offset += step
+        return
+    while True:
+        chunk = buffer.read(size if sizer is None else sizer.size)
+        if not chunk:
+            break
+        yield chunk
+
+async def aiter_chunks(
+    source: StreamSource,
+    size: int,
+    sizer: Optional[ChunkSizer] = None) -> AsyncGenerator[Union[bytes, memoryview], None]:
+    """
+    Read a stream source in chunks
+
+    Async file objects and StreamReaders are read a chunk at a time.
+    The chunks of async iterables are passed on as they come, sliced
+    when larger than the chunk size, so nothing is buffered. Buffer
+    objects are read by iter_chunks.
+
+    :param source: A buffer object, async file object, StreamReader or
+        async iterable of bytes
+    :param size int: Chunk size in bytes
+    :param sizer ChunkSizer: Read the chunk size from it before each chunk
+    :return: Async iterator of chunks
+    """
+    read = getattr(source, 'read', None)
+    if inspect.iscoroutinefunction(read):
+        while True:
+            chunk = await read(size if sizer is None else sizer.size)
+            if not chunk:
+                break
+            yield chunk
+    elif hasattr(source, '__aiter__'):
+        async for data in cast(AsyncIterable[Union[bytes, memoryview]], source):
+            step = size if sizer is None else sizer.size
+            if len(data) <= step:
+                if data:
+                    yield data
+                continue
+            view = memoryview(data)
+            offset = 0
+            while offset < len(view):
+                yield view[offset:offset + step]
+                offset += step
+                step = size if sizer is None else sizer.size
+    else:
+        for chunk in iter_chunks(cast(BinaryIO, source), size, sizer):
+            yield chunk
+
+async def close_source(source: StreamSource) -> None:
+    """
+    Close a stream source
+
+    Buffer objects are closed, as are async file objects and async
+    generators. StreamReaders belong to their connection and are left
+    as they are.
+
+    :param source: A buffer object, async file object, StreamReader or
+        async iterable of bytes
+    """
+    if not is_async_source(source):
+        cast(BinaryIO, source).close()
+        return
+    aclose = getattr(source, 'aclose', None)
+    close = getattr(source, 'close', None)
+    if aclose is not None:
+        await aclose()
+    elif inspect.iscoroutinefunction(close):
+        await close()
+
+@asynccontextmanager
+async def closing_stream(source: StreamSource) -> AsyncIterator[StreamSource]:
+    """
+    Close a stream source once it is written, see close_source
+
+    :param source: A buffer object, async file object, StreamReader or
+        async iterable of bytes
+    :return: The source
+    """
+    try:
+        yield source
+    finally:
+        await close_source(source)
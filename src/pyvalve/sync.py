@@ -0,0 +1,276 @@
+""" Blocking client for threaded code, running on a shared background event loop """
+import asyncio
+import os
+import threading
+from typing import Any, Awaitable, BinaryIO, Callable, Coroutine, Iterator, Optional, Union
+from . import ForkSafe, Pyvalve, RoutedScan
+
+class LoopThread(ForkSafe):
+    """
+    Event loop running forever in a daemon thread
+
+    Coroutines are submitted from any thread with run, which blocks the
+    calling thread until they complete. A forked child only inherits
+    the loop, not its thread, so it starts a loop of its own.
+    """
+    _shared: Optional['LoopThread'] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, name: str = 'pyvalve-loop'):
+        """
+        LoopThread Constructor
+
+        :param name str: Name of the thread
+        """
+        super().__init__()
+        self.name = name
+        self.start()
+
+    def start(self) -> None:
+        """ Start a new loop in a new thread """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True)
+        self.thread.start()
+
+    def after_fork(self) -> None:
+        """ Abandon the parent's loop, it can not be closed while marked as running """
+        self.start()
+
+    def run(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        """
+        Run a coroutine on the loop and wait for its result
+
+        :param coro coroutine: The coroutine
+        :return: What the coroutine returns
+        :raises RuntimeError: If called from the loop thread, which would deadlock
+        """
+        if self.fork_generation != ForkSafe.generation:
+            with LoopThread._shared_lock:
+                self.check_fork()
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError('LoopThread.run called from its own loop')
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            # e.g. KeyboardInterrupt in the calling thread
+            future.cancel()
+            raise
+
+    @classmethod
+    def shared(cls) -> 'LoopThread':
+        """
+        Get the loop thread shared by sync clients, starting it on first use
+
+        :rtype: LoopThread
+        """
+        with cls._shared_lock:
+            if cls._shared is None or cls._shared.loop.is_closed():
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def reset_lock(cls) -> None:
+        """ Replace the shared loop lock in a forked child, another thread may have held it """
+        cls._shared_lock = threading.Lock()
+
+    def stop(self) -> None:
+        """ Stop the loop and wait for its thread """
+        self.check_fork()
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+class PyvalveSync():
+    """
+    Blocking client, safe to call from many threads at once
+
+    The asyncio client and its connection pool live on one background
+    event loop, every call is handed to it and the calling thread waits
+    for the result. Each call runs on a pooled connection or on one
+    opened for it alone, so calls from different threads never share a
+    connection. Methods without a blocking wrapper below are
+    reached through the asyncio client, e.g. set_cache or scan_index.
+    """
+    def __init__(self,
+        endpoint: Union[str, Callable[[], Awaitable[Any]]] = '/tmp/clamd.socket',
+        pool_size: int = 10,
+        call_timeout: Optional[float] = None,
+        loop: Optional[LoopThread] = None):
+        """
+        PyvalveSync Constructor
+
+        :param endpoint: A socket path, host:port, or a coroutine function
+            creating the asyncio client, e.g. a PyvalveCluster
+        :param pool_size int: Connections shared by all threads, 0 for a
+            connection per call
+        :param call_timeout float: Seconds a call may take, None to wait forever
+        :param loop LoopThread: Loop to run on, the shared one by default
+        """
+        self.loop = loop or LoopThread.shared()
+        self.client = self.loop.run(self._create(endpoint, pool_size, call_timeout))
+
+    @staticmethod
+    async def _create(
+        endpoint: Union[str, Callable[[], Awaitable[Any]]],
+        pool_size: int,
+        call_timeout: Optional[float]) -> Any:
+        """ Create the asyncio client on the loop """
+        if isinstance(endpoint, str):
+            # pylint: disable=import-outside-toplevel
+            from .cluster import create_client
+            client = await create_client(endpoint)
+        else:
+            client = await endpoint()
+        if isinstance(client, Pyvalve) and pool_size:
+            await client.create_pool(max_size=pool_size)
+        client.set_call_timeout(call_timeout)
+        return client
+
+    def call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        """
+        Call a method of the asyncio client on the loop
+
+        Async iterators are returned as blocking iterators.
+
+        :param method str: Method name
+        :param args: Method arguments
+        :param kwargs: Method keyword arguments
+        :return: What the method returns
+        """
+        async def invoke() -> Any:
+            result = getattr(self.client, method)(*args, **kwargs)
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                result = await result
+            return result
+
+        result = self.loop.run(invoke())
+        if hasattr(result, '__anext__'):
+            return self.iterate(result)
+        return result
+
+    def iterate(self, iterator: Any) -> Iterator[Any]:
+        """
+        Consume an async iterator of the loop from this thread
+
+        :param iterator: The async iterator
+        :return: Blocking iterator over the same items
+        """
+        async def step() -> Any:
+            return await anext(iterator)
+
+        try:
+            while True:
+                try:
+                    yield self.loop.run(step())
+                except StopAsyncIteration:
+                    return
+        finally:
+            if hasattr(iterator, 'aclose') and not self.loop.loop.is_closed():
+                self.loop.run(iterator.aclose())
+
+    def __getattr__(self, name: str) -> Any:
+        """ Reach other methods of the asyncio client """
+        if name == 'client':
+            # the constructor failed
+            raise AttributeError(name)
+        if name.startswith('_') or not callable(getattr(self.client, name)):
+            return getattr(self.client, name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def ping(self) -> str:
+        """
+        Send ping command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return self.call('ping')
+
+    def version(self) -> str:
+        """
+        Send version command
+
+        :return: Response from clamav
+        :rtype: str
+        """
+        return self.call('version')
+
+    def scan(self, path: str) -> str:
+        """
+        Send scan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        return self.call('scan', path)
+
+    def multiscan(self, path: str) -> str:
+        """
+        Send multiscan command
+
+        :param path str: Path to file/directory to be scanned
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If path is not found
+        """
+        return self.call('multiscan', path)
+
+    def instream(self, buffer: BinaryIO) -> str:
+        """
+        Send a stream to clamav
+
+        The buffer is read on the loop thread, the calling thread must not
+        use it until the call returns.
+
+        :param BinaryIO buffer: a buffer object
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveStreamMaxLength: If stream size limit exceeded
+        """
+        return self.call('instream', buffer)
+
+    def instream_file(self, path: str) -> str:
+        """
+        Send a file on disk to clamav
+
+        :param path str: Path to the file
+        :return: Response from clamav
+        :rtype: str
+        :raises PyvalveScanningError: If the file can not be opened
+        """
+        return self.call('instream_file', path)
+
+    def scan_auto(self, source: Any) -> RoutedScan:
+        """
+        Scan a path, bytes or a buffer over the cheapest transport
+
+        :param source: A path, bytes, or a buffer object
+        :return: The response and the route taken
+        :rtype: RoutedScan
+        """
+        return self.call('scan_auto', source)
+
+    def close(self) -> None:
+        """ Close the pool, or the cluster, the loop keeps running for other clients """
+        if self.loop.loop.is_closed():
+            return
+        if isinstance(self.client, Pyvalve):
+            if self.client.pool is not None:
+                self.loop.run(self.client.pool.close())
+        elif hasattr(self.client, 'close'):
+            self.loop.run(self.client.close())
+
+    def __enter__(self) -> 'PyvalveSync':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=LoopThread.reset_lock)
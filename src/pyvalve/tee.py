@@ -0,0 +1,188 @@
+""" Scan a stream while forwarding it to storage """
+import asyncio
+import inspect
+import os
+import tempfile
+from typing import Any, AsyncGenerator, Awaitable, Optional, Union
+from . import DEFAULT_CHUNK_SIZE, StreamSource, aiter_chunks, close_source, print_
+
+Chunk = Union[bytes, memoryview]
+
+class TeeStream():
+    """
+    Async iterable of the chunks of a source, forwarded to a destination
+
+    Handed to instream, each chunk is written to the destination while
+    it is sent to clamd, so a stored upload takes as long as the slower
+    of the two instead of both. At most two chunks are held at once:
+    the one being stored and the one being sent.
+
+    The destination is an object with an async write method, such as
+    an aiofiles file or a StagedFile, an asyncio.StreamWriter, or an
+    object with a blocking write method, such as a file, written to
+    from a worker thread.
+    """
+    def __init__(self,
+        source: StreamSource,
+        destination: Any,
+        chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        TeeStream Constructor
+
+        :param source: A buffer object, async file object, StreamReader or
+            async iterable of bytes
+        :param destination: Where the chunks are forwarded
+        :param chunk_size int: Size of the chunks read from the source
+        """
+        self.source = source
+        self.destination = destination
+        self.chunk_size = chunk_size
+        self.forwarded = 0
+        self.complete = False
+        self._chunks: Optional[AsyncGenerator[Chunk, None]] = None
+
+    def store(self, chunk: Chunk) -> Awaitable[Any]:
+        """
+        Write a chunk to the destination
+
+        :param chunk bytes: The chunk
+        :return: Awaitable completing once it is written
+        """
+        destination = self.destination
+        write = destination.write
+        if inspect.iscoroutinefunction(write):
+            return write(chunk)
+        if isinstance(destination, asyncio.StreamWriter):
+            write(chunk)
+            return destination.drain()
+        return asyncio.to_thread(write, chunk)
+
+    async def chunks(self) -> AsyncGenerator[Chunk, None]:
+        """
+        Read the source, storing each chunk while the previous one is sent
+
+        :return: Async iterator of chunks
+        """
+        storing: Optional[asyncio.Future] = None
+        try:
+            async for chunk in aiter_chunks(self.source, self.chunk_size):
+                if storing is not None:
+                    await storing
+                storing = asyncio.ensure_future(self.store(chunk))
+                self.forwarded += len(chunk)
+                yield chunk
+            if storing is not None:
+                await storing
+                storing = None
+            self.complete = True
+            print_(f'Forwarded {self.forwarded} bytes')
+        finally:
+            if storing is not None and not storing.done():
+                storing.cancel()
+                try:
+                    await storing
+                except asyncio.CancelledError:
+                    pass
+
+    def __aiter__(self) -> AsyncGenerator[Chunk, None]:
+        """ Iterate the chunks once """
+        if self._chunks is None:
+            self._chunks = self.chunks()
+        return self._chunks
+
+    async def aclose(self) -> None:
+        """ Stop forwarding and close the source """
+        try:
+            if self._chunks is not None:
+                await self._chunks.aclose()
+        finally:
+            await close_source(self.source)
+
+class StagedFile():
+    """
+    File written next to its final path, and moved there on commit::
+
+        async with StagedFile('/srv/uploads/report.pdf') as stored:
+            response = await pv.instream_tee(request.content, stored)
+            if response.endswith(': OK'):
+                await stored.commit()
+
+    The file is discarded on leaving the block unless it was committed,
+    so readers of the final path never see a partial or infected file.
+    """
+    def __init__(self, path: str, mode: int = 0o640, fsync: bool = False):
+        """
+        StagedFile Constructor
+
+        :param path str: Final path of the file
+        :param mode int: Permissions of the file
+        :param fsync bool: Flush the file to disk before moving it
+        """
+        self.path = path
+        self.mode = mode
+        self.fsync = fsync
+        self.temp: Optional[str] = None
+        self.handle: Optional[int] = None
+        self.committed = False
+
+    def open(self) -> int:
+        """
+        Create the staging file in the directory of the final path, blocking
+
+        :return: The file descriptor
+        :rtype: int
+        """
+        if self.handle is None:
+            directory, name = os.path.split(os.path.abspath(self.path))
+            # hidden, and on the same file system so it can be renamed in place
+            handle, self.temp = tempfile.mkstemp(
+                prefix=f'.{name}.', suffix='.part', dir=directory
+            )
+            os.fchmod(handle, self.mode)
+            self.handle = handle
+        return self.handle
+
+    async def write(self, chunk: Chunk) -> None:
+        """
+        Write a chunk, from a worker thread
+
+        :param chunk bytes: The chunk
+        """
+        def write() -> None:
+            handle = self.open()
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(handle, view):]
+        await asyncio.to_thread(write)
+
+    async def commit(self) -> None:
+        """ Move the file to its final path """
+        def commit() -> None:
+            handle = self.open()
+            if self.fsync:
+                os.fsync(handle)
+            os.close(handle)
+            self.handle = None
+            os.replace(self.temp, self.path)  # type: ignore[arg-type]
+        await asyncio.to_thread(commit)
+        self.committed = True
+
+    async def discard(self) -> None:
+        """ Remove the file, unless it was committed """
+        def discard() -> None:
+            if self.handle is not None:
+                os.close(self.handle)
+                self.handle = None
+            if self.temp is not None and not self.committed:
+                try:
+                    os.unlink(self.temp)
+                except FileNotFoundError:
+                    pass
+            self.temp = None
+        await asyncio.to_thread(discard)
+
+    async def __aenter__(self) -> 'StagedFile':
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.discard()
@@ -0,0 +1,166 @@
+""" Parallel directory walks with client side filters """
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from typing import Any, AsyncIterator, Callable, Iterable, List, Optional, Set, Tuple
+
+def matches(path: str, name: str, patterns: Iterable[str]) -> bool:
+    """
+    Check a path against glob patterns
+
+    Patterns with a slash are matched against the path relative to the
+    walked root, the others against the name alone, as in .gitignore.
+
+    :param path str: Path relative to the root
+    :param name str: Last component of the path
+    :param patterns iterable: Glob patterns, e.g. '*.iso' or 'cache/*'
+    :rtype: bool
+    """
+    for pattern in patterns:
+        if fnmatchcase(path if '/' in pattern else name, pattern.strip('/')):
+            return True
+    return False
+
+# pylint: disable=too-few-public-methods
+class TreeFilter():
+    """ Files and directories kept by a walk """
+    __slots__ = ('include', 'exclude', 'max_size', 'follow_symlinks')
+
+    def __init__(self,
+        include: Optional[Iterable[str]] = None,
+        exclude: Iterable[str] = (),
+        max_size: Optional[int] = None,
+        follow_symlinks: bool = False):
+        """
+        TreeFilter Constructor
+
+        :param include iterable: Glob patterns of the files to keep, None for all
+        :param exclude iterable: Glob patterns of the files and directories to skip
+        :param max_size int: Size in bytes above which files are skipped
+        :param follow_symlinks bool: Follow links to files and directories
+        """
+        self.include = tuple(include) if include is not None else None
+        self.exclude = tuple(exclude)
+        self.max_size = max_size
+        self.follow_symlinks = follow_symlinks
+
+    def list_dir(self,
+        root: str,
+        path: str,
+        onerror: Optional[Callable[[OSError], Any]] = None) -> Tuple[List[str], List[str]]:
+        """
+        List a directory, blocking
+
+        :param root str: The walked root
+        :param path str: The directory
+        :param onerror callable: Called with the OSError of an unreadable
+            entry, errors are ignored by default
+        :return: Paths of the kept files and subdirectories
+        :rtype: tuple
+        """
+        files: List[str] = []
+        dirs: List[str] = []
+        follow = self.follow_symlinks
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        relative = os.path.relpath(entry.path, root)
+                        if self.exclude and matches(relative, entry.name, self.exclude):
+                            continue
+                        if entry.is_dir(follow_symlinks=follow):
+                            dirs.append(entry.path)
+                        elif not entry.is_file(follow_symlinks=follow):
+                            # sockets, fifos and devices can not be scanned
+                            continue
+                        elif self.include is not None and not matches(
+                                relative, entry.name, self.include):
+                            continue
+                        elif (self.max_size is None
+                                or entry.stat(follow_symlinks=follow).st_size <= self.max_size):
+                            files.append(entry.path)
+                    except OSError as exc:
+                        if onerror is not None:
+                            onerror(exc)
+        except OSError as exc:
+            if onerror is not None:
+                onerror(exc)
+        return files, dirs
+
+def first_visit(path: str,
+    seen: Set[Tuple[int, int]],
+    onerror: Optional[Callable[[OSError], Any]] = None) -> bool:
+    """
+    Check a directory was not walked yet, links can lead to it twice or in a loop
+
+    :param path str: The directory
+    :param seen set: Device and inode of the directories walked, updated
+    :param onerror callable: Called with the OSError if the directory is gone
+    :rtype: bool
+    """
+    try:
+        info = os.stat(path)
+    except OSError as exc:
+        if onerror is not None:
+            onerror(exc)
+        return False
+    if (info.st_dev, info.st_ino) in seen:
+        return False
+    seen.add((info.st_dev, info.st_ino))
+    return True
+
+async def walk_tree(root: str,
+    tree_filter: Optional[TreeFilter] = None,
+    workers: int = 4,
+    onerror: Optional[Callable[[OSError], Any]] = None) -> AsyncIterator[str]:
+    """
+    Walk a directory tree, listing directories in a thread pool::
+
+        async for path in walk_tree('/srv/uploads', TreeFilter(exclude=['.git'])):
+            print(path)
+
+    Up to `workers` directories are listed at once. Files are yielded
+    as their directory is listed, in no particular order, and listing
+    waits for the consumer. With follow_symlinks, a directory reached
+    twice is walked once.
+
+    :param root str: The directory to walk
+    :param tree_filter TreeFilter: Files and directories to keep, all by default
+    :param workers int: Directories listed in parallel
+    :param onerror callable: Called with the OSError of an unreadable
+        directory or entry, from a pool thread. Errors are ignored by
+        default, as in os.walk
+    :return: Async iterator of file paths
+    :raises ValueError: If workers is below 1
+    """
+    if workers < 1:
+        raise ValueError(f'Invalid workers: {workers}')
+    tree_filter = tree_filter or TreeFilter()
+    loop = asyncio.get_running_loop()
+    seen: Set[Tuple[int, int]] = set()
+    pending = [root]
+    listing: Set[asyncio.Future] = set()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pyvalve-walk')
+    try:
+        while pending or listing:
+            while pending and len(listing) < workers:
+                path = pending.pop()
+                if tree_filter.follow_symlinks and not first_visit(path, seen, onerror):
+                    continue
+                listing.add(loop.run_in_executor(
+                    executor, tree_filter.list_dir, root, path, onerror
+                ))
+            if not listing:
+                # the remaining directories were walked already
+                break
+            done, listing = await asyncio.wait(listing, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                pending.extend(dirs)
+                for path in files:
+                    yield path
+    finally:
+        for future in listing:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
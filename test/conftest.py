@@ -0,0 +1,31 @@
+""" Fixtures shared by the test modules """
+import asyncio
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Connection
+from unittest import mock
+
+
+@pytest.fixture
+def session_connection():
+    """
+    Build session connections with canned replies, fed upfront, or
+    after_stream once the terminating chunk of a stream is written
+    """
+    def build(*replies, after_stream=None):
+        reader = asyncio.StreamReader()
+        writer = mock.Mock(asyncio.StreamWriter)
+        writer.is_closing = mock.Mock(return_value=False)
+        for reply in replies:
+            reader.feed_data(reply)
+        if after_stream is not None:
+            def write(data):
+                if data == b'\0\0\0\0':
+                    reader.feed_data(after_stream)
+            writer.write = mock.Mock(side_effect=write)
+        conn = Connection(reader, writer)
+        conn.session = True
+        return conn
+    return build
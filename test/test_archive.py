@@ -0,0 +1,117 @@
+""" Test class for scanning archive members """
+import asyncio
+import io
+import pytest
+import tarfile
+import zipfile
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import ArchiveLimits, Pyvalve, PyvalveScanningError, ScanResult
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+def make_zip(members):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+def make_tar(members, mode='w:gz'):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode=mode) as archive:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+def verdict(data):
+    return 'stream: Eicar-Signature FOUND' if b'EICAR' in data else 'stream: OK'
+
+async def scanner(session_connection):
+    """ A client answering from the content it is sent """
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(side_effect=session_connection)
+    scanned = []
+
+    async def send_stream(conn, command, buffer):
+        scanned.append(buffer.read())
+        return verdict(scanned[-1])
+
+    async def instream(buffer):
+        with buffer:
+            scanned.append(b'whole:' + buffer.read())
+        return verdict(scanned[-1])
+    pvs.send_stream = mock.AsyncMock(side_effect=send_stream)
+    pvs.instream = mock.AsyncMock(side_effect=instream)
+    return pvs, scanned
+
+@pytest.mark.asyncio
+async def test_scan_archive(tmp_path, session_connection):
+    inner = make_tar({'docs/b.txt': b'b', 'eicar.com': b'X5O EICAR'})
+    path = tmp_path / 'upload.zip'
+    path.write_bytes(make_zip({'a.txt': b'a', 'dir/inner.tar.gz': inner}))
+    pvs, scanned = await scanner(session_connection)
+
+    result = await pvs.scan_archive(str(path), concurrency=2)
+    assert result.infected and result.status == ScanResult.FOUND
+    assert result.hits == [ScanResult(f'{path}/dir/inner.tar.gz/eicar.com', ScanResult.FOUND,
+        ('Eicar-Signature',))]
+    assert result.members == 3 and result.expanded == len(inner) + len(b'X5O EICAR') + 2
+    assert result.fallback is None
+    assert sorted(scanned) == [b'X5O EICAR', b'a', b'b']
+
+    # nested archives past max_depth are scanned as members
+    scanned.clear()
+    result = await pvs.scan_archive(str(path), ArchiveLimits(max_depth=1))
+    assert result.members == 2 and sorted(scanned) == sorted([b'a', inner])
+
+    # the first hit stops the scan
+    path.write_bytes(make_tar({f'{n}.txt': b'EICAR' for n in range(50)}, 'w'))
+    scanned.clear()
+    result = await pvs.scan_archive(str(path), concurrency=1, stop_on_hit=True)
+    assert len(result.hits) == 1 and len(scanned) < 50
+
+@pytest.mark.asyncio
+async def test_scan_archive_whole(tmp_path, session_connection):
+    pvs, scanned = await scanner(session_connection)
+
+    # files that are not archives, and documents built on zip
+    buffer = io.BytesIO(b'plain EICAR text')
+    result = await pvs.scan_archive(buffer)
+    assert result.hits == [ScanResult('stream', ScanResult.FOUND, ('Eicar-Signature',))]
+    assert scanned == [b'whole:plain EICAR text'] and buffer.closed
+    document = make_zip({'[Content_Types].xml': b'<Types/>', 'word/document.xml': b'EICAR'})
+    scanned.clear()
+    result = await pvs.scan_archive(io.BytesIO(document))
+    assert result.members == 0 and scanned == [b'whole:' + document]
+
+    # limits send the archive whole, clamd applies its own
+    data = make_zip({'big.bin': b'\0' * 4096, 'small.txt': b'ok'})
+    scanned.clear()
+    result = await pvs.scan_archive(io.BytesIO(data), ArchiveLimits(max_member_size=1024))
+    assert result.fallback == 'stream/big.bin exceeds 1024 bytes'
+    assert result.status == ScanResult.OK and scanned == [b'whole:' + data]
+
+    scanned.clear()
+    data = make_zip({f'{n}.txt': b'x' for n in range(10)})
+    result = await pvs.scan_archive(io.BytesIO(data), ArchiveLimits(max_members=5))
+    assert result.fallback == 'More than 5 members' and scanned[-1] == b'whole:' + data
+
+    # corrupt archives too
+    data = make_tar({'a.txt': b'a' * 100000}, 'w')[:2048]
+    scanned.clear()
+    result = await pvs.scan_archive(io.BytesIO(data))
+    assert result.fallback is not None and scanned[-1] == b'whole:' + data
+
+    with pytest.raises(PyvalveScanningError):
+        await pvs.scan_archive(str(tmp_path / 'missing.zip'))
@@ -0,0 +1,162 @@
+""" Test class for Pyvalve verdict caches """
+import asyncio
+import pytest
+from io import BytesIO
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Connection, Session, Pyvalve, MemoryVerdictCache, SqliteVerdictCache, signature_version
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_signature_version():
+    assert signature_version('ClamAV 1.0.0/26789/Mon Jan 30 08:17:46 2023') == '26789'
+    assert signature_version('ClamAV 1.0.0') is None
+
+@pytest.mark.asyncio
+async def test_memory_cache():
+    cache = MemoryVerdictCache(max_entries=2)
+    await cache.set(b'a', 'stream: OK')
+    await cache.set(b'b', 'stream: OK')
+    assert await cache.get(b'a') == 'stream: OK'
+
+    # the least recently used entry is evicted
+    await cache.set(b'c', 'stream: Eicar-Signature FOUND')
+    assert await cache.get(b'b') is None
+    assert len(cache) == 2
+
+    # a new signature version clears the cache
+    await cache.set_version('26789')
+    assert len(cache) == 0 and not cache.needs_version()
+
+    cache = MemoryVerdictCache(ttl=-1)
+    await cache.set(b'a', 'stream: OK')
+    assert await cache.get(b'a') is None
+
+@pytest.mark.asyncio
+async def test_sqlite_cache(tmp_path):
+    path = str(tmp_path / 'verdicts.db')
+    cache = SqliteVerdictCache(path, max_entries=2)
+    await cache.set_version('26789')
+    await cache.set(b'a', 'stream: OK')
+    await cache.set(b'b', 'stream: OK')
+    await cache.get(b'a')
+    await cache.set(b'c', 'stream: OK')
+    assert await cache.get(b'b') is None
+    cache.close()
+
+    # verdicts and version survive a restart
+    cache = SqliteVerdictCache(path, max_entries=2)
+    assert cache.version == '26789' and len(cache) == 2
+    assert await cache.get(b'a') == 'stream: OK'
+
+    await cache.set_version('26790')
+    assert await cache.get(b'a') is None
+    cache.close()
+
+def instream_connection(reply):
+    reader = asyncio.StreamReader()
+    writer = mock.Mock(asyncio.StreamWriter)
+    conn = Connection(reader, writer)
+    if reply:
+        reader.feed_data(reply)
+        reader.feed_eof()
+    return conn
+
+@pytest.mark.asyncio
+async def test_instream_cache():
+    pvs = await Pyvalve()
+    cache = MemoryVerdictCache()
+    pvs.set_cache(cache)
+    pvs.send_command = mock.AsyncMock(return_value='ClamAV 1.0.0/26789/Mon Jan 30 08:17:46 2023')
+
+    conn = instream_connection(b'stream: Eicar-Signature FOUND\n')
+    pvs.get_connection = mock.AsyncMock(return_value=conn)
+    pvs.set_connection(conn)
+    result = await pvs.instream(BytesIO(b'X5O!P%@AP'))
+    assert result == 'stream: Eicar-Signature FOUND'
+    assert len(cache) == 1
+
+    # the same content is not scanned again
+    conn = instream_connection(None)
+    pvs.get_connection.return_value = conn
+    result = await pvs.instream(BytesIO(b'X5O!P%@AP'))
+    assert result == 'stream: Eicar-Signature FOUND'
+    conn.writer.transport.abort.assert_called()
+    assert mock.call(b'\x00\x00\x00\x00') not in conn.writer.write.call_args_list
+    assert pvs.send_command.await_count == 1
+
+    # errors are not cached
+    conn = instream_connection(b'stream: Can not allocate memory ERROR\n')
+    pvs.get_connection.return_value = conn
+    await pvs.instream(BytesIO(b'other'))
+    assert len(cache) == 1
+
+    # reload clears the cache
+    await pvs.reload()
+    assert len(cache) == 0 and cache.needs_version()
+
+def clamd_connection(session_connection, latency=0.0):
+    """ Session connection answering PING and INSTREAM in order, after a delay """
+    conn = session_connection()
+    reader, writer = conn.reader, conn.writer
+    loop = asyncio.get_running_loop()
+    def write(data):
+        # commands are written before the request id is counted
+        if data == b'zPING\0':
+            reply = f'{conn.request_id + 1}: PONG'
+        elif data == b'\x00\x00\x00\x00':
+            reply = f'{conn.request_id}: stream: Eicar-Signature FOUND'
+        else:
+            return
+        loop.call_later(latency, reader.feed_data, reply.encode() + b'\0')
+    writer.write = mock.Mock(side_effect=write)
+    return conn
+
+@pytest.mark.asyncio
+async def test_session_cache_pool(session_connection):
+    pvs = await Pyvalve()
+    cache = MemoryVerdictCache()
+    await cache.set_version('26789')
+    pvs.set_cache(cache)
+    pvs.open_session = mock.AsyncMock(side_effect=lambda: clamd_connection(session_connection, 0.01))
+    await pvs.create_pool(max_size=1)
+
+    for _ in range(2):
+        async with pvs.session() as session:
+            assert await session.instream(BytesIO(b'X5O!P%@AP')) == 'stream: Eicar-Signature FOUND'
+    # the reply owed to the cache hit was read before the connection went back
+    assert pvs.pool.idle == 1
+    assert await pvs.ping() == 'PONG'
+    assert pvs.open_session.await_count == 1
+
+@pytest.mark.asyncio
+async def test_session_cache(session_connection):
+    pvs = await Pyvalve()
+    cache = MemoryVerdictCache()
+    pvs.set_cache(cache)
+    pvs.send_command = mock.AsyncMock(return_value='ClamAV 1.0.0/26789/Mon Jan 30 08:17:46 2023')
+
+    conn = session_connection()
+    session = Session(pvs, conn)
+    await session.start()
+    conn.reader.feed_data(b'1: stream: Eicar-Signature FOUND\0')
+    assert await session.instream(BytesIO(b'X5O!P%@AP')) == 'stream: Eicar-Signature FOUND'
+    assert len(cache) == 1
+
+    # a hit answers without waiting for clamd, the stream is still
+    # terminated and its late reply dropped
+    assert await session.instream(BytesIO(b'X5O!P%@AP')) == 'stream: Eicar-Signature FOUND'
+    assert conn.writer.write.call_args_list[-1] == mock.call(b'\x00\x00\x00\x00')
+    conn.reader.feed_data(b'2: stream: Eicar-Signature FOUND\0')
+    conn.reader.feed_data(b'3: PONG\0')
+    assert await session.ping() == 'PONG'
+    assert session.error is None and not session.pending
+    await session.stop()
@@ -0,0 +1,173 @@
+""" Test class for PyvalveCluster """
+import asyncio
+import pytest
+from io import BytesIO
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Pyvalve, PyvalveSocket, PyvalveNetwork, PyvalveConnectionError, PyvalveStreamMaxLength, PyvalveTimeout
+from src.pyvalve.cluster import PyvalveCluster, LEAST_OUTSTANDING, POWER_OF_TWO
+from benchmarks.fake_clamd import spawn
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+async def client(name, fail=False, delay=0):
+    pv = await Pyvalve()
+    async def scan(path):
+        await asyncio.sleep(delay)
+        if fail:
+            raise PyvalveConnectionError('refused')
+        return f'{path}: OK {name}'
+    async def ping():
+        if fail:
+            raise PyvalveConnectionError('refused')
+        return 'PONG'
+    pv.scan = scan
+    pv.ping = ping
+    pv.reload = mock.AsyncMock(return_value='RELOADING')
+    return pv
+
+@pytest.mark.asyncio
+async def test_cluster_endpoints():
+    cluster = await PyvalveCluster(['/tmp/clamd.socket', 'clamd:3311', 'clamd'], check_interval=0)
+    assert isinstance(cluster.endpoints[0].client, PyvalveSocket)
+    assert (cluster.endpoints[1].client.host, cluster.endpoints[1].client.port) == ('clamd', 3311)
+    assert isinstance(cluster.endpoints[2].client, PyvalveNetwork)
+
+    with pytest.raises(ValueError):
+        await PyvalveCluster([], check_interval=0)
+    with pytest.raises(ValueError):
+        await PyvalveCluster(['clamd'], strategy='random', check_interval=0)
+
+@pytest.mark.asyncio
+async def test_cluster_balancing():
+    for strategy in (LEAST_OUTSTANDING, POWER_OF_TWO):
+        clients = [await client(i, delay=0.01) for i in range(3)]
+        cluster = await PyvalveCluster(clients, strategy=strategy, check_interval=0)
+        results = await asyncio.gather(*(cluster.scan(f'/f{i}') for i in range(30)))
+        used = {result.rsplit(' ', 1)[1] for result in results}
+        assert used == {'0', '1', '2'}
+        assert all(endpoint.outstanding == 0 for endpoint in cluster.endpoints)
+
+@pytest.mark.asyncio
+async def test_cluster_failover():
+    clients = [await client('bad', fail=True), await client('good')]
+    cluster = await PyvalveCluster(clients, check_interval=0)
+    # the idle endpoint is picked first and fails over to the busy one
+    cluster.endpoints[1].outstanding = 1
+    assert await cluster.scan('/f') == '/f: OK good'
+    cluster.endpoints[1].outstanding = 0
+    assert await cluster.scan('/f') == '/f: OK good'
+    assert not cluster.endpoints[0].healthy
+    assert cluster.healthy == [cluster.endpoints[1]]
+
+    # instream buffers can not be sent twice
+    cluster.endpoints[1].client.instream = mock.AsyncMock()
+    cluster.endpoints[0].client.instream = mock.AsyncMock(side_effect=PyvalveConnectionError('refused'))
+    cluster.endpoints[1].healthy = False
+    cluster.endpoints[1].outstanding = 1
+    with pytest.raises(PyvalveConnectionError):
+        await cluster.instream(BytesIO(b"x"))
+    cluster.endpoints[1].client.instream.assert_not_called()
+
+    # the health check brings the endpoint back
+    clients[0].ping = mock.AsyncMock(return_value='PONG')
+    assert await cluster.check(cluster.endpoints[0])
+    assert cluster.endpoints[0].healthy
+
+    clients[0].ping = mock.AsyncMock(side_effect=PyvalveConnectionError('refused'))
+    assert not await cluster.check(cluster.endpoints[0])
+    assert cluster.endpoints[0].healthy
+    assert not await cluster.check(cluster.endpoints[0])
+    assert not cluster.endpoints[0].healthy
+
+@pytest.mark.asyncio
+async def test_cluster_broadcast():
+    clients = [await client(i) for i in range(2)]
+    cluster = await PyvalveCluster(clients, check_interval=0.01)
+    assert await cluster.reload() == 'RELOADING'
+    for pv in clients:
+        pv.reload.assert_awaited_once()
+
+    results = [outcome async for outcome in cluster.scan_many(['/a', '/b', '/c'], ordered=True)]
+    assert [outcome.item for outcome in results] == ['/a', '/b', '/c']
+    assert all(outcome.ok for outcome in results)
+
+    await asyncio.sleep(0.02)
+    await cluster.close()
+    assert cluster.checker is None
+
+@pytest.mark.asyncio
+async def test_cluster_stream_max_length():
+    clients = [await client('small'), await client('large')]
+    for pv in clients:
+        pv.instream = mock.AsyncMock(return_value='stream: OK')
+    clients[0].set_stream_max_length(5)
+    cluster = await PyvalveCluster(clients, check_interval=0)
+
+    for _ in range(4):
+        await cluster.instream(BytesIO(b'x' * 10))
+    clients[0].instream.assert_not_called()
+    assert clients[1].instream.await_count == 4
+
+    clients[1].set_stream_max_length(5)
+    with pytest.raises(PyvalveStreamMaxLength):
+        await cluster.instream(BytesIO(b'x' * 10))
+
+@pytest.mark.asyncio
+async def test_cluster_hedging():
+    clients = [await client('slow', delay=10), await client('fast')]
+    cluster = await PyvalveCluster(clients, check_interval=0)
+    cluster.set_hedging(min_samples=1)
+    cluster.latency('scan').record(0.01)
+    cluster.latency('ping').record(0.01)
+    assert cluster.hedgeable('scan_results', ('/f',))
+    assert not cluster.hedgeable('scan_results', ('/d', 'MULTISCAN'))
+    assert not cluster.hedgeable('multiscan', ('/d',))
+    # the slow endpoint is picked first, the duplicate goes to the other one
+    cluster.endpoints[1].outstanding = 1
+    assert await cluster.scan('/f') == '/f: OK fast'
+    cluster.endpoints[1].outstanding = 0
+    assert cluster.endpoints[0].outstanding == 0
+
+    # a timeout counts as a failure but does not eject the endpoint at once
+    clients[0].ping = mock.AsyncMock(side_effect=PyvalveTimeout('slow'))
+    cluster.endpoints[1].outstanding = 1
+    assert await cluster.ping() == 'PONG'
+    assert cluster.endpoints[0].healthy and cluster.endpoints[0].failures == 1
+
+@pytest.mark.asyncio
+async def test_cluster_concurrent_one_shot(tmp_path):
+    # unpooled endpoints open a connection per call, calls in flight
+    # together must each read their own reply
+    sockets = [str(tmp_path / f'clamd{i}.socket') for i in range(2)]
+    servers = [await spawn(path, latency=0.001) for path in sockets]
+    try:
+        cluster = await PyvalveCluster(sockets, check_interval=0)
+        buffers = [BytesIO(os.urandom(1000)) for _ in range(300)]
+        results = [item async for item in cluster.instream_many(buffers, concurrency=32)]
+        assert [item.result for item in results] == ['stream: OK'] * 300
+
+        paths = []
+        for i in range(300):
+            path = tmp_path / f'file{i}'
+            path.write_bytes(b'x')
+            paths.append(str(path))
+        results = [item async for item in cluster.scan_many(paths, concurrency=32)]
+        assert sorted(item.result for item in results) == sorted(f'{path}: OK' for path in paths)
+
+        pv = cluster.endpoints[0].client
+        replies = await asyncio.gather(*(pv.ping() for _ in range(100)))
+        assert replies == ['PONG'] * 100
+        await cluster.close()
+    finally:
+        for server in servers:
+            server.terminate()
+            await server.wait()
@@ -0,0 +1,100 @@
+""" Test class for fork safety """
+import asyncio
+import socket
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Connection, ConcurrencyLimiter, ForkSafe, Pyvalve, SqliteVerdictCache
+from src.pyvalve.fork import forked
+from src.pyvalve.sync import LoopThread
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_fork_pool(session_connection):
+    pvs = await Pyvalve()
+    opened = []
+    async def open_session():
+        opened.append(session_connection(b'1: PONG\0'))
+        return opened[-1]
+    pvs.open_session = open_session
+    pool = await pvs.create_pool(min_size=1, max_size=2)
+    borrowed = await pool.acquire()
+    await pool.release(await pool.acquire())
+    assert pool.size == 2 and pool.idle == 1
+
+    # as seen by the child process
+    forked()
+    assert not borrowed.is_usable() and borrowed.inherited
+    await pool.release(borrowed)
+    assert pool.size == 0 and pool.idle == 0
+    await borrowed.close()
+    borrowed.abort()
+    borrowed.writer.close.assert_not_called()
+    borrowed.writer.transport.abort.assert_not_called()
+
+    # the child opens connections of its own
+    assert await pvs.ping() == 'PONG'
+    assert len(opened) == 3 and pool.size == 1 and pool.idle == 1
+    assert pvs.conn is None and pvs.fork_generation == ForkSafe.generation
+
+@pytest.mark.asyncio
+async def test_fork_state(tmp_path):
+    cache = SqliteVerdictCache(str(tmp_path / 'verdicts.db'))
+    await cache.set(b'a', 'stream: OK')
+    limiter = ConcurrencyLimiter(initial=2, max_limit=2)
+    await limiter.acquire()
+    await limiter.acquire()
+
+    forked()
+    parent_db = cache.database.db
+    assert await cache.get(b'a') == 'stream: OK'
+    assert cache.database.db is not parent_db and cache.database.inherited is parent_db
+    # slots taken by the parent are not waited for
+    await asyncio.wait_for(limiter.acquire(), 1)
+    assert limiter.in_flight == 1
+    cache.close()
+
+def test_fork_loop_thread():
+    thread = LoopThread()
+    parent_loop = thread.loop
+    # the parent's loop keeps running here, in a real child it is abandoned
+    forked()
+    assert thread.run(asyncio.sleep(0, 'done')) == 'done'
+    assert thread.loop is not parent_loop
+    thread.stop()
+    parent_loop.call_soon_threadsafe(parent_loop.stop)
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_fork_process():
+    async def main():
+        parent, peer = socket.socketpair()
+        reader, writer = await asyncio.open_unix_connection(sock=parent)
+        conn = Connection(reader, writer)
+        generation = ForkSafe.generation
+        pid = os.fork()
+        if pid == 0:
+            # the child must not close or read the parent's socket
+            code = 0 if ForkSafe.generation == generation + 1 else 1
+            if conn.is_usable():
+                code = 2
+            asyncio.new_event_loop().run_until_complete(conn.close())
+            os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+        assert ForkSafe.generation == generation and conn.is_usable()
+        conn.send(b'zPING\0')
+        await conn.flush()
+        assert peer.recv(16) == b'zPING\0'
+        peer.close()
+        await conn.close()
+
+    asyncio.new_event_loop().run_until_complete(main())
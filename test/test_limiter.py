@@ -0,0 +1,160 @@
+""" Test class for clamd stats and the concurrency limiter """
+import asyncio
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Pyvalve, PyvalveSocket, PyvalveResponseError, PyvalveTimeout, ConcurrencyLimiter, parse_stats
+from benchmarks.fake_clamd import spawn
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+STATS = '''POOLS: 1
+
+STATE: VALID PRIMARY
+THREADS: live 3  idle 1 max 4 idle-timeout 30
+QUEUE: 2 items
+\tmin_wait: 0.000012 max_wait: 0.250000 avg_wait: 0.125006
+
+\tSCAN 0.001203 /srv/uploads/report.pdf
+\tSTATS 0.000052
+
+MEMSTATS: heap 9.082M mmap 0.000M used 6.902M free 2.184M releasable 0.129M pools 1 pools_used 565.979M pools_total N/A
+END'''
+
+def test_parse_stats():
+    stats = parse_stats(STATS)
+    assert (stats.pools, stats.state) == (1, 'VALID PRIMARY')
+    assert (stats.threads_busy, stats.threads_free, stats.queue) == (2, 2, 2)
+    assert stats.queue_wait == 0.25
+    assert stats.tasks == [('SCAN', 0.001203, '/srv/uploads/report.pdf'), ('STATS', 0.000052, '')]
+    assert stats.memory['heap'] == 9.082 and 'pools_total' not in stats.memory
+
+    with pytest.raises(ValueError):
+        parse_stats('I like big stats and I cannot lie')
+
+@pytest.mark.asyncio
+async def test_limiter_slots():
+    limiter = ConcurrencyLimiter(initial=2, stats_interval=None)
+    await limiter.acquire()
+    await limiter.acquire()
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    limiter.release(0.01)
+    await waiter
+    assert limiter.in_flight == 2
+
+    # a cancelled wait gives its slot back
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    limiter.release()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert limiter.in_flight == 1 and not limiter._waiters
+
+    with pytest.raises(ValueError):
+        ConcurrencyLimiter(initial=0)
+
+def test_limiter_gradient():
+    limiter = ConcurrencyLimiter(initial=8, max_limit=64, stats_interval=None)
+    # latency at the baseline with the limit in use grows it
+    for _ in range(50):
+        limiter.in_flight = limiter.current
+        limiter.release(0.01)
+    assert limiter.current > 8
+    grown = limiter.limit
+
+    # queueing latency shrinks it
+    for _ in range(20):
+        limiter.in_flight = limiter.current
+        limiter.release(0.1)
+    assert limiter.limit < grown
+
+    # so do failures, multiplicatively
+    limiter.in_flight = 1
+    before = limiter.limit
+    limiter.release(dropped=True)
+    assert limiter.limit == pytest.approx(before * 0.9)
+
+    # an idle client does not grow the limit
+    limiter = ConcurrencyLimiter(initial=8, stats_interval=None)
+    for _ in range(50):
+        limiter.in_flight = 1
+        limiter.release(0.01)
+    assert limiter.current == 8
+
+def test_limiter_stats():
+    limiter = ConcurrencyLimiter(initial=16, stats_interval=0)
+    assert limiter.stats_due()
+    limiter.observe(parse_stats(STATS))
+    # capped at MaxThreads, and backed off as clamd is queueing
+    assert limiter.ceiling == 4 and limiter.current == 3
+
+    limiter = ConcurrencyLimiter(stats_interval=60)
+    assert limiter.stats_due() and not limiter.stats_due()
+
+@pytest.mark.asyncio
+async def test_pyvalve_limiter():
+    pvs = await Pyvalve()
+    pvs.stats = mock.AsyncMock(return_value=STATS)
+    assert (await pvs.server_stats()).threads_max == 4
+    pvs.stats = mock.AsyncMock(return_value='nope')
+    with pytest.raises(PyvalveResponseError):
+        await pvs.server_stats()
+
+    in_flight = []
+    async def exchange(msg, jargs):
+        in_flight.append(msg)
+        assert len(in_flight) <= 2
+        await asyncio.sleep(0.01)
+        in_flight.remove(msg)
+        return b'/f: OK' if msg == 'SCAN' else b'PONG'
+    pvs.exchange = exchange
+    pvs.use_pool = mock.Mock(return_value=True)
+    pvs.check_path = mock.AsyncMock(return_value=True)
+    pvs.stats = mock.AsyncMock(return_value=STATS)
+    limiter = ConcurrencyLimiter(initial=2, max_limit=2, stats_interval=0)
+    pvs.set_limiter(limiter)
+
+    assert await asyncio.gather(*(pvs.scan('/f') for _ in range(6))) == ['/f: OK'] * 6
+    assert limiter.stats is not None and limiter.in_flight == 0
+
+    # control commands are not limited
+    limiter.in_flight = 2
+    assert await pvs.ping() == 'PONG'
+    limiter.in_flight = 0
+
+
+@pytest.mark.asyncio
+async def test_limiter_call_timeout(tmp_path):
+    # clamd answers after the call timeout, each expiry cuts the limit
+    path = str(tmp_path / 'clamd.socket')
+    server = await spawn(path, latency=0.2)
+    try:
+        for pooled in (False, True):
+            pvs = await PyvalveSocket(path)
+            if pooled:
+                await pvs.create_pool(max_size=2)
+            pvs.set_path_check(None)
+            limiter = ConcurrencyLimiter(initial=8, stats_interval=None)
+            pvs.set_limiter(limiter)
+            pvs.set_call_timeout(0.02)
+            for _ in range(5):
+                with pytest.raises(PyvalveTimeout):
+                    await pvs.scan('/f')
+            assert limiter.in_flight == 0 and limiter.limit < 8 * 0.9 ** 4
+            if pooled:
+                await pvs.pool.close()
+    finally:
+        server.terminate()
+        await server.wait()
@@ -0,0 +1,143 @@
+""" Test class for incremental scans """
+import asyncio
+import hashlib
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Pyvalve, PyvalveScanningError, ScanManifest, map_bounded, scan_incremental, walk_tree
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_scan_incremental(tmp_path):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    for name in ('a', 'b', 'c', 'eicar', 'bad'):
+        (root / name).write_bytes(name.encode())
+    manifest = ScanManifest(str(tmp_path / 'manifest.db'), batch_size=2)
+    version = '26789'
+    scanned = []
+
+    async def scan(path):
+        name = os.path.basename(path)
+        scanned.append(name)
+        if name == 'bad':
+            raise PyvalveScanningError('clamd failed')
+        return f"{path}: {'Eicar-Signature FOUND' if name == 'eicar' else 'OK'}"
+
+    async def run():
+        async def current():
+            return version
+        scanned.clear()
+        results = [r async for r in scan_incremental(manifest, str(root), current,
+            walk_tree(str(root)), lambda changed: map_bounded(scan, changed, 2))]
+        assert sorted(scanned) == sorted(os.path.basename(r.item) for r in results)
+        return sorted(scanned)
+
+    assert await run() == ['a', 'b', 'bad', 'c', 'eicar']
+    # failed scans are tried again, the rest is unchanged
+    assert await run() == ['bad']
+
+    os.utime(root / 'a', ns=(1, 1))
+    (root / 'b').write_bytes(b'changed')
+    (root / 'd').write_bytes(b'd')
+    (root / 'c').unlink()
+    (root / 'bad').unlink()
+    # a is only touched, its content is the same
+    assert await run() == ['b', 'd']
+    assert await manifest.infected() == [(str(root / 'eicar'), f"{root / 'eicar'}: Eicar-Signature FOUND")]
+
+    # new signatures, everything is scanned again
+    version = '26790'
+    assert await run() == ['a', 'b', 'd', 'eicar']
+    manifest.close()
+
+    # the manifest is read back as it is used
+    manifest = ScanManifest(str(tmp_path / 'manifest.db'), digests=False)
+    assert manifest.run == 4
+    (root / 'c').write_bytes(b'c')
+    assert await run() == ['c']
+    # gone files were forgotten
+    count = await manifest.database.execute(lambda db: db.execute('SELECT COUNT(*) FROM files').fetchone()[0])
+    assert count == 5
+    manifest.close()
+
+def blake2b(data):
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+async def digests(manifest):
+    return [row[0] for row in await manifest.database.execute(
+        lambda db: db.execute('SELECT digest FROM files ORDER BY path').fetchall())]
+
+@pytest.mark.asyncio
+async def test_manifest_digests(tmp_path):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    for name in ('a', 'b', 'c'):
+        (root / name).write_bytes(name.encode())
+    manifest = ScanManifest(str(tmp_path / 'manifest.db'), workers=2)
+    manifest.digest = mock.Mock(wraps=manifest.digest)
+    await manifest.start('26789')
+
+    async def scan(modify=None):
+        changed = [path async for path in manifest.changed(walk_tree(str(root)))]
+        for path in changed:
+            if modify is not None:
+                modify(path)
+            await manifest.record(path, f'{path}: OK')
+        await manifest.flush()
+        return sorted(os.path.basename(path) for path in changed)
+
+    # new files are hashed once scanned, not before
+    assert await scan(lambda path: manifest.digest.assert_not_called()) == ['a', 'b', 'c']
+    assert await digests(manifest) == [blake2b(b'a'), blake2b(b'b'), blake2b(b'c')]
+
+    # changed files are hashed before, to skip them if only touched
+    os.utime(root / 'a', ns=(1, 1))
+    os.utime(root / 'b', ns=(1, 1))
+    (root / 'c').write_bytes(b'changed')
+    manifest.digest.reset_mock()
+    await manifest.start('26789')
+    assert await scan() == ['c']
+    assert manifest.digest.call_count == 3
+
+    # a new file changed after its scan is recorded without a digest, as
+    # the content hashed is not the one scanned
+    def modify(path):
+        (root / 'd').write_bytes(b'after the scan')
+    (root / 'd').write_bytes(b'd')
+    await manifest.start('26789')
+    assert await scan(modify) == ['d']
+    assert (await digests(manifest))[3] is None
+    os.utime(root / 'd', ns=(1, 1))
+    await manifest.start('26789')
+    assert await scan() == ['d']
+    manifest.close()
+
+@pytest.mark.asyncio
+async def test_scan_tree_manifest(tmp_path, session_connection):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    (root / 'a').write_bytes(b'a')
+    manifest = ScanManifest(str(tmp_path / 'manifest.db'))
+    manifest.digest = mock.Mock(wraps=manifest.digest)
+    pvs = await Pyvalve()
+    pvs.version = mock.AsyncMock(return_value='ClamAV 1.0.0/26789/Mon Jan 30 08:17:46 2023')
+    pvs.open_session = mock.AsyncMock(side_effect=lambda: session_connection(b'1: stream: OK\0'))
+
+    results = [r async for r in pvs.scan_tree(str(root), manifest=manifest)]
+    assert [r.result for r in results] == ['stream: OK']
+    assert manifest.version == '26789'
+    # the digest of a streamed file is taken from the stream
+    assert await digests(manifest) == [blake2b(b'a')]
+    manifest.digest.assert_not_called()
+    assert [r async for r in pvs.scan_tree(str(root), manifest=manifest)] == []
+    manifest.close()
@@ -0,0 +1,86 @@
+""" Test class for Pyvalve instrumentation """
+import asyncio
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Pyvalve, PyvalveResponseError, Histogram, Metrics
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_histogram():
+    histogram = Histogram()
+    # every bucket holds the values mapped to it
+    for micros in range(0, 100000, 7):
+        low, high = histogram.bounds(histogram.index(micros))
+        assert low <= micros < high
+        assert high - low <= max(1, low / 16)
+
+    for micros in range(1, 10001):
+        histogram.record(micros / 1e6)
+    assert histogram.count == 10000 and histogram.max == 0.01
+    assert histogram.quantile(0.5) == pytest.approx(0.005, rel=0.04)
+    assert histogram.quantile(0.99) == pytest.approx(0.0099, rel=0.04)
+    assert histogram.quantile(1) == 0.01
+    assert dict(histogram.cumulative((0.001, 1.0))) == pytest.approx({0.001: 1000, 1.0: 10000}, rel=0.04)
+
+    other = Histogram()
+    other.record(2.0)
+    histogram.merge(other)
+    assert histogram.count == 10001 and histogram.max == 2.0
+    assert histogram.summary()['p999'] == pytest.approx(0.01, rel=0.04)
+    assert Histogram().quantile(0.5) is None
+
+@pytest.mark.asyncio
+async def test_metrics(session_connection):
+    replies = [b'1: PONG\0', b'2: /f: OK\0', b'3: ERROR: you suck\0', b'4: PONG\0']
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(side_effect=lambda: session_connection(*replies))
+    pvs.check_path = mock.AsyncMock(return_value=True)
+    await pvs.create_pool(max_size=1)
+
+    metrics = Metrics()
+    events = []
+    metrics.add_hook(lambda event, trace: events.append((event, trace.command, trace.reused)))
+    pvs.set_metrics(metrics)
+
+    assert await pvs.ping() == 'PONG'
+    assert events == [('connect', 'PING', False), ('send', 'PING', False),
+        ('first_byte', 'PING', False), ('complete', 'PING', False)]
+    await pvs.scan('/f')
+    assert events[-1] == ('complete', 'SCAN', True)
+    with pytest.raises(PyvalveResponseError):
+        await pvs.ping()
+
+    ping, scan = metrics.snapshot()
+    assert (ping['command'], ping['endpoint'], ping['count'], ping['errors']) == ('PING', 'clamd', 2, 1)
+    assert (ping['connects'], ping['reused']) == (2, 1)
+    assert ping['bytes_sent'] == 2 * len(b'zPING\0')
+    assert scan['bytes_received'] == len(b'/f: OK')
+    assert scan['latency']['count'] == 1 and scan['buckets'][-1] == (10.0, 1)
+
+    text = metrics.prometheus()
+    assert 'pyvalve_request_seconds_count{command="PING",endpoint="clamd"} 2' in text
+    assert 'pyvalve_request_errors_total{command="PING",endpoint="clamd"} 1' in text
+    # the samples of each family follow its TYPE line
+    lines = text.splitlines()
+    for start, line in enumerate(lines):
+        if line.startswith('# TYPE'):
+            family = line.split()[2]
+            rows = [i for i, row in enumerate(lines) if row.startswith(family + '{')
+                or row.startswith(family + '_bucket{') or row.startswith(family + '_sum{')
+                or row.startswith(family + '_count{')]
+            assert rows == list(range(start + 1, start + 1 + len(rows)))
+
+    # nothing is traced without a collector
+    pvs.set_metrics(None)
+    metrics.reset()
+    assert await pvs.ping() == 'PONG'
+    assert metrics.snapshot() == [] and len(events) == 12
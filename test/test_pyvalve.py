@@ -1,11 +1,12 @@
 """ Test class for Pyvalve """
 import asyncio
 import pytest
-from io import BytesIO
+from contextlib import aclosing
+from io import BytesIO, RawIOBase
 
-import sys, os
+import sys, os, socket, threading, time
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
-from src.pyvalve import Connection, Pyvalve, PyvalveSocket,  PyvalveNetwork, PyvalveResponseError, PyvalveConnectionError, PyvalveScanningError
+from src.pyvalve import Connection, ConnectionPool, Session, ChunkSizer, default_chunk_size, ScanResult, parse_results, index_results, Pyvalve, PyvalveSocket,  PyvalveNetwork, PyvalveResponseError, PyvalveStreamMaxLength, PyvalveConnectionError, PyvalveScanningError, PyvalveTimeout, LatencyWindow, deadline, first_of, remaining_length
 from unittest import mock
 
 
@@ -75,15 +76,20 @@ async def test_check_path():
     pvs = await Pyvalve()
     result = await pvs.check_path('abc/123')
     assert result is False
+    assert await pvs.check_path(os.path.abspath(__file__)) is True
+    assert await pvs.check_paths(['abc/123', __file__]) == [False, True]
 
-    with mock.patch('src.pyvalve.AsyncPath.exists') as mock_exists:
+    pvs.set_path_check('stat')
+    assert await pvs.check_path('abc/123') is False
+    assert await pvs.check_paths(['abc/123', __file__]) == [False, True]
 
-        future = asyncio.Future()
-        future.set_result(True)
-        mock_exists = mock.AsyncMock(return_value=future)
+    # no check, clamd reports missing paths
+    pvs.set_path_check(None)
+    assert await pvs.check_path('abc/123') is True
+    assert await pvs.check_paths(['abc/123']) == [True]
 
-        pvs = await Pyvalve()
-        await pvs.check_path('abc/123')
+    with pytest.raises(ValueError):
+        pvs.set_path_check('aiopath')
 
 @pytest.mark.asyncio
 async def test_send_instream():
@@ -276,7 +282,7 @@ async def test_shutdown():
 async def test_scan():
     # test scan command
 
-    with mock.patch('src.pyvalve.AsyncPath.exists') as mock_exists:
+    with mock.patch('src.pyvalve.commands.os.path.exists', return_value=True):
         reader = asyncio.StreamReader()
         writer = mock.Mock(asyncio.StreamWriter)
         conn = Connection(reader, writer)
@@ -315,7 +321,7 @@ async def test_scan():
 async def test_contscan():
     # test test_contscan command
 
-    with mock.patch('src.pyvalve.AsyncPath.exists') as mock_exists:
+    with mock.patch('src.pyvalve.commands.os.path.exists', return_value=True):
         reader = asyncio.StreamReader()
         writer = mock.Mock(asyncio.StreamWriter)
         conn = Connection(reader, writer)
@@ -354,7 +360,7 @@ async def test_contscan():
 async def test_multiscan():
     # test test_multiscan command
 
-    with mock.patch('src.pyvalve.AsyncPath.exists') as mock_exists:
+    with mock.patch('src.pyvalve.commands.os.path.exists', return_value=True):
         reader = asyncio.StreamReader()
         writer = mock.Mock(asyncio.StreamWriter)
         conn = Connection(reader, writer)
@@ -393,7 +399,7 @@ async def test_multiscan():
 async def test_allmatchscan():
     # test test_allmatchscan command
 
-    with mock.patch('src.pyvalve.AsyncPath.exists') as mock_exists:
+    with mock.patch('src.pyvalve.commands.os.path.exists', return_value=True):
         reader = asyncio.StreamReader()
         writer = mock.Mock(asyncio.StreamWriter)
         conn = Connection(reader, writer)
@@ -457,3 +463,844 @@ async def test_close():
     pvs.set_connection(conn)
     result = await pvs.close()
     assert result is None
+
+
+@pytest.mark.asyncio
+async def test_connection_pool(session_connection):
+    # test connections are reused
+    factory = mock.AsyncMock(side_effect=lambda: session_connection())
+    pool = ConnectionPool(factory, max_size=2)
+
+    conn = await pool.acquire()
+    await pool.release(conn)
+    async with pool.connection() as conn2:
+        assert conn2 is conn
+    assert factory.await_count == 1
+    assert pool.size == 1 and pool.idle == 1
+
+    # test connections are discarded on error
+    with pytest.raises(RuntimeError):
+        async with pool.connection():
+            raise RuntimeError('boom')
+    assert pool.size == 0
+
+    # test max lifetime
+    pool = ConnectionPool(factory, max_lifetime=0)
+    conn = await pool.acquire()
+    await pool.release(conn)
+    assert pool.size == 0
+
+    # test we raise the right errors
+    pool = ConnectionPool(factory, max_size=1, acquire_timeout=0.01)
+    conn = await pool.acquire()
+    with pytest.raises(PyvalveConnectionError):
+        await pool.acquire()
+    await pool.release(conn)
+    await pool.close()
+    with pytest.raises(PyvalveConnectionError):
+        await pool.acquire()
+
+    with pytest.raises(ValueError):
+        ConnectionPool(factory, min_size=3, max_size=2)
+
+@pytest.mark.asyncio
+async def test_connection_pool_fill(session_connection):
+    factory = mock.AsyncMock(side_effect=lambda: session_connection())
+    pool = ConnectionPool(factory, min_size=2, idle_timeout=0)
+    await pool.fill()
+    assert pool.size == 2 and pool.idle == 2
+
+    # idle connections below min_size are kept
+    conn = await pool.acquire()
+    await pool.release(conn)
+    assert pool.size == 2
+
+@pytest.mark.asyncio
+async def test_send_command_pooled(session_connection):
+    conn = session_connection(b'1: PONG\0', b'2: ERROR: you suck\0')
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    pool = await pvs.create_pool(max_size=1)
+
+    result = await pvs.ping()
+    assert result == 'PONG'
+    conn.writer.write.assert_called_with(b'zPING\0')
+
+    # the pool can be shared between instances
+    other = await Pyvalve()
+    other.set_pool(pool)
+    with pytest.raises(PyvalveResponseError):
+        await other.ping()
+    assert pvs.open_session.await_count == 1
+
+    # commands not allowed in a session use their own connection
+    reader = asyncio.StreamReader()
+    writer = mock.Mock(asyncio.StreamWriter)
+    single = Connection(reader, writer)
+    reader.feed_data(b'RELOADING\n')
+    reader.feed_eof()
+    pvs.get_connection = mock.AsyncMock(return_value=single)
+    pvs.set_connection(single)
+    assert await pvs.reload() == 'RELOADING'
+
+@pytest.mark.asyncio
+async def test_send_instream_pooled(session_connection):
+    conn = session_connection(b'1: stream: OK\0')
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    pvs.set_persistant_connection(True)
+
+    result = await pvs.instream(BytesIO(b'clean'))
+
+    assert result == 'stream: OK'
+    conn.writer.write.assert_any_call(b'zINSTREAM\0')
+
+    async with pvs.acquire() as pooled:
+        assert pooled is conn
+
+@pytest.mark.asyncio
+async def test_read_reply_wrong_id(session_connection):
+    conn = session_connection(b'2: PONG\0')
+    with pytest.raises(PyvalveResponseError):
+        await conn.request(b'zPING\0')
+
+    conn = session_connection(b'1: PO')
+    conn.reader.feed_eof()
+    with pytest.raises(PyvalveConnectionError):
+        await conn.request(b'zPING\0')
+
+@pytest.mark.asyncio
+async def test_session(session_connection):
+    # replies arrive out of order and are matched by request id
+    conn = session_connection()
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    pvs.check_path = mock.AsyncMock(return_value=True)
+
+    async with pvs.session() as session:
+        tasks = asyncio.gather(
+            session.scan('/tmp/eicar.com.txt'),
+            session.ping(),
+            session.instream(BytesIO(b'clean')),
+        )
+        await asyncio.sleep(0)
+        conn.reader.feed_data(b'2: PONG\0')
+        conn.reader.feed_data(b'3: stream: OK\0')
+        conn.reader.feed_data(b'1: /tmp/eicar.com.txt: Win.Test.EICAR_HDB-1 FOUND\0')
+        scan, ping, stream = await tasks
+
+    assert ping == 'PONG'
+    assert stream == 'stream: OK'
+    assert 'Win.Test.EICAR_HDB-1 FOUND' in scan
+    conn.writer.write.assert_any_call(b'zSCAN /tmp/eicar.com.txt\0')
+    conn.writer.write.assert_any_call(b'zINSTREAM\0')
+    assert conn.request_id == 3
+    assert pvs.pool.idle == 1
+
+@pytest.mark.asyncio
+async def test_session_errors(session_connection):
+    conn = session_connection()
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+
+    # test we raise the right errors
+    with pytest.raises(PyvalveResponseError):
+        async with pvs.session() as session:
+            task = asyncio.ensure_future(session.version())
+            await asyncio.sleep(0)
+            conn.reader.feed_data(b'1: ERROR: you suck\0')
+            await task
+
+    # a closed session fails every request in flight
+    conn = session_connection()
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    async with pvs.session() as session:
+        tasks = asyncio.gather(session.ping(), session.ping(), return_exceptions=True)
+        await asyncio.sleep(0)
+        conn.reader.feed_data(b'1: PONG\0')
+        conn.reader.feed_eof()
+        first, second = await tasks
+        assert first == 'PONG'
+        assert isinstance(second, PyvalveConnectionError)
+        with pytest.raises(PyvalveConnectionError):
+            await session.ping()
+
+def test_parse_results():
+    data = (b'/data/eicar.com.txt: Win.Test.EICAR_HDB-1 FOUND\n'
+        b'/data/eicar.com.txt: Eicar-Signature FOUND\n'
+        b'/data/ERROR.txt: OK\n'
+        b'/data/a: b.txt: OK\n'
+        b'/data/secret: lstat() failed: Permission denied. ERROR\n')
+    results = parse_results(data)
+
+    assert results == [
+        ScanResult('/data/eicar.com.txt', ScanResult.FOUND,
+            ('Win.Test.EICAR_HDB-1', 'Eicar-Signature')),
+        ScanResult('/data/ERROR.txt', ScanResult.OK),
+        ScanResult('/data/a: b.txt', ScanResult.OK),
+        ScanResult('/data/secret', ScanResult.ERROR,
+            reason='lstat() failed: Permission denied.'),
+    ]
+    assert results[0].infected and not results[1].infected
+
+    index = index_results(parse_results(b'stream: OK\0'))
+    assert index['stream'].status == ScanResult.OK
+
+    result, = parse_results(b'ERROR: you suck\n')
+    assert result.path == '' and result.status == ScanResult.ERROR
+
+@pytest.mark.asyncio
+async def test_scan_results():
+    reader = asyncio.StreamReader()
+    writer = mock.Mock(asyncio.StreamWriter)
+    conn = Connection(reader, writer)
+
+    pvs = await Pyvalve()
+    pvs.get_connection = mock.AsyncMock(return_value=conn)
+    pvs.check_path = mock.AsyncMock(return_value=True)
+    pvs.set_connection(conn)
+
+    conn.reader.feed_data(b'/tmp/ERROR/eicar.com.txt: Win.Test.EICAR_HDB-1 FOUND\n'
+        b'/tmp/ERROR/clean.txt: OK\n')
+    conn.reader.feed_eof()
+
+    index = await pvs.scan_index('/tmp/ERROR', 'CONTSCAN')
+
+    writer.write.assert_called_with(b'nCONTSCAN /tmp/ERROR\n')
+    assert index['/tmp/ERROR/eicar.com.txt'].signatures == ('Win.Test.EICAR_HDB-1',)
+    assert index['/tmp/ERROR/clean.txt'].status == ScanResult.OK
+
+    # test we raise the right errors
+    with pytest.raises(ValueError):
+        await pvs.scan_results('/tmp', 'PING')
+
+    reader = asyncio.StreamReader()
+    conn = Connection(reader, writer)
+    pvs.set_connection(conn)
+    conn.reader.feed_data(b'UNKNOWN COMMAND\n')
+    conn.reader.feed_eof()
+    with pytest.raises(PyvalveResponseError):
+        await pvs.scan_results('/tmp')
+
+@pytest.mark.asyncio
+async def test_iter_scan():
+    reader = asyncio.StreamReader()
+    writer = mock.Mock(asyncio.StreamWriter)
+    writer.is_closing = mock.Mock(return_value=False)
+    conn = Connection(reader, writer)
+
+    pvs = await Pyvalve()
+    pvs.open_connection = mock.AsyncMock(return_value=conn)
+    pvs.check_path = mock.AsyncMock(return_value=True)
+
+    # results are yielded before clamd finishes
+    reader.feed_data(b'/data/a.txt: OK\n')
+    results = pvs.iter_multiscan('/data')
+    first = await results.__anext__()
+    assert first == ScanResult('/data/a.txt', ScanResult.OK)
+    writer.write.assert_called_with(b'nMULTISCAN /data\n')
+
+    reader.feed_data(b'/data/eicar.com.txt: Win.Test.EICAR_HDB-1 FOUND\n')
+    reader.feed_eof()
+    assert [result.path async for result in results] == ['/data/eicar.com.txt']
+    writer.close.assert_called()
+
+    # matches for the same file are merged
+    reader = asyncio.StreamReader()
+    conn = Connection(reader, writer)
+    pvs.open_connection = mock.AsyncMock(return_value=conn)
+    reader.feed_data(b'/data/eicar.com.txt: Win.Test.EICAR_HDB-1 FOUND\n'
+        b'/data/eicar.com.txt: Eicar-Signature FOUND\n/data/a.txt: OK\n')
+    reader.feed_eof()
+    results = [result async for result in pvs.iter_allmatchscan('/data')]
+    assert results[0].signatures == ('Win.Test.EICAR_HDB-1', 'Eicar-Signature')
+    assert len(results) == 2
+
+    # test we raise the right errors
+    reader = asyncio.StreamReader()
+    conn = Connection(reader, writer)
+    pvs.open_connection = mock.AsyncMock(return_value=conn)
+    reader.feed_data(b'UNKNOWN COMMAND\n')
+    reader.feed_eof()
+    with pytest.raises(PyvalveResponseError):
+        async for result in pvs.iter_contscan('/data'):
+            pass
+
+    pvs.check_path = mock.AsyncMock(return_value=False)
+    with pytest.raises(PyvalveScanningError):
+        async for result in pvs.iter_multiscan('/data'):
+            pass
+
+@pytest.mark.asyncio
+async def test_send_instream_chunks():
+    # header and payload are written together, without concatenation
+    reader = asyncio.StreamReader()
+    writer = mock.Mock(asyncio.StreamWriter)
+    conn = Connection(reader, writer)
+
+    pvs = await Pyvalve()
+    pvs.get_connection = mock.AsyncMock(return_value=conn)
+    pvs.set_connection(conn)
+    pvs.set_stream_buffer(4)
+
+    chunks = []
+    async def drain():
+        if len(chunks) == 2:
+            reader.feed_data(b'stream: OK\n')
+            reader.feed_eof()
+    writer.writelines = mock.Mock(side_effect=lambda data: chunks.append(tuple(data)))
+    writer.drain = mock.AsyncMock(side_effect=drain)
+
+    result = await pvs.instream(BytesIO(b'abcdefghij'))
+
+    assert result == 'stream: OK'
+    assert chunks[0] == (b'\x00\x00\x00\x04', b'abcd')
+    assert isinstance(chunks[0][1], memoryview)
+    writer.write.assert_called_with(b'\x00\x00\x00\x00')
+    assert writer.drain.await_count == 4
+
+@pytest.mark.asyncio
+async def test_instream_async_sources(session_connection):
+    pvs = await Pyvalve()
+    pvs.set_stream_buffer(4)
+
+    def written(conn):
+        return [bytes(call.args[0][1]) for call in conn.writer.writelines.call_args_list]
+
+    # async iterables are sent as they come, large chunks are sliced
+    closed = []
+    async def body():
+        try:
+            for chunk in (b'ab', b'', b'cdefghij'):
+                yield chunk
+        finally:
+            closed.append(True)
+    conn = session_connection(b'1: stream: OK\0')
+    assert await pvs.send_stream(conn, b'zINSTREAM\0', body()) == 'stream: OK'
+    assert written(conn) == [b'ab', b'cdef', b'ghij']
+    conn.writer.write.assert_called_with(b'\x00\x00\x00\x00')
+    assert closed == [True]
+
+    # StreamReaders are read a chunk at a time and left open
+    source = asyncio.StreamReader()
+    source.feed_data(b'abcdefghij')
+    source.feed_eof()
+    assert remaining_length(source) is None
+    conn = session_connection(b'1: stream: OK\0')
+    assert await pvs.send_stream(conn, b'zINSTREAM\0', source) == 'stream: OK'
+    assert written(conn) == [b'abcd', b'efgh', b'ij']
+
+    # async file objects are closed
+    class AsyncFile():
+        def __init__(self, data):
+            self.data = BytesIO(data)
+            self.closed = False
+        async def read(self, size=-1):
+            return self.data.read(size)
+        async def close(self):
+            self.closed = True
+    file = AsyncFile(b'abcdef')
+    session = Session(pvs, session_connection(b'1: stream: OK\0'))
+    await session.start()
+    assert await session.instream(file) == 'stream: OK'
+    assert written(session.conn) == [b'abcd', b'ef'] and file.closed
+    await session.stop()
+
+    # the length is unknown, the limit is checked while streaming
+    pvs.set_stream_max_length(6)
+    closed.clear()
+    conn = session_connection()
+    with pytest.raises(PyvalveStreamMaxLength):
+        await pvs.send_stream(conn, b'zINSTREAM\0', body())
+    conn.writer.transport.abort.assert_called_once()
+    assert closed == [True]
+
+def test_chunk_sizer():
+    assert default_chunk_size(10) == 16 << 10
+    assert default_chunk_size(100 << 10) == 100 << 10
+    assert default_chunk_size(100 << 20) == 256 << 10
+    assert default_chunk_size(None) == 256 << 10
+
+    # the size keeps growing while throughput improves, and turns back once it drops
+    sizer = ChunkSizer(1024, 8192, size=2048, window=0)
+    sizer.record(2048, 1.0)
+    sizer.record(2048, 1.0)
+    assert sizer.size == 4096
+    sizer.record(4096, 1.0)
+    sizer.record(4096, 1.0)
+    assert sizer.size == 8192
+    sizer.record(8192, 1.0)
+    sizer.record(8192, 1.0)
+    assert sizer.size == 8192
+    sizer.record(8192, 4.0)
+    sizer.record(8192, 4.0)
+    assert sizer.size == 4096
+
+    with pytest.raises(ValueError):
+        ChunkSizer(0, 1024)
+
+@pytest.mark.asyncio
+async def test_send_instream_adaptive(session_connection):
+    conn = session_connection(b'1: stream: OK\0', b'2: stream: OK\0')
+    pvs = await Pyvalve()
+    pvs.set_adaptive_stream_buffer(min_size=16 << 10, max_size=64 << 10)
+    payload = BytesIO(b'x' * (1 << 20))
+
+    assert await pvs.send_stream(conn, b'zINSTREAM\0', payload) == 'stream: OK'
+    sizes = [len(call.args[0][1]) for call in conn.writer.writelines.call_args_list]
+    assert sum(sizes) == 1 << 20
+    assert sizes[0] == 64 << 10 and set(sizes) <= {16 << 10, 32 << 10, 64 << 10}
+    # the learned size stays with the connection
+    sizer = conn.sizer
+    assert await pvs.send_stream(conn, b'zINSTREAM\0', BytesIO(b'x' * 10)) == 'stream: OK'
+    assert conn.sizer is sizer and pvs.sizer is None
+
+    with pytest.raises(ValueError):
+        pvs.set_adaptive_stream_buffer(min_size=1024, max_size=512)
+
+@pytest.mark.asyncio
+async def test_send_instream_early_reply():
+    # writing stops as soon as clamd replies
+    reader = asyncio.StreamReader()
+    writer = mock.Mock(asyncio.StreamWriter)
+    conn = Connection(reader, writer)
+
+    pvs = await Pyvalve()
+    pvs.get_connection = mock.AsyncMock(return_value=conn)
+    pvs.set_connection(conn)
+    pvs.set_stream_buffer(4)
+
+    async def drain():
+        await asyncio.sleep(0)
+        if writer.writelines.call_count == 2:
+            reader.feed_data(b'INSTREAM size limit exceeded. ERROR\n')
+            reader.feed_eof()
+    writer.drain = mock.AsyncMock(side_effect=drain)
+
+    with pytest.raises(PyvalveStreamMaxLength):
+        await pvs.instream(BytesIO(os.urandom(4096)))
+    assert writer.writelines.call_count < 4
+    # the limit is learned from the rejection
+    assert pvs.stream_max_length == conn.streamed - 1
+
+    # a broken pipe without a reply is a connection error
+    reader = asyncio.StreamReader()
+    conn = Connection(reader, writer)
+    pvs.set_connection(conn)
+    pvs.set_stream_max_length(None)
+    writer.drain = mock.AsyncMock(side_effect=BrokenPipeError('gone'))
+    reader.feed_eof()
+
+    with pytest.raises(PyvalveConnectionError):
+        await pvs.instream(BytesIO(b'abcdefghij'))
+
+@pytest.mark.asyncio
+async def test_stream_max_length(session_connection):
+    class Pipe(RawIOBase):
+        def __init__(self, data):
+            self.data = BytesIO(data)
+        def readable(self):
+            return True
+        def readinto(self, buffer):
+            return self.data.readinto(buffer)
+
+    conn = session_connection(b'1: stream: OK\0')
+    pvs = await Pyvalve()
+    pvs.set_stream_max_length(8)
+    pvs.set_stream_buffer(4)
+
+    # known lengths are rejected before sending anything
+    buffer = BytesIO(b'x' * 9)
+    with pytest.raises(PyvalveStreamMaxLength):
+        await pvs.send_stream(conn, b'zINSTREAM\0', buffer)
+    conn.writer.write.assert_not_called()
+    assert not buffer.closed
+    assert await pvs.send_stream(conn, b'zINSTREAM\0', BytesIO(b'x' * 8)) == 'stream: OK'
+
+    # unknown lengths are cut off at the limit
+    conn = session_connection()
+    with pytest.raises(PyvalveStreamMaxLength):
+        await pvs.send_stream(conn, b'zINSTREAM\0', Pipe(b'x' * 100))
+    assert conn.writer.writelines.call_count == 2
+    conn.writer.transport.abort.assert_called_once()
+
+    # sessions check before sending too
+    session = Session(pvs, session_connection())
+    with pytest.raises(PyvalveStreamMaxLength):
+        await session.instream(BytesIO(b'x' * 9))
+    assert session.error is None
+    session.conn.writer.write.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_instream_file(tmp_path, session_connection):
+    path = tmp_path / 'upload.bin'
+    path.write_bytes(b'abcdefghij')
+
+    def instream_client():
+        reader = asyncio.StreamReader()
+        writer = mock.Mock(asyncio.StreamWriter)
+        conn = Connection(reader, writer)
+        reader.feed_data(b'stream: OK\n')
+        reader.feed_eof()
+        return conn
+
+    # the payload is handed to sendfile
+    conn = instream_client()
+    pvs = await Pyvalve()
+    pvs.get_connection = mock.AsyncMock(return_value=conn)
+    pvs.set_connection(conn)
+    loop = asyncio.get_running_loop()
+    with mock.patch.object(loop, 'sendfile', mock.AsyncMock(return_value=10)) as sendfile:
+        result = await pvs.instream_file(str(path))
+    assert result == 'stream: OK'
+    assert sendfile.await_args.args[2:] == (0, 10)
+    conn.writer.write.assert_any_call(b'\x00\x00\x00\x0a')
+
+    # transports without sendfile get memory mapped chunks
+    conn = instream_client()
+    pvs.set_connection(conn)
+    pvs.get_connection = mock.AsyncMock(return_value=conn)
+    with mock.patch.object(loop, 'sendfile', side_effect=RuntimeError('unsupported')):
+        await pvs.instream_file(str(path))
+    chunk = conn.writer.write.call_args_list[2].args[0]
+    assert isinstance(chunk, memoryview)
+
+    # files that can not be mapped are read
+    conn = instream_client()
+    pvs.set_connection(conn)
+    pvs.get_connection = mock.AsyncMock(return_value=conn)
+    with mock.patch.object(loop, 'sendfile', side_effect=RuntimeError('unsupported')):
+        with mock.patch('src.pyvalve.streams.mmap.mmap', side_effect=OSError('unsupported')):
+            await pvs.instream_file(str(path))
+    conn.writer.write.assert_any_call(b'abcdefghij')
+
+    # test we raise the right errors
+    with pytest.raises(PyvalveScanningError):
+        await pvs.instream_file(str(tmp_path / 'missing.bin'))
+
+    # files refused before streaming are closed
+    opened = []
+    real_open = open
+    def tracked_open(*args):
+        opened.append(real_open(*args))
+        return opened[-1]
+    pvs.set_stream_max_length(5)
+    session = Session(pvs, session_connection())
+    with mock.patch('builtins.open', side_effect=tracked_open):
+        for client in (pvs, session):
+            with pytest.raises(PyvalveStreamMaxLength):
+                await client.instream_file(str(path))
+    assert len(opened) == 2 and all(file.closed for file in opened)
+
+def fildes_server(path):
+    """ Fake clamd answering one FILDES request over a unix socket """
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            data, fds = b'', []
+            while not fds:
+                msg, received, _, _ = socket.recv_fds(conn, 1024, 1)
+                data += msg
+                fds += received
+            assert data.startswith(b'nFILDES\n')
+            with os.fdopen(fds[0], 'rb') as scanned:
+                found = b'EICAR' in scanned.read()
+            verdict = b'Eicar-Signature FOUND' if found else b'OK'
+            conn.sendall(b'fd[%d]: %s\n' % (fds[0], verdict))
+        server.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return thread
+
+@pytest.mark.asyncio
+async def test_scan_auto(tmp_path):
+    shared = tmp_path / 'shared'
+    (shared / 'spill').mkdir(parents=True)
+    (shared / 'file').write_bytes(b'x' * 10)
+    (tmp_path / 'private').write_bytes(b'x' * 10)
+
+    pvs = await Pyvalve()
+    pvs.set_routing({str(shared): '/clamd'}, spill_dir=str(shared / 'spill'), spill_min=100)
+    scanned = []
+    async def send_command(msg, path):
+        local = str(shared / 'spill' / os.path.basename(path))
+        mode = os.stat(local).st_mode & 0o777 if os.path.exists(local) else None
+        scanned.append((path, mode))
+        return f'{path}: OK'
+    pvs.send_command = mock.AsyncMock(side_effect=send_command)
+    pvs.instream = mock.AsyncMock(return_value='stream: OK')
+    pvs.instream_file = mock.AsyncMock(return_value='stream: OK')
+
+    # shared paths are scanned in place, under the name clamd knows them by
+    result = await pvs.scan_auto(str(shared / 'file'))
+    assert (result.route, result.size) == ('SCAN', 10)
+    assert result.response == f"{shared / 'file'}: OK"
+    assert scanned[-1][0] == '/clamd/file'
+
+    result = await pvs.scan_auto(str(tmp_path / 'private'))
+    assert result.route == 'INSTREAM'
+    pvs.instream_file.assert_awaited_once_with(str(tmp_path / 'private'))
+
+    # small content is streamed, large content is spilled
+    assert (await pvs.scan_auto(b'x' * 10)).route == 'INSTREAM'
+    result = await pvs.scan_auto(BytesIO(b'x' * 100))
+    assert (result.route, result.response) == ('SPILL', 'stream: OK')
+    # readable by the group, not by every user
+    assert scanned[-1][0].startswith('/clamd/spill/pyvalve-') and scanned[-1][1] == 0o640
+    assert os.listdir(shared / 'spill') == []
+
+    # streams over StreamMaxLength are spilled too
+    pvs.set_stream_max_length(5)
+    assert (await pvs.scan_auto(b'x' * 10)).route == 'SPILL'
+
+    with pytest.raises(PyvalveScanningError):
+        await pvs.scan_auto(str(tmp_path / 'missing'))
+    with pytest.raises(PyvalveScanningError):
+        await pvs.scan_auto(str(tmp_path))
+
+    # a local clamd gets the file descriptor
+    pvs = await PyvalveSocket()
+    pvs.scan_fd = mock.AsyncMock(return_value='fd[7]: OK')
+    result = await pvs.scan_auto(str(tmp_path / 'private'))
+    assert (result.route, result.response) == ('FILDES', f"{tmp_path / 'private'}: OK")
+
+    # and spilled content, the file staying private
+    pvs.set_routing(spill_dir=str(shared / 'spill'), spill_min=100)
+    modes = []
+    async def scan_fd(fd):
+        modes.append((os.fstat(fd).st_mode & 0o777, os.read(fd, 4)))
+        return f'fd[{fd}]: OK'
+    pvs.scan_fd = scan_fd
+    result = await pvs.scan_auto(b'y' * 100)
+    assert (result.route, result.response) == ('SPILL', 'stream: OK')
+    assert modes == [(0o600, b'yyyy')] and os.listdir(shared / 'spill') == []
+
+    # only a local clamd takes file descriptors
+    with pytest.raises(PyvalveConnectionError):
+        await (await Pyvalve()).scan_fd(0)
+
+@pytest.mark.asyncio
+async def test_socket_scan_fd(tmp_path):
+    sock_path = str(tmp_path / 'clamd.sock')
+    thread = fildes_server(sock_path)
+    scanned = tmp_path / 'eicar.com.txt'
+    scanned.write_bytes(b'X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*')
+
+    pvs = await PyvalveSocket(sock_path)
+    with open(scanned, 'rb') as fileobj:
+        result = await pvs.scan_fd(fileobj)
+    thread.join()
+
+    assert result.startswith('fd[') and result.endswith('Eicar-Signature FOUND')
+
+    # test we raise the right errors
+    reader = asyncio.StreamReader()
+    writer = mock.Mock(asyncio.StreamWriter)
+    writer.get_extra_info = mock.Mock(return_value=None)
+    with pytest.raises(PyvalveConnectionError):
+        await Connection(reader, writer).send_fd(0)
+
+def fill(sock):
+    """ Write to a non-blocking socket until its send buffer is full """
+    filled = 0
+    for size in (65536, 1):
+        try:
+            while True:
+                filled += sock.send(b'x' * size)
+        except BlockingIOError:
+            pass
+    return filled
+
+def read_fd(sock, size):
+    """ Read size bytes and the descriptor passed after them """
+    data, fds = b'', []
+    while not fds:
+        msg, received, _, _ = socket.recv_fds(sock, 65536, 1)
+        data += msg
+        fds += received
+    assert len(data) == size + 1
+    return fds[0]
+
+@pytest.mark.asyncio
+async def test_send_fd_backpressure():
+    for command in (b'zFILDES\0', b''):
+        ours, peer = socket.socketpair()
+        ours.setblocking(False)
+        filled = fill(ours)
+        reader, writer = await asyncio.open_unix_connection(sock=ours)
+        conn = Connection(reader, writer)
+        # the command waits in the transport buffer, or the socket itself is full
+        writer.write(command)
+        assert writer.transport.get_write_buffer_size() == len(command)
+        task = asyncio.create_task(conn.send_fd(0))
+
+        # waiting for the peer to read does not spin the loop
+        started = time.process_time()
+        await asyncio.sleep(0.2)
+        assert not task.done() and time.process_time() - started < 0.1
+
+        fd = await asyncio.to_thread(read_fd, peer, filled + len(command))
+        await task
+        assert os.path.sameopenfile(fd, 0)
+        os.close(fd)
+        writer.close()
+        peer.close()
+
+@pytest.mark.asyncio
+async def test_run_many(session_connection):
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(side_effect=lambda: session_connection())
+    in_flight = []
+
+    async def operation(conn, item):
+        in_flight.append(item)
+        assert len(in_flight) <= 3
+        await asyncio.sleep(0.001 * (10 - item))
+        in_flight.remove(item)
+        if item == 4:
+            raise PyvalveScanningError('Path not found')
+        return f'{item}: OK'
+
+    results = [r async for r in pvs.run_many(operation, range(10), concurrency=3)]
+    assert sorted(r.index for r in results) == list(range(10))
+    assert [r.index for r in results] != list(range(10))
+    failed, = [r for r in results if not r.ok]
+    assert failed.item == 4 and isinstance(failed.error, PyvalveScanningError)
+    assert pvs.open_session.await_count <= 3
+
+    results = [r async for r in pvs.run_many(operation, range(10), concurrency=3, ordered=True)]
+    assert [r.index for r in results] == list(range(10))
+    assert results[5].result == '5: OK'
+
+    # leaving the loop early stops the batch
+    async with aclosing(pvs.run_many(operation, iter(range(1000)), concurrency=3)) as batch:
+        async for result in batch:
+            break
+
+    with pytest.raises(ValueError):
+        async for result in pvs.run_many(operation, range(10), concurrency=0):
+            pass
+
+@pytest.mark.asyncio
+async def test_scan_many(session_connection):
+    conn = session_connection(b'1: /tmp/a: OK\0', b'2: /tmp/b: Eicar-Signature FOUND\0', b'3: stream: OK\0')
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    pvs.check_path = mock.AsyncMock(side_effect=lambda path: path != '/tmp/missing')
+
+    results = [r async for r in pvs.scan_many(['/tmp/a', '/tmp/missing', '/tmp/b'], concurrency=1, ordered=True)]
+
+    assert [r.result for r in results] == ['/tmp/a: OK', None, '/tmp/b: Eicar-Signature FOUND']
+    assert isinstance(results[1].error, PyvalveScanningError)
+    conn.writer.write.assert_any_call(b'zSCAN /tmp/b\0')
+
+    pvs.set_pool(ConnectionPool(pvs.open_session))
+    results = [r async for r in pvs.instream_many([BytesIO(b'clean')], concurrency=1)]
+    assert results[0].result == 'stream: OK'
+    assert pvs.open_session.await_count == 2
+
+@pytest.mark.asyncio
+async def test_call_timeout(session_connection):
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(side_effect=lambda: session_connection())
+    pool = await pvs.create_pool(max_size=1)
+
+    # clamd never answers, the connection is discarded
+    pvs.set_call_timeout(0.01)
+    with pytest.raises(PyvalveTimeout):
+        await pvs.ping()
+    assert pool.size == 0
+
+    # a deadline bounds every call in the block, nested ones only shorten it
+    pvs.set_call_timeout(None)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    with pytest.raises(PyvalveConnectionError):
+        with deadline(0.02):
+            with deadline(10):
+                await pvs.ping()
+    assert loop.time() - started < 1
+
+    # connecting is bounded by the client timeout
+    async def hang(*args, **kwargs):
+        await asyncio.sleep(10)
+    with mock.patch('src.pyvalve.asyncio.open_connection', side_effect=hang) as opener:
+        pvn = await PyvalveNetwork(timeout=0.01)
+        with pytest.raises(PyvalveTimeout):
+            await pvn.get_connection()
+        assert 'ssl_handshake_timeout' not in opener.call_args.kwargs
+
+@pytest.mark.asyncio
+async def test_session_deadline(session_connection):
+    loop = asyncio.get_running_loop()
+    def slow_connection():
+        conn = session_connection()
+        def write(data):
+            if data == b'zPING\0':
+                reply = f'{conn.request_id + 1}: PONG\0'.encode()
+                loop.call_later(0.1, conn.reader.feed_data, reply)
+        conn.writer.write = mock.Mock(side_effect=write)
+        conn.writer.is_closing = mock.Mock(side_effect=lambda: conn.writer.close.called)
+        return conn
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(side_effect=slow_connection)
+    pool = await pvs.create_pool(max_size=1)
+
+    # a deadline hit while a reply is owed leaves the session out of
+    # sync, its connection is not reused
+    async with pvs.session() as session:
+        with pytest.raises(PyvalveConnectionError):
+            with deadline(0.02):
+                await session.ping()
+        assert session.error is not None
+    assert pool.size == 0
+    assert await pvs.ping() == 'PONG'
+    assert pvs.open_session.await_count == 2
+
+def test_latency_window():
+    window = LatencyWindow(size=100)
+    assert window.quantile(0.5) is None
+    for latency in range(200):
+        window.record(latency)
+    assert len(window) == 100
+    assert window.quantile(0.95) == 195
+    assert window.quantile(1) == 199
+
+@pytest.mark.asyncio
+async def test_hedging():
+    started = []
+    async def request():
+        started.append(asyncio.current_task())
+        await asyncio.sleep(10 if len(started) == 1 else 0)
+        return len(started)
+
+    assert await first_of(request, 0.01) == 2
+    assert started[0].cancelled()
+
+    async def exchange(msg, jargs):
+        if pvs.exchange.await_count == 1:
+            await asyncio.sleep(10)
+        return b'PONG'
+    pvs = await Pyvalve()
+    pvs.exchange = mock.AsyncMock(side_effect=exchange)
+    pvs.set_hedging(min_samples=1)
+    assert pvs.hedge_delay('PING') is None
+    pvs.latency('PING').record(0.01)
+    assert await pvs.ping() == 'PONG'
+    assert pvs.exchange.await_count == 2
+    # each command is measured on its own
+    assert len(pvs.latency('PING')) == 2 and pvs.hedge_delay('SCAN') is None
+
+    # directory scans are never sent twice
+    pvs.exchange = mock.AsyncMock(return_value=b'/d: OK')
+    pvs.use_pool = mock.Mock(return_value=True)
+    pvs.check_path = mock.AsyncMock(return_value=True)
+    pvs.latency('MULTISCAN').record(0)
+    assert await pvs.multiscan('/d') == '/d: OK'
+    assert pvs.exchange.await_count == 1
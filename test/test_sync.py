@@ -0,0 +1,97 @@
+""" Test class for the blocking client """
+import asyncio
+import subprocess
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import PyvalveScanningError
+from src.pyvalve.sync import LoopThread, PyvalveSync
+from benchmarks.fake_clamd import free_port
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def loop_thread():
+    thread = LoopThread()
+    yield thread
+    thread.stop()
+
+@pytest.fixture
+def clamd(tmp_path):
+    """ A fake clamd in another process, on a unix socket and a TCP port """
+    path, port = str(tmp_path / 'clamd.socket'), free_port()
+    server = subprocess.Popen([sys.executable,
+        os.path.dirname(os.path.abspath(__file__)) + '/../benchmarks/fake_clamd.py',
+        '--socket', path, '--port', str(port), '--latency', '0.001'],
+        stdout=subprocess.DEVNULL)
+    while not os.path.exists(path):
+        assert server.poll() is None
+        time.sleep(0.01)
+    yield path, f'127.0.0.1:{port}'
+    server.terminate()
+    server.wait()
+
+def hammer(pvs, directory):
+    """ Call the client from many threads at once, return the wrong replies """
+    def call(i):
+        path = os.path.join(directory, f'file{i % 4}')
+        kind = i % 4
+        if kind == 0:
+            return pvs.ping(), 'PONG'
+        if kind == 1:
+            return pvs.scan(path), f'{path}: OK'
+        if kind == 2:
+            return pvs.multiscan(directory), f'{directory}: OK'
+        return pvs.instream(BytesIO(os.urandom(2000))), 'stream: OK'
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        replies = list(executor.map(call, range(400)))
+    return [(reply, expected) for reply, expected in replies if reply != expected]
+
+@pytest.mark.parametrize('pool_size', [8, 0])
+def test_sync_threads(loop_thread, clamd, tmp_path, pool_size):
+    for i in range(4):
+        (tmp_path / f'file{i}').write_bytes(b'x')
+    pvs = PyvalveSync(clamd[0], pool_size=pool_size, loop=loop_thread)
+    assert (pvs.client.pool is not None) == bool(pool_size)
+
+    # pooled and one shot calls from many threads each get their own reply
+    assert hammer(pvs, str(tmp_path)) == []
+
+    with pytest.raises(PyvalveScanningError):
+        pvs.scan(str(tmp_path / 'missing'))
+
+    # other methods go through the asyncio client
+    pvs.set_call_timeout(5)
+    assert pvs.client.call_timeout == 5 and pvs.call_timeout == 5
+    assert [result.path for result in pvs.iter_scan(str(tmp_path))] == [str(tmp_path)]
+
+    with pvs:
+        pass
+    assert pvs.client.pool is None or pvs.client.pool.closed
+
+def test_sync_loop(loop_thread, clamd):
+    async def inside():
+        loop_thread.run(asyncio.sleep(0))
+    with pytest.raises(RuntimeError):
+        loop_thread.run(inside())
+
+    # clients share one loop unless given their own
+    assert LoopThread.shared() is LoopThread.shared()
+    pvs = PyvalveSync(clamd[1], pool_size=0, call_timeout=2)
+    assert pvs.loop is LoopThread.shared()
+    assert (pvs.client.host, pvs.client.port) == ('127.0.0.1', int(clamd[1].rsplit(':')[1]))
+    assert pvs.client.pool is None and pvs.client.call_timeout == 2
+    assert pvs.ping() == 'PONG'
+    pvs.loop.stop()
+    assert LoopThread.shared() is not pvs.loop
+    LoopThread.shared().stop()
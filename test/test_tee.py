@@ -0,0 +1,103 @@
+""" Test class for scanning while forwarding """
+import asyncio
+import pytest
+from io import BytesIO
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Pyvalve, PyvalveResponseError, StagedFile, TeeStream
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+def streamed(conn):
+    return b''.join(bytes(call.args[0][1]) for call in conn.writer.writelines.call_args_list)
+
+async def body(*chunks):
+    for chunk in chunks:
+        await asyncio.sleep(0)
+        yield chunk
+
+@pytest.mark.asyncio
+async def test_tee_stream(session_connection):
+    pvs = await Pyvalve()
+    pvs.set_stream_buffer(4)
+    conn = session_connection(after_stream=b'1: stream: OK\0')
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    pvs.set_persistant_connection(True)
+
+    # a blocking destination is written from a thread
+    stored = BytesIO()
+    assert await pvs.instream_tee(body(b'abc', b'defghij'), stored) == 'stream: OK'
+    assert stored.getvalue() == streamed(conn) == b'abcdefghij'
+
+    # chunks are stored while the previous ones are sent
+    active = set()
+    overlapped = []
+    class Destination():
+        def __init__(self):
+            self.data = b''
+        async def write(self, chunk):
+            active.add('store')
+            await asyncio.sleep(0.01)
+            self.data += bytes(chunk)
+            active.discard('store')
+    async def drain():
+        await asyncio.sleep(0)
+        overlapped.append('store' in active)
+    conn = session_connection(after_stream=b'1: stream: OK\0')
+    conn.writer.drain = mock.AsyncMock(side_effect=drain)
+    destination = Destination()
+    tee = TeeStream(BytesIO(b'x' * 64), destination, chunk_size=16)
+    assert await pvs.send_stream(conn, b'zINSTREAM\0', tee) == 'stream: OK'
+    assert tee.complete and tee.forwarded == 64 and destination.data == b'x' * 64
+    assert any(overlapped)
+
+@pytest.mark.asyncio
+async def test_tee_early_reply(session_connection):
+    pvs = await Pyvalve()
+    pvs.set_stream_buffer(4)
+    conn = session_connection()
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    pvs.set_persistant_connection(True)
+
+    async def drain():
+        await asyncio.sleep(0)
+        if conn.writer.writelines.call_count == 1:
+            conn.reader.feed_data(b'1: stream: Read timeout ERROR\0')
+    conn.writer.drain = mock.AsyncMock(side_effect=drain)
+    stored = BytesIO()
+    with pytest.raises(PyvalveResponseError):
+        await pvs.instream_tee(body(b'abcd', b'efgh', b'ijkl', b'mnop'), stored)
+    assert len(stored.getvalue()) < 16
+
+@pytest.mark.asyncio
+async def test_staged_file(tmp_path, session_connection):
+    path = str(tmp_path / 'upload.bin')
+
+    async def store(reply, commit):
+        pvs = await Pyvalve()
+        conn = session_connection(after_stream=reply)
+        pvs.open_session = mock.AsyncMock(return_value=conn)
+        pvs.set_persistant_connection(True)
+        async with StagedFile(path, mode=0o600) as staged:
+            response = await pvs.instream_tee(body(b'abc', b'def'), staged)
+            if commit(response):
+                await staged.commit()
+        return response
+
+    # infected uploads never reach the final path
+    await store(b'1: stream: Eicar-Signature FOUND\0', commit=lambda r: r.endswith(': OK'))
+    assert os.listdir(tmp_path) == []
+
+    await store(b'1: stream: OK\0', commit=lambda r: r.endswith(': OK'))
+    assert os.listdir(tmp_path) == ['upload.bin']
+    with open(path, 'rb') as file:
+        assert file.read() == b'abcdef'
+    assert os.stat(path).st_mode & 0o777 == 0o600
@@ -0,0 +1,100 @@
+""" Test class for directory walks """
+import asyncio
+import pytest
+from contextlib import aclosing
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from src.pyvalve import Pyvalve, PyvalveScanningError, TreeFilter, map_bounded, walk_tree
+from unittest import mock
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for name, size in (('a.txt', 1), ('b.iso', 1), ('big.txt', 100), ('src/c.txt', 1),
+            ('src/cache/d.txt', 1), ('.git/config', 1), ('deep/er/est/e.txt', 1)):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * size)
+    os.symlink(tmp_path, tmp_path / 'src' / 'loop')
+    os.mkfifo(tmp_path / 'fifo')
+    return tmp_path
+
+async def walk(root, tree_filter=None, workers=4, onerror=None):
+    return sorted([os.path.relpath(path, root)
+        async for path in walk_tree(str(root), tree_filter, workers, onerror)])
+
+@pytest.mark.asyncio
+async def test_walk_tree(tree):
+    # links and fifos are skipped
+    assert await walk(tree) == ['.git/config', 'a.txt', 'b.iso', 'big.txt',
+        'deep/er/est/e.txt', 'src/c.txt', 'src/cache/d.txt']
+
+    tree_filter = TreeFilter(include=['*.txt'], exclude=['.git', 'src/cache'], max_size=10)
+    assert await walk(tree, tree_filter, workers=1) == ['a.txt', 'deep/er/est/e.txt', 'src/c.txt']
+
+    # a link to the root is walked once
+    followed = await walk(tree, TreeFilter(include=['c.txt'], follow_symlinks=True))
+    assert len(followed) == 1
+
+    errors = []
+    assert await walk(tree / 'missing', onerror=errors.append) == []
+    assert isinstance(errors[0], FileNotFoundError)
+    with pytest.raises(ValueError):
+        await walk(tree, workers=0)
+
+@pytest.mark.asyncio
+async def test_map_bounded_async():
+    closed = []
+    async def items():
+        try:
+            for item in range(100):
+                await asyncio.sleep(0)
+                yield item
+        finally:
+            closed.append(True)
+
+    async def double(item):
+        return item * 2
+
+    results = [r async for r in map_bounded(double, items(), concurrency=4, ordered=True)]
+    assert [r.result for r in results] == list(range(0, 200, 2))
+    assert [r.index for r in results] == list(range(100))
+
+    # leaving early closes the source
+    closed.clear()
+    async with aclosing(map_bounded(double, items(), concurrency=4)) as batch:
+        async for result in batch:
+            break
+    assert closed == [True]
+
+@pytest.mark.asyncio
+async def test_scan_tree(tree, session_connection):
+    conn = session_connection(b'1: stream: OK\0', b'2: stream: Eicar-Signature FOUND\0')
+    pvs = await Pyvalve()
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    results = [r async for r in pvs.scan_tree(str(tree), include=['c.txt', 'e.txt'], concurrency=1)]
+    assert sorted(r.result for r in results) == ['stream: Eicar-Signature FOUND', 'stream: OK']
+    assert {os.path.basename(r.item) for r in results} == {'c.txt', 'e.txt'}
+
+    conn = session_connection(b'1: /clamd/a.txt: OK\0')
+    pvs.open_session = mock.AsyncMock(return_value=conn)
+    pvs.set_routing(shared_paths={str(tree): '/clamd'})
+    results = [r async for r in pvs.scan_tree(str(tree), include=['a.txt'], command='SCAN')]
+    assert results[0].result == '/clamd/a.txt: OK'
+    conn.writer.write.assert_any_call(b'zSCAN /clamd/a.txt\0')
+
+    # files outside the shared paths can not be sent by path
+    pvs.set_routing(shared_paths={'/elsewhere': '/clamd'})
+    results = [r async for r in pvs.scan_tree(str(tree), include=['a.txt'], command='SCAN')]
+    assert isinstance(results[0].error, PyvalveScanningError)
+
+    with pytest.raises(ValueError):
+        pvs.scan_tree(str(tree), command='MULTISCAN')